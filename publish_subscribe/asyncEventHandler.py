@@ -0,0 +1,498 @@
+''' An asyncio client of the notifier: the counterpart of the threaded
+    EventHandler for code that already runs in an event loop.
+
+    A single task reads the connection and dispatches the events; the
+    callbacks are called from the event loop (if a callback returns an
+    awaitable it is scheduled as a task). This module requires python 3.
+    '''
+import asyncio
+import random
+import socket
+import syslog, traceback
+from .connection import ConnectionClosed, PartialMessageDueConnectionClose, parse_address
+from .message import pack_message, unpack_message_header, unpack_message_body, pack_publish_batches
+from .message import ProtocolVersion, HeaderLenByVersion, is_content_typed, supports_sync, supports_filters, supports_retained
+from .serializers import serializer_by_name
+from .topic import build_topic_chain, ValidTopicsCache, is_pattern, compile_pattern
+from .filters import canonical_filter, compile_filter
+from .esc import esc, to_bytes, to_text
+
+
+class TopicStream(object):
+    ''' The events of a topic (and its subtopics) to be consumed with
+        'async for'. Created by AsyncEventHandler.stream; close it to
+        unsubscribe. '''
+    def __init__(self, handler, topic, queue_len):
+        self.handler = handler
+        self.topic = topic
+        self.queue = asyncio.Queue(queue_len)
+        self.subscription_id = None
+        self.closed = False
+
+    def _put(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.handler._log(syslog.LOG_ERR, "The stream of the topic '%s' is full. Dropping the event." % esc(self.topic))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.queue.empty():
+            raise StopAsyncIteration
+
+        data = await self.queue.get()
+        if data is _EndOfStream:
+            raise StopAsyncIteration
+        return data
+
+    async def close(self):
+        if self.subscription_id is not None:
+            subscription_id, self.subscription_id = self.subscription_id, None
+            await self.handler.unsubscribe(subscription_id)
+
+            # a consumer waiting in an empty queue is woken up by the end
+            # of the stream; if the queue is full, it ends once it drains it
+            self.closed = True
+            try:
+                self.queue.put_nowait(_EndOfStream)
+            except asyncio.QueueFull:
+                pass
+
+_EndOfStream = object()
+
+
+class AsyncEventHandler(object):
+    def __init__(self, name="(bob-asyncio)", address=("localhost", 5555), protocol_version=ProtocolVersion, serializer="json"):
+        ''' Create the handler; it must be connected with 'await connect()'
+            before using it (or use the AsyncEventHandler.open shortcut).
+
+            The 'protocol_version' and 'serializer' have the same meaning
+            that in the Publisher of the eventHandler module. '''
+        self.name = to_text(name)
+        self.bin_name = to_bytes(name)
+        self.address = address
+
+        serializer_by_name(serializer)  # fail early if it is unknown
+        if serializer != "json" and not is_content_typed(protocol_version):
+            raise ValueError("The serializer '%s' requires the version 3 of the protocol or higher." % serializer)
+
+        self.serializer = serializer
+        self.max_protocol_version = protocol_version
+        self.protocol_version = 1
+        self._wire_serializer = None
+
+        self.reader = self.writer = None
+        self._reading_task = None
+        self.said_goodbye = False
+        self.closed = False
+
+        self.callbacks_by_topic = {}
+        self.matchers_by_pattern = {}   # the subscribed topics with wildcards (see topic.compile_pattern)
+        self.filtered_callbacks_by_topic = {}   # see EventHandler.subscribe
+        self.filtered_subscriptions = {}
+        self.subscriptions_by_id = {}
+        self.next_valid_subscription_id = 0
+
+        # the futures of the outstanding requests by the topic of their response
+        self._pending_responses = {}
+
+        # the futures waiting for a 'synced' message by its cookie
+        self._pending_syncs = {}
+
+        self._safe_topics = ValidTopicsCache()
+
+    @classmethod
+    async def open(cls, *args, **kargs):
+        handler = cls(*args, **kargs)
+        await handler.connect()
+        return handler
+
+    async def connect(self):
+        try:
+            if isinstance(self.address, socket.socket):
+                self.reader, self.writer = await asyncio.open_connection(sock=self.address)
+            else:
+                family, address = parse_address(self.address)
+                if family == socket.AF_INET:
+                    self.reader, self.writer = await asyncio.open_connection(*address)
+                else:
+                    self.reader, self.writer = await asyncio.open_unix_connection(address)
+            self._log(syslog.LOG_DEBUG, "Established a connection with the notifier server (%s)." % esc(str(self.address)))
+        except:
+            self._log(syslog.LOG_ERR, "Error when creating a connection with the notifier server (%s): %s." % esc(str(self.address), traceback.format_exc()))
+            raise
+
+        if self.max_protocol_version > 1:
+            self.writer.write(pack_message(message_type='hello', name=self.bin_name, max_protocol_version=self.max_protocol_version))
+            message_type, message_body = await self._receive_message()
+            if message_type != "welcome":
+                raise Exception("Unexpected message of type '%s' (expecting a 'welcome' message)." % message_type)
+
+            self.protocol_version = unpack_message_body(message_type, message_body)
+            self._log(syslog.LOG_DEBUG, "Using the protocol version %i." % esc(self.protocol_version))
+        else:
+            self.writer.write(pack_message(message_type='introduce_myself', name=self.bin_name))
+
+        if is_content_typed(self.protocol_version):
+            self._wire_serializer = self.serializer
+        elif self.serializer != "json":
+            raise Exception("The notifier doesn't support the serializer '%s' (protocol version %i)." % (self.serializer, self.protocol_version))
+
+        self._reading_task = asyncio.ensure_future(self._read_and_dispatch())
+
+    async def _receive_message(self):
+        header_len = HeaderLenByVersion[self.protocol_version]
+        try:
+            header = await self.reader.readexactly(header_len)
+        except asyncio.IncompleteReadError as ex:
+            if ex.partial:
+                raise PartialMessageDueConnectionClose()
+            raise ConnectionClosed()
+
+        message_type, message_body_len = unpack_message_header(header, self.protocol_version)
+        try:
+            message_body = await self.reader.readexactly(message_body_len)
+        except asyncio.IncompleteReadError:
+            raise PartialMessageDueConnectionClose()
+
+        return message_type, message_body
+
+    async def _read_and_dispatch(self):
+        try:
+            while True:
+                message_type, message_body = await self._receive_message()
+                content_typed = is_content_typed(self.protocol_version)
+
+                if message_type == "publish_batch":
+                    for topic, obj in unpack_message_body(message_type, message_body, dont_unpack_object=False, content_typed=content_typed):
+                        self.dispatch(topic, obj)
+                    continue
+
+                if message_type == "ping":
+                    self._send(pack_message(message_type='pong', cookie=unpack_message_body(message_type, message_body), protocol_version=self.protocol_version))
+                    continue
+
+                if message_type == "synced":
+                    future = self._pending_syncs.pop(unpack_message_body(message_type, message_body), None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+                    continue
+
+                if message_type != "publish":
+                    self._log(syslog.LOG_ERR, "Unexpected message of type '%s' (expecting a 'publish' message). Dropping the message and moving on." % esc(message_type))
+                    continue
+
+                topic, obj = unpack_message_body(message_type, message_body, dont_unpack_object=False, content_typed=content_typed)
+                self.dispatch(topic, obj)
+
+        except Exception as ex:
+            if isinstance(ex, ConnectionClosed) and self.said_goodbye:
+                self._log(syslog.LOG_NOTICE, "The connection was closed, it's ok, we said goodbye.")
+            else:
+                self._log(syslog.LOG_ERR, "Exception when receiving a message: %s." % esc(traceback.format_exc()))
+        finally:
+            self.closed = True
+            self.writer.close()
+
+            # nobody will answer now
+            pending = list(self._pending_responses.values()) + list(self._pending_syncs.values())
+            self._pending_responses, self._pending_syncs = {}, {}
+            for future in pending:
+                if not future.done():
+                    future.set_exception(ConnectionClosed())
+
+    def dispatch(self, topic, obj):
+        ''' Call the callbacks of the topic and of its prefixes, the more
+            specific first (like EventHandler.dispatch does). '''
+        assert isinstance(topic, bytes)
+
+        future = self._pending_responses.pop(topic, None)
+        if future is not None and not future.done():
+            future.set_result(obj)
+
+        for t in build_topic_chain(topic):
+            for callback, subscription in list(self.callbacks_by_topic.get(t, ())):
+                self._execute_callback(callback, obj, t)
+
+        for pattern, matches in list(self.matchers_by_pattern.items()):
+            if matches(topic):
+                for callback, subscription in list(self.callbacks_by_topic.get(pattern, ())):
+                    self._execute_callback(callback, obj, pattern)
+
+        if self.filtered_callbacks_by_topic:
+            for t in build_topic_chain(topic):
+                for callback, subscription in list(self.filtered_callbacks_by_topic.get(t, ())):
+                    if subscription['filter'].matches(obj):
+                        self._execute_callback(callback, obj, t)
+
+    def _execute_callback(self, callback, data, t):
+        try:
+            result = callback(data)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                asyncio.ensure_future(self._await_callback(result, t))
+        except:
+            self._log(syslog.LOG_ERR, "Exception in callback for the topic '%s': %s" % esc((t if t else "(the empty topic)"), traceback.format_exc()))
+
+    async def _await_callback(self, awaitable, t):
+        try:
+            await awaitable
+        except:
+            self._log(syslog.LOG_ERR, "Exception in callback for the topic '%s': %s" % esc((t if t else "(the empty topic)"), traceback.format_exc()))
+
+    def _valid_topic(self, topic, allow_empty, allow_patterns=False):
+        topic = to_bytes(topic)
+        self._safe_topics.validate(topic, allow_empty=allow_empty, allow_patterns=allow_patterns)
+        return topic
+
+    def _send(self, message):
+        if self.closed:
+            raise ConnectionClosed()
+        self.writer.write(message)
+
+    async def publish(self, topic, data, retain=False):
+        ''' Publish the data on the topic. If 'retain' is true the notifier
+            keeps it for the later subscribers (see Publisher.publish). '''
+        topic = self._valid_topic(topic, allow_empty=False)
+        if retain and not supports_retained(self.protocol_version):
+            raise Exception("The notifier doesn't support the retained events (protocol version %i)." % self.protocol_version)
+
+        self._send(pack_message(message_type='publish_retained' if retain else 'publish', topic=topic, obj=data, dont_pack_object=False, protocol_version=self.protocol_version, serializer=self._wire_serializer))
+        await self.writer.drain()
+
+    async def publish_many(self, events):
+        ''' Publish several events, a sequence of (topic, data) pairs, at once
+            (see Publisher.publish_many). '''
+        events = [(self._valid_topic(topic, allow_empty=False), data) for topic, data in events]
+        if not events:
+            return
+
+        self._send(b"".join(pack_publish_batches(events, dont_pack_object=False, protocol_version=self.protocol_version, serializer=self._wire_serializer)))
+        await self.writer.drain()
+
+    def _subscribe(self, topic, callback):
+        if topic in self.callbacks_by_topic:
+            self.callbacks_by_topic[topic].append((callback, {'id': self.next_valid_subscription_id}))
+        else:
+            self._send(pack_message(message_type='subscribe', topic=topic, protocol_version=self.protocol_version))
+            self.callbacks_by_topic[topic] = [(callback, {'id': self.next_valid_subscription_id})]
+            if is_pattern(topic):
+                self.matchers_by_pattern[topic] = compile_pattern(topic)
+
+        self.subscriptions_by_id[self.next_valid_subscription_id] = {
+              'callback': callback,
+              'topic': topic,
+              }
+
+        self.next_valid_subscription_id += 1
+        return self.next_valid_subscription_id - 1
+
+    def _subscribe_filtered(self, topic, callback, compiled_filter):
+        meta = {'id': self.next_valid_subscription_id, 'filter': compiled_filter}
+        self.filtered_callbacks_by_topic.setdefault(topic, []).append((callback, meta))
+
+        key = (topic, compiled_filter.raw)
+        count = self.filtered_subscriptions.get(key, 0)
+        self.filtered_subscriptions[key] = count + 1
+        if not count:
+            self._send(self._pack_filtered_subscription('subscribe', topic, compiled_filter.raw))
+
+        self.subscriptions_by_id[self.next_valid_subscription_id] = {
+              'callback': callback,
+              'topic': topic,
+              'filter': compiled_filter.raw,
+              }
+
+        self.next_valid_subscription_id += 1
+        return self.next_valid_subscription_id - 1
+
+    def _pack_filtered_subscription(self, message_type, topic, filter_raw):
+        # see EventHandler._pack_filtered_subscription
+        if supports_filters(self.protocol_version):
+            return pack_message(message_type=message_type + '_filtered', topic=topic, filter_raw=filter_raw, protocol_version=self.protocol_version)
+
+        return pack_message(message_type=message_type, topic=topic, protocol_version=self.protocol_version)
+
+    async def subscribe(self, topic, callback, return_subscription_id=False, send_and_wait_echo=True, filter=None):
+        ''' Call 'callback' with the data of each event of the topic or of
+            any of its subtopics. The callback can be a coroutine function.
+
+            If 'send_and_wait_echo' is true, wait until the notifier has
+            processed the subscription so any event published after this
+            returns will be received.
+
+            If 'filter' is given, only the events whose data matches it are
+            received (see EventHandler.subscribe). '''
+        if filter is not None:
+            compiled_filter = compile_filter(canonical_filter(filter))
+            topic = self._valid_topic(topic, allow_empty=True)
+            subscription_id = self._subscribe_filtered(topic, callback, compiled_filter)
+        else:
+            topic = self._valid_topic(topic, allow_empty=True, allow_patterns=True)
+            subscription_id = self._subscribe(topic, callback)
+
+        if send_and_wait_echo:
+            await self._wait_echo()
+        else:
+            await self.writer.drain()
+
+        return subscription_id if return_subscription_id else None
+
+    async def _wait_echo(self):
+        # wait until the notifier processed everything sent before (see
+        # EventHandler._wait_until_synced)
+        synced = asyncio.get_event_loop().create_future()
+        if supports_sync(self.protocol_version):
+            cookie = int(random.getrandbits(32))
+            while cookie in self._pending_syncs:
+                cookie = int(random.getrandbits(32))
+
+            self._pending_syncs[cookie] = synced
+            self._send(pack_message(message_type='sync', cookie=cookie, protocol_version=self.protocol_version))
+            await self.writer.drain()
+        else:
+            cookie = "echo-%i" % int(random.getrandbits(30))
+            self._subscribe_for_once_call(to_bytes(cookie), lambda data: synced.done() or synced.set_result(None))
+            await self.publish(cookie, '')
+
+        await synced
+
+    async def unsubscribe(self, subscription_id):
+        self._unsubscribe(subscription_id)
+        await self.writer.drain()
+
+    def _unsubscribe(self, subscription_id):
+        try:
+            subscription = self.subscriptions_by_id.pop(subscription_id)
+        except KeyError:
+            raise Exception("The subscription id '%i' hasn't any callback registered to it." % esc(subscription_id))
+
+        topic = subscription['topic']
+        if 'filter' in subscription:
+            self._unsubscribe_filtered(subscription_id, topic, subscription['filter'])
+            return
+
+        callbacks = self.callbacks_by_topic[topic]
+        for i, (callback, meta) in enumerate(callbacks):
+            if meta['id'] == subscription_id:
+                del callbacks[i]
+                break
+
+        if not callbacks:
+            del self.callbacks_by_topic[topic]
+            self.matchers_by_pattern.pop(topic, None)
+            if not self.closed:
+                self._send(pack_message(message_type='unsubscribe', topic=topic, protocol_version=self.protocol_version))
+
+    def _unsubscribe_filtered(self, subscription_id, topic, filter_raw):
+        callbacks = self.filtered_callbacks_by_topic[topic]
+        callbacks[:] = [(callback, meta) for callback, meta in callbacks if meta['id'] != subscription_id]
+        if not callbacks:
+            del self.filtered_callbacks_by_topic[topic]
+
+        key = (topic, filter_raw)
+        self.filtered_subscriptions[key] -= 1
+        if not self.filtered_subscriptions[key]:
+            del self.filtered_subscriptions[key]
+            if not self.closed:
+                self._send(self._pack_filtered_subscription('unsubscribe', topic, filter_raw))
+
+    def _subscribe_for_once_call(self, topic, callback):
+        subscription = {}
+        def wrapper(data):
+            if 'done' in subscription:
+                return
+            subscription['done'] = True
+            self._unsubscribe(subscription['id'])
+            return callback(data)
+
+        subscription['id'] = self._subscribe(topic, wrapper)
+        return subscription['id']
+
+    async def subscribe_for_once_call(self, topic, callback, send_and_wait_echo=True):
+        topic = self._valid_topic(topic, allow_empty=True, allow_patterns=True)
+        subscription_id = self._subscribe_for_once_call(topic, callback)
+
+        if send_and_wait_echo:
+            await self._wait_echo()
+        else:
+            await self.writer.drain()
+
+        return subscription_id
+
+    async def wait(self, topic, timeout=None):
+        ''' Wait for the next event of the topic (or of any of its subtopics)
+            and return its data. Raise asyncio.TimeoutError if 'timeout'
+            seconds passed without events. '''
+        topic = self._valid_topic(topic, allow_empty=True, allow_patterns=True)
+        received = asyncio.get_event_loop().create_future()
+        subscription_id = self._subscribe_for_once_call(topic, lambda data: received.done() or received.set_result(data))
+        await self.writer.drain()
+
+        try:
+            return await asyncio.wait_for(received, timeout)
+        finally:
+            if not received.done() and subscription_id in self.subscriptions_by_id:
+                self._unsubscribe(subscription_id)
+
+    async def stream(self, topic, queue_len=0):
+        ''' Subscribe to the topic and return a TopicStream to iterate over
+            its events with 'async for'. Up to 'queue_len' events are held
+            until they are consumed (0 means no limit); the events that
+            don't fit are dropped. '''
+        topic = self._valid_topic(topic, allow_empty=True, allow_patterns=True)
+        stream = TopicStream(self, topic, queue_len)
+        stream.subscription_id = await self.subscribe(topic, stream._put, return_subscription_id=True)
+        return stream
+
+    async def request(self, request_topic, data, response_topic, timeout=None):
+        ''' Publish 'data' in the 'request_topic' and return the data of the
+            event published later in the 'response_topic'.
+
+            The subscription to the response and the request are sent
+            together without waiting any echo: the notifier processes them
+            in order so the response cannot be missed. The outstanding
+            requests are just futures indexed by their response topic so
+            thousands of them can share the same connection.
+
+            Raise asyncio.TimeoutError if no response arrived in 'timeout'
+            seconds. '''
+        response_topic = self._valid_topic(response_topic, allow_empty=False)
+        if response_topic in self._pending_responses:
+            raise ValueError("There is already a request waiting a response in the topic '%s'." % to_text(response_topic))
+
+        response = asyncio.get_event_loop().create_future()
+        self._pending_responses[response_topic] = response
+
+        # a callback may be subscribed to the same topic already
+        already_subscribed = response_topic in self.callbacks_by_topic
+        if not already_subscribed:
+            self._send(pack_message(message_type='subscribe', topic=response_topic, protocol_version=self.protocol_version))
+        try:
+            await self.publish(request_topic, data)
+            return await asyncio.wait_for(response, timeout)
+        finally:
+            self._pending_responses.pop(response_topic, None)
+            if not already_subscribed and not self.closed and response_topic not in self.callbacks_by_topic:
+                self._send(pack_message(message_type='unsubscribe', topic=response_topic, protocol_version=self.protocol_version))
+
+    async def close(self):
+        if not self.closed:
+            self._send(pack_message(message_type='goodbye', name=self.bin_name, protocol_version=self.protocol_version))
+            self.said_goodbye = True
+            await self.writer.drain()
+            self.writer.close()
+
+        if self._reading_task is not None:
+            await self._reading_task
+
+    def __repr__(self):
+        return "Endpoint (%s)" % self.name
+
+    def _log(self, level, message):
+        header = "%s: " % esc(repr(self))
+        message = header + message
+
+        syslog.syslog(level, message)
+        return message
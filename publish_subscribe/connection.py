@@ -1,12 +1,15 @@
 
 import socket
+import threading
 import syslog
 import json
 import time
 import traceback
+import sys
 
 from .esc import esc
-from .message import unpack_message_header
+from .message import unpack_message_header, HeaderLenByVersion
+from . import tracing
 
 class ConnectionClosed(Exception):
     def __init__(self, msg=""):
@@ -16,17 +19,200 @@ class PartialMessageDueConnectionClose(Exception):
     def __init__(self, msg=""):
         Exception.__init__(self, "The message was sent/received partially due an unexpected connection close. " + msg)
 
+class MessageLargerThanAllowed(Exception):
+    def __init__(self, message_body_len, max_message_len):
+        Exception.__init__(self, "The header announces a message of %i bytes, larger than the %i bytes allowed." % (message_body_len, max_message_len))
+
+# how many chunks are given to a single sendmsg (the IOV_MAX of Linux)
+_MaxChunksPerSend = 1024
+
+# below this, joining the chunks is cheaper than a scatter/gather write
+_MinLenToGather = 16 * 1024
+
+_can_gather = hasattr(socket.socket, "sendmsg")
+
+def send_chunks(sock, chunks):
+   ''' Send the chunks (a list of bytes-like objects) with a single write.
+       Large chunks are sent with a scatter/gather write (sendmsg) instead
+       of joining them; small ones are joined first, which is cheaper.
+       The sent chunks are removed from the list and a partially sent
+       chunk is replaced by its remainder. Return how many bytes were sent. '''
+   if len(chunks) > 1 and (not _can_gather or sum(len(chunk) for chunk in chunks[:_MaxChunksPerSend]) < _MinLenToGather):
+      chunks[:_MaxChunksPerSend] = [b"".join(chunks[:_MaxChunksPerSend])]
+
+   if len(chunks) == 1 or not _can_gather:
+      sent = sock.send(chunks[0])
+   else:
+      sent = sock.sendmsg(chunks[:_MaxChunksPerSend])
+
+   _forget_sent_chunks(chunks, sent)
+   return sent
+
+def _forget_sent_chunks(chunks, sent):
+   i = 0
+   while i < len(chunks) and sent >= len(chunks[i]):
+      sent -= len(chunks[i])
+      i += 1
+
+   del chunks[:i]
+   if sent:
+      # python 2.x cannot join memoryviews (and it never gathers)
+      chunks[0] = memoryview(chunks[0])[sent:] if _can_gather else chunks[0][sent:]
+
+
+class MessageReader(object):
+   ''' Buffered reader of messages. The bytes are received with large
+       recv_into calls in a reusable buffer and then all the complete
+       messages received are parsed from it without more reads.
+
+       The bodies of the messages that fit in the buffer are returned as
+       views of it (memoryview; in python 2.x they are copied): they are
+       valid only until the next recv_from so they must be unpacked
+       before reading more (the unpack_* functions return copies).
+       The larger messages are received directly in their own buffer,
+       which grows as their bytes arrive: a header alone doesn't allocate
+       the body that it announces. A message whose body is larger than
+       'max_message_len' (None for no limit) is refused: the header
+       raises MessageLargerThanAllowed.
+       '''
+   def __init__(self, buffer_len=64 * 1024, max_message_len=None):
+      self.max_message_len = max_message_len
+      self.buf = bytearray(buffer_len)
+      self.view = memoryview(self.buf)
+      self.begin = self.end = 0   # the bytes received but not parsed yet
+
+      # the header of the message being received, None while waiting for it
+      self.message_type = None
+      self.message_body_len = None
+
+      # the body of a message that doesn't fit in the buffer
+      self.large_body = None
+      self.large_body_received = 0
+
+   def recv_from(self, sock):
+      ''' Receive from the socket with a single recv_into. Return how many
+          bytes were received, 0 if the connection was closed.
+          Any socket error (like EAGAIN for non-blocking sockets) is
+          propagated. '''
+      if self.large_body is not None:
+         if self.large_body_received == len(self.large_body):
+            # double it, up to the size of the body
+            growth = min(max(len(self.large_body), len(self.buf)), self.message_body_len - len(self.large_body))
+            self.large_body.extend(bytearray(growth))
+
+         n = sock.recv_into(memoryview(self.large_body)[self.large_body_received:])
+         self.large_body_received += n
+         return n
+
+      if self.begin == self.end:
+         self.begin = self.end = 0
+
+      elif self.end == len(self.buf):
+         # move the incomplete message to the begin of the buffer
+         pending = self.end - self.begin
+         self.buf[:pending] = self.buf[self.begin:self.end]
+         self.begin, self.end = 0, pending
+
+      n = sock.recv_into(self.view[self.end:])
+      self.end += n
+      return n
+
+   def next_message(self, protocol_version):
+      ''' Parse the next message from the received bytes and return its
+          type and body, or None if the message is not complete yet. '''
+      if self.message_type is None:
+         header_len = HeaderLenByVersion[protocol_version]
+         if self.end - self.begin < header_len:
+            return None
+
+         message_type, message_body_len = unpack_message_header(bytes(self.buf[self.begin:self.begin+header_len]), protocol_version)
+         if self.max_message_len is not None and message_body_len > self.max_message_len:
+            raise MessageLargerThanAllowed(message_body_len, self.max_message_len)
+
+         self.message_type, self.message_body_len = message_type, message_body_len
+         self.begin += header_len
+
+         if self.message_body_len > len(self.buf):
+            self.large_body_received = min(self.end - self.begin, self.message_body_len)
+            self.large_body = bytearray(self.buf[self.begin:self.begin+self.large_body_received])
+            self.begin += self.large_body_received
+
+      if self.large_body is not None:
+         if self.large_body_received < self.message_body_len:
+            return None
+
+         message_body = self.large_body
+         self.large_body = None
+         self.large_body_received = 0
+
+      else:
+         if self.end - self.begin < self.message_body_len:
+            return None
+
+         message_body = self._body(self.begin, self.begin + self.message_body_len)
+         self.begin += self.message_body_len
+
+      message = (self.message_type, message_body)
+      self.message_type = self.message_body_len = None
+      return message
+
+   if sys.version_info.major > 2:
+      def _body(self, begin, end):
+         return self.view[begin:end]
+   else:
+      def _body(self, begin, end):
+         return self.buf[begin:end]
+
+   def is_in_the_middle_of_a_message(self):
+      return self.message_type is not None or self.begin != self.end
+
+   def pending_len(self):
+      ''' How many bytes of an incomplete message are held. '''
+      return (self.end - self.begin) + self.large_body_received
+
+
+UnixAddressPrefix = "unix:"
+
+def parse_address(address):
+   ''' Return the family of the socket and the address to bind or connect
+       it: an address like "unix:/path" is a Unix domain socket, an
+       address like ("host", port) is a TCP socket. '''
+   if isinstance(address, (tuple, list)):
+      return socket.AF_INET, tuple(address)
+
+   if hasattr(address, "startswith") and address.startswith(UnixAddressPrefix):
+      if not hasattr(socket, "AF_UNIX"):
+         raise ValueError("The Unix domain sockets are not supported in this platform (address '%s')." % address)
+      return socket.AF_UNIX, address[len(UnixAddressPrefix):]
+
+   raise ValueError("Invalid address %s: expected a (host, port) pair or '%s/path'." % (repr(address), UnixAddressPrefix))
+
+
 class Connection(object):
-   def __init__(self, address_or_already_open_socket, whoiam="(?)"):
-      self.buf = ""
+   # size of the reusable receive buffer (see MessageReader)
+   recv_buffer_len = 64 * 1024
+
+   def __init__(self, address_or_already_open_socket, whoiam="(?)", max_message_len=None):
+      ''' Connect to the address (see parse_address) or use the given
+          socket, already connected (like one end of a socketpair). The
+          messages larger than 'max_message_len' are refused (see
+          MessageReader). '''
+      self.reader = MessageReader(self.recv_buffer_len, max_message_len)
       self.end_of_the_communication = False
       self.closed = True
       self.whoiam = whoiam
 
-      if isinstance(address_or_already_open_socket, (tuple, list)):
-         address = address_or_already_open_socket
+      # the messages sent by different threads must not be interleaved
+      self.send_lock = threading.Lock()
+
+      # how the messages are framed, see the 'hello' message
+      self.protocol_version = 1
 
-         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      # (in python 2.x socketpair() doesn't return socket.socket objects)
+      if not hasattr(address_or_already_open_socket, "fileno"):
+         family, address = parse_address(address_or_already_open_socket)
+
+         self.socket = socket.socket(family, socket.SOCK_STREAM)
          connected = False
          attempts = 0
          while not connected:
@@ -56,24 +242,45 @@ class Connection(object):
       #        repr(message), 
       #        ]))
 
-      self.socket.sendall(message)
+      # only the clients send whole messages (the notifier sends chunks)
+      began = tracing.begin() if tracing.active else None
+      with self.send_lock:
+         self.socket.sendall(message)
+
+      if began is not None:
+         tracing.end("client.send", began)
+
+   def send_chunks(self, chunks, progress=None):
+      ''' Send the chunks as a single stream without joining them first
+          (see send_chunks). The list of chunks is consumed; 'progress', if
+          given, is called with the remaining chunks after each write. '''
+      if self.end_of_the_communication:
+         raise Exception("The communication is already close")
+
+      with self.send_lock:
+         while chunks:
+            send_chunks(self.socket, chunks)
+            if progress is not None:
+               progress(chunks)
 
    def receive_object(self):
+      ''' Receive the next message and return its type and its body. The
+          body may be a view of the receive buffer, valid only until the
+          next call (see MessageReader). '''
       if self.end_of_the_communication:
          raise Exception("The communication is already close")
 
-      header = self._read_next_message_header()
-      message_type, message_body = self._read_next_message_body(header)
-      #syslog.syslog(syslog.LOG_DEBUG, 
-      #        " ".join(["%s received" % self.whoiam, 
-      #        str(len(header)), 
-      #       repr(header), 
-      #        "op:", 
-      #        message_type, 
-      #        str(len(message_body)), 
-      #        repr(message_body)]))
+      while True:
+         message = self.reader.next_message(self.protocol_version)
+         if message is not None:
+            return message
 
-      return message_type, message_body
+         if not self.reader.recv_from(self.socket):
+            self.end_of_the_communication = True
+            if self.reader.is_in_the_middle_of_a_message():
+               raise PartialMessageDueConnectionClose("Received %i bytes of an incomplete message" % self.reader.pending_len())
+            else:
+               raise ConnectionClosed()
 
 
    def close(self):
@@ -94,47 +301,5 @@ class Connection(object):
          syslog.syslog(syslog.LOG_ERR, "Error in the close: '%s'" % esc(traceback.format_exc()))
 
     
-   def _read_next_message_header(self):
-      #syslog.syslog(syslog.LOG_DEBUG, "Waiting for the next message header")
-      header_len = 3
-      header = self._recv_all(header_len)
-
-      if len(header) < header_len:
-          self.end_of_the_communication = True
-          if not header:
-              raise ConnectionClosed()
-          else:
-              raise PartialMessageDueConnectionClose("Received %i bytes of the header" % (header_len-len(header)))
-
-      return header
-
-   def _read_next_message_body(self, header):
-      message_type, message_body_len = unpack_message_header(header)
-      #syslog.syslog(syslog.LOG_DEBUG, "Received '%s' with %i bytes to be read. Reading..." % esc(message_type, message_body_len))
-
-      message_body = self._recv_all(message_body_len)
-
-      if len(message_body) < message_body_len:
-          self.end_of_the_communication = True
-          raise PartialMessageDueConnectionClose("Received %i bytes of the message body" % (message_body_len-len(message_body)))
-
-      return message_type, message_body
-
-   
-   def _recv_all(self, to_receive):
-      chunks = []
-      assert to_receive >= 0
-
-      while to_receive > 0:
-          chunk = self.socket.recv(to_receive)
-          if not chunk:
-              break
-
-          chunks.append(chunk)
-          to_receive -= len(chunk)
-      
-      return b"".join(chunks)
-
-
    def __del__(self):
       self.close()
@@ -1,21 +1,64 @@
-import json
 import threading
 import socket
+import time
 from threading import Lock
 import syslog, traceback
 from .connection import Connection, ConnectionClosed
-from .message import pack_message, unpack_message_body
-from .topic import build_topic_chain, fail_if_topic_isnt_valid
+from .message import pack_message, unpack_message_body, pack_publish_batches, ShortMax, ProtocolVersion
+from .message import pack_object, is_content_typed, supports_sync, supports_filters, supports_retained, supports_keepalive, supports_no_pings
+from .serializers import serializer_by_name
+from .topic import build_topic_chain, ValidTopicsCache, is_pattern, compile_pattern
+from .filters import canonical_filter, compile_filter
 from .esc import esc, to_bytes, to_text
-import random
+from . import tracing
+import random, zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # python 2.x
 
 class Publisher(object):
-    def __init__(self, name="(publisher-only)", address=("localhost", 5555)):
+    # a Publisher never reads its connection so it cannot answer the pings
+    # of the notifier: it tells the notifier not to ping it (see 'no_pings')
+    answers_pings = False
+
+    def __init__(self, name="(publisher-only)", address=("localhost", 5555), coalesce_window=None, protocol_version=ProtocolVersion, serializer="json"):
+        ''' Connect to the notifier at 'address': a ("host", port) pair,
+            a Unix domain socket like "unix:/path" or a socket already
+            connected (see Notifier.socketpair).
+
+            The client and the notifier agree the version of the protocol
+            to use, at most 'protocol_version'. The version 1 limits the
+            messages to 64 KiB; the version 2 lifts the limit to 4 GiB.
+
+            The published objects are serialized with 'serializer' ("json"
+            or the more compact "msgpack", see the module serializers).
+            The subscribers decode each object with the serializer used to
+            publish it, no matter which one they use. Serializers other
+            than json require the version 3 of the protocol.
+
+            If 'coalesce_window' is not None, the published events are not
+            sent immediately: they are held at most 'coalesce_window' seconds
+            and sent together in 'publish_batch' messages, trading a little
+            latency for much fewer writes. See 'flush'.
+            '''
         self.name = to_text(name) # for threading.Thread compatibility
         self.bin_name = to_bytes(name)
 
         self.said_goodbye = False
 
+        serializer_by_name(serializer)  # fail early if it is unknown
+        if serializer != "json" and not is_content_typed(protocol_version):
+            raise ValueError("The serializer '%s' requires the version 3 of the protocol or higher." % serializer)
+
+        self.serializer = serializer
+
+        self.coalesce_window = coalesce_window
+        self._coalesce_cond = threading.Condition(Lock())
+        self._pending_events = []
+        self._pending_events_len = 0
+        self._flusher = None
+
         try:
           self.connection = Connection(address, whoiam=self.name)
           self._log(syslog.LOG_DEBUG, "Established a connection with the notifier server (%s)." % esc(str(address)))
@@ -23,24 +66,154 @@ class Publisher(object):
           self._log(syslog.LOG_ERR, "Error when creating a connection with the notifier server (%s): %s." % esc(str(address), traceback.format_exc()))
           raise 
 
-        self.connection.send_object(pack_message(message_type='introduce_myself', name=self.bin_name))
-        self._safe_topics = set()
+        if protocol_version > 1:
+            self._negotiate_protocol_version(protocol_version)
+
+            v = self.connection.protocol_version
+            if not self.answers_pings and supports_keepalive(v) and not supports_no_pings(v):
+                # an older notifier would ping us and we would not answer:
+                # connect again with the version 4 at most, without pings
+                self.connection.close()
+                self.connection = Connection(address, whoiam=self.name)
+                self._negotiate_protocol_version(4)
+
+            elif not self.answers_pings and supports_no_pings(v):
+                self.connection.send_object(pack_message(message_type='no_pings', protocol_version=v))
+        else:
+            self.connection.send_object(pack_message(message_type='introduce_myself', name=self.bin_name))
+
+        if is_content_typed(self.connection.protocol_version):
+            self._wire_serializer = self.serializer
+        elif self.serializer == "json":
+            self._wire_serializer = None    # json without content type
+        else:
+            raise Exception("The notifier doesn't support the serializer '%s' (protocol version %i)." % (self.serializer, self.connection.protocol_version))
+
+        self._safe_topics = ValidTopicsCache()
         
-    def publish(self, topic, data):
-        topic = to_bytes(topic)
-        if topic not in self._safe_topics:
-            fail_if_topic_isnt_valid(topic, allow_empty=False)
-            self._safe_topics.add(topic)
+    def _negotiate_protocol_version(self, max_protocol_version):
+        self.connection.send_object(pack_message(message_type='hello', name=self.bin_name, max_protocol_version=max_protocol_version))
+
+        message_type, message_body = self.connection.receive_object()
+        if message_type != "welcome":
+            raise Exception("Unexpected message of type '%s' (expecting a 'welcome' message)." % message_type)
+
+        self.connection.protocol_version = unpack_message_body(message_type, message_body)
+        self._log(syslog.LOG_DEBUG, "Using the protocol version %i." % esc(self.connection.protocol_version))
+
+    def publish(self, topic, data, retain=False):
+        ''' Publish the data on the topic.
+
+            If 'retain' is true, the notifier keeps the event as the last one
+            of the topic and sends it to the endpoints that subscribe later
+            to the topic or to any of its prefixes (see retained). Retaining
+            None clears it. This requires the version 8 of the protocol. '''
+        topic = self._valid_topic_to_publish(topic)
+
+        if retain:
+            if not supports_retained(self.connection.protocol_version):
+                raise Exception("The notifier doesn't support the retained events (protocol version %i)." % self.connection.protocol_version)
+
+            # sent after any coalesced event, never coalesced itself
+            self._send(pack_message(message_type='publish_retained', topic=topic, obj=data, dont_pack_object=False, protocol_version=self.connection.protocol_version, serializer=self._wire_serializer))
+            return
+
+        if self.coalesce_window is not None:
+            self._coalesce([(topic, data)])
+            return
 
         #self._log(syslog.LOG_DEBUG, "Sending publication of an event with topic '%s'." % esc(topic))
-        self.connection.send_object(pack_message(message_type='publish', topic=topic, obj=data, dont_pack_object=False))
+        self.connection.send_object(pack_message(message_type='publish', topic=topic, obj=data, dont_pack_object=False, protocol_version=self.connection.protocol_version, serializer=self._wire_serializer))
         #self._log(syslog.LOG_DEBUG, "Publication of an event sent.")
 
+    def publish_many(self, events):
+        ''' Publish several events, a sequence of (topic, data) pairs, at once.
+            The events are packed in as few 'publish_batch' messages as
+            possible and they are sent with a single write. '''
+        events = [(self._valid_topic_to_publish(topic), data) for topic, data in events]
+        if not events:
+            return
+
+        if self.coalesce_window is not None:
+            self._coalesce(events)
+            return
+
+        self.connection.send_object(b"".join(pack_publish_batches(events, dont_pack_object=False, protocol_version=self.connection.protocol_version, serializer=self._wire_serializer)))
+
+    def flush(self):
+        ''' Send right now the events held by the coalescing mode. '''
+        with self._coalesce_cond:
+            self._flush_pending_events()
+
+    def _valid_topic_to_publish(self, topic):
+        topic = to_bytes(topic)
+        self._safe_topics.validate(topic, allow_empty=False)
+        return topic
+
+    def _coalesce(self, events):
+        # serialize the objects now: this allows us to know how many
+        # bytes are pending so we can send them as soon as they fill
+        # a whole message
+        events = [(topic, pack_object(data, self._wire_serializer)) for topic, data in events]
+
+        with self._coalesce_cond:
+            was_empty = not self._pending_events
+            self._pending_events.extend(events)
+            self._pending_events_len += sum(len(topic) + len(obj_raw) for topic, obj_raw in events)
+
+            if self._pending_events_len >= ShortMax:
+                self._flush_pending_events()
+                return
+
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+            if was_empty:
+                self._coalesce_cond.notify()
+
+    def _flush_pending_events(self):
+        # the caller must hold the _coalesce_cond
+        if self._pending_events:
+            events, self._pending_events, self._pending_events_len = self._pending_events, [], 0
+            self.connection.send_object(b"".join(pack_publish_batches(events, dont_pack_object=True, protocol_version=self.connection.protocol_version)))
+
+    def _flush_periodically(self):
+        try:
+            with self._coalesce_cond:
+                while not self.connection.end_of_the_communication:
+                    if not self._pending_events:
+                        self._coalesce_cond.wait(1)
+                        continue
+
+                    # hold the events for a while so more events can be coalesced
+                    deadline = time.time() + self.coalesce_window
+                    remaining = self.coalesce_window
+                    while remaining > 0 and self._pending_events:
+                        self._coalesce_cond.wait(remaining)
+                        remaining = deadline - time.time()
+
+                    self._flush_pending_events()
+        except:
+            if not self.connection.closed:
+                self._log(syslog.LOG_ERR, "Exception when flushing the coalesced events: %s." % esc(traceback.format_exc()))
+
+    def _send(self, message):
+        ''' Send a message other than a publication. Any pending event
+            is sent first so the order of the messages is kept. '''
+        if self.coalesce_window is None:
+            self.connection.send_object(message)
+            return
+
+        with self._coalesce_cond:
+            self._flush_pending_events()
+            self.connection.send_object(message)
 
     def close(self, *args, **kargs):
        assert isinstance(self.bin_name, bytes)
        if not self.connection.closed:
-          self.connection.send_object(pack_message(message_type='goodbye', name=self.bin_name))
+          self._send(pack_message(message_type='goodbye', name=self.bin_name, protocol_version=self.connection.protocol_version))
           self.said_goodbye = True
        self.connection.close()
     
@@ -55,71 +228,320 @@ class Publisher(object):
         return message
 
 
+class _DispatchPool(object):
+    ''' Run the callbacks in a pool of worker threads so a slow callback
+        doesn't block the reader of the connection (and, when its socket
+        buffer fills up, the notifier and everyone else).
+
+        Each worker serves its own lane, a bounded queue of events. All the
+        events of a topic go to the same lane so they are dispatched in
+        order, one after the other, while the events of different topics
+        are dispatched in parallel. A callback subscribed to a prefix of
+        several topics can then be called from different workers at the
+        same time.
+
+        When a lane is full the reader waits for room: the backpressure
+        still reaches the notifier but only after the queue filled up.
+        '''
+    def __init__(self, dispatch, workers, queue_len, name):
+        self.dispatch = dispatch
+        self.lanes = [queue.Queue(queue_len) for i in range(workers)]
+
+        self.stats_lock = Lock()
+        self.max_depth = 0
+        self.dispatched = 0
+        self.wait_total = self.wait_max = 0.0
+        self.callback_total = self.callback_max = 0.0
+
+        self.workers = []
+        for lane in self.lanes:
+            worker = threading.Thread(target=self._work, args=(lane,), name="%s-dispatcher-%i" % (name, len(self.workers)))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, topic, obj):
+        # a stable hash (not randomized per process) so a topic always goes
+        # to the same lane
+        lane = self.lanes[(zlib.crc32(to_bytes(topic)) & 0xffffffff) % len(self.lanes)]
+        lane.put((topic, obj, time.time()))
+
+        depth = lane.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth   # a racy max is good enough for a metric
+
+    def _work(self, lane):
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+
+            topic, obj, queued_at = item
+            started_at = time.time()
+            self.dispatch(topic, obj)
+            finished_at = time.time()
+
+            waited, took = started_at - queued_at, finished_at - started_at
+            with self.stats_lock:
+                self.dispatched += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.callback_total += took
+                self.callback_max = max(self.callback_max, took)
+
+    def stats(self):
+        ''' Return the depth of the queues (now and the maximum seen), how
+            many events were dispatched, how long they waited in the queue
+            and how long their callbacks took (mean and max, in seconds). '''
+        with self.stats_lock:
+            dispatched = self.dispatched
+            return {
+                  'workers': len(self.workers),
+                  'depth': sum(lane.qsize() for lane in self.lanes),
+                  'max_depth': self.max_depth,
+                  'dispatched': dispatched,
+                  'wait_mean': (self.wait_total / dispatched) if dispatched else 0.0,
+                  'wait_max': self.wait_max,
+                  'callback_mean': (self.callback_total / dispatched) if dispatched else 0.0,
+                  'callback_max': self.callback_max,
+                  }
+
+    def close(self):
+        ''' Stop the workers once they dispatched the queued events. '''
+        for lane in self.lanes:
+            lane.put(None)
+
+    def join(self, *args, **kargs):
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join(*args, **kargs)
+
+
 class EventHandler(threading.Thread, Publisher):
+    answers_pings = True
     
-    def __init__(self, as_daemon=False, name="(bob-py)", address=("localhost", 5555)):
+    def __init__(self, as_daemon=False, name="(bob-py)", address=("localhost", 5555), coalesce_window=None, protocol_version=ProtocolVersion, serializer="json",
+                       dispatch_workers=None, dispatch_queue_len=1024, sync_timeout=60):
+        ''' Connect to the notifier (see Publisher) and start to receive the
+            events to which we subscribe.
+
+            By default the callbacks are called by the thread that reads
+            the events. If 'dispatch_workers' is a number, that many
+            worker threads call them instead, keeping the order of the
+            events of each topic; up to 'dispatch_queue_len' events can
+            wait for each worker. See _DispatchPool and dispatch_stats.
+
+            The subscriptions wait for the notifier at most 'sync_timeout'
+            seconds (None to wait forever); see _wait_until_synced.
+            '''
         threading.Thread.__init__(self)
         if as_daemon:
            self.daemon = True
 
-        Publisher.__init__(self, name=name, address=address)
+        Publisher.__init__(self, name=name, address=address, coalesce_window=coalesce_window, protocol_version=protocol_version, serializer=serializer)
+
+        self._dispatcher = None
+        if dispatch_workers is not None:
+           if dispatch_workers < 1 or dispatch_queue_len < 1:
+              raise ValueError("The dispatch workers and the length of their queue must be positive numbers (%s and %s)." % (dispatch_workers, dispatch_queue_len))
+
+           self._dispatcher = _DispatchPool(self.dispatch, dispatch_workers, dispatch_queue_len, self.name)
 
         self.lock = Lock()
         self.callbacks_by_topic = {}
+        self.matchers_by_pattern = {}   # the subscribed topics with wildcards (see topic.compile_pattern)
+
+        # the callbacks subscribed with a filter by topic and how many
+        # subscriptions there are by (topic, filter json)
+        self.filtered_callbacks_by_topic = {}
+        self.filtered_subscriptions = {}
       
         self.subscriptions_by_id = {}
         self.next_valid_subscription_id = 0
 
+        # the flags of the threads waiting for a 'synced' message by its cookie
+        self.syncs_by_cookie = {}
+        self.sync_timeout = sync_timeout
+
         self.start()
         
     def __repr__(self):
         return "Endpoint (%s)" % self.name
         
-    def subscribe(self, topic, callback, return_subscription_id=False, send_and_wait_echo=True):
-        topic = to_bytes(topic)
-        if topic not in self._safe_topics:
-            fail_if_topic_isnt_valid(topic, allow_empty=True)
-            if topic: # don't add an empty topic: whitelisting this kind of topics will defeat the publish's check. See this same check in the publish method.
-                self._safe_topics.add(topic) 
+    def subscribe(self, topic, callback, return_subscription_id=False, send_and_wait_echo=True, filter=None):
+        ''' Subscribe the callback to the events of the topic (or of any of
+            its subtopics). The topic can be a pattern (see topic.compile_pattern).
+
+            If 'filter' is given, a dict of fields and conditions (see
+            filters), the callback is called only with the events whose
+            object matches it and the notifier doesn't even send the others
+            (with the version 7 of the protocol or higher; with the older
+            ones the events are filtered here). A filtered topic cannot be a
+            pattern. '''
+        compiled_filter = None
+        if filter is not None:
+           compiled_filter = compile_filter(canonical_filter(filter))
+
+        topic = self._valid_topic_to_subscribe(topic, allow_patterns=compiled_filter is None)
 
-        result = None
         self.lock.acquire()
         try:
-           if topic in self.callbacks_by_topic:
-               self.callbacks_by_topic[topic].append((callback, {'id': self.next_valid_subscription_id}))
+           if compiled_filter is None:
+              subscription_id, is_a_new_topic = self._register_callback(topic, callback)
+
+              message = b""
+              if is_a_new_topic:
+                  message = pack_message(message_type='subscribe', topic=topic, protocol_version=self.connection.protocol_version)
            else:
-               #self._log(syslog.LOG_DEBUG, "Sending subscription to the topic '%s'." % esc(topic))
-               self.connection.send_object(pack_message(message_type='subscribe', topic=topic))
-               #self._log(syslog.LOG_DEBUG, "Subscription sent.")
+              subscription_id, message = self._register_filtered_callback(topic, callback, compiled_filter)
+
+           synced_flag = self._send_with_sync(message, sync=send_and_wait_echo)
+        finally:
+           self.lock.release()
 
-               self.callbacks_by_topic[topic] = [(callback, {'id': self.next_valid_subscription_id})]
+        if send_and_wait_echo:
+           self._wait_until_synced(synced_flag)
 
-           self.subscriptions_by_id[self.next_valid_subscription_id] = {
-                 'callback': callback,
-                 'topic': topic,
-                 }
+        return subscription_id if return_subscription_id else None
 
-           self.next_valid_subscription_id += 1
-           if return_subscription_id:
-              result = self.next_valid_subscription_id - 1;
+    def subscribe_many(self, subscriptions, return_subscription_ids=False, send_and_wait_echo=True):
+        ''' Subscribe each callback to its topic, 'subscriptions' being a
+            sequence of (topic, callback) pairs. All the new topics are sent
+            in a single message and, if 'send_and_wait_echo' is true, we
+            wait for the notifier only once. '''
+        subscriptions = [(self._valid_topic_to_subscribe(topic), callback) for topic, callback in subscriptions]
 
+        subscription_ids = []
+        self.lock.acquire()
+        try:
+           new_topics = []
+           for topic, callback in subscriptions:
+               subscription_id, is_a_new_topic = self._register_callback(topic, callback)
+               subscription_ids.append(subscription_id)
+               if is_a_new_topic:
+                   new_topics.append(topic)
+
+           protocol_version = self.connection.protocol_version
+           if len(new_topics) > 1 and supports_sync(protocol_version):
+               message = pack_message(message_type='subscribe_many', topics=new_topics, protocol_version=protocol_version)
+           else:
+               message = b"".join(pack_message(message_type='subscribe', topic=topic, protocol_version=protocol_version) for topic in new_topics)
+
+           synced_flag = self._send_with_sync(message, sync=send_and_wait_echo)
         finally:
            self.lock.release()
 
         if send_and_wait_echo:
+           self._wait_until_synced(synced_flag)
+
+        return subscription_ids if return_subscription_ids else None
+
+    def _send_with_sync(self, message, sync=True):
+        ''' Send the message followed by a 'sync' message, in a single write,
+            and return the flag to wait for the answer of the notifier (see
+            _wait_until_synced). The caller must hold the lock.
+
+            If the protocol doesn't support the 'sync' message (or if 'sync'
+            is false) send the message alone and return None. '''
+        synced_flag = None
+        if sync and supports_sync(self.connection.protocol_version):
+           cookie = int(random.getrandbits(32))
+           while cookie in self.syncs_by_cookie:
+              cookie = int(random.getrandbits(32))
+
+           synced_flag = threading.Event()
+           self.syncs_by_cookie[cookie] = synced_flag
+
+           message += pack_message(message_type='sync', cookie=cookie, protocol_version=self.connection.protocol_version)
+
+        if message:
+           self._send(message)
+
+        return synced_flag
+
+    def _wait_until_synced(self, synced_flag):
+        ''' Block until the notifier processed all the messages that we
+            sent before. With the version 4 of the protocol it answers our
+            'sync' message (see _send_with_sync); with the older ones we
+            publish an event to ourselves and we wait for it.
+
+            Raise an exception if the notifier didn't answer in
+            'sync_timeout' seconds. '''
+        if synced_flag is None:
            cookie = "echo-%i" % int(random.getrandbits(30))
-         
-           echo_received_flag = Lock()
-           echo_received_flag.acquire()
 
-           self.subscribe_for_once_call(cookie, lambda data: echo_received_flag.release(), send_and_wait_echo=False)
+           synced_flag = threading.Event()
+
+           self.subscribe_for_once_call(cookie, lambda data: synced_flag.set(), send_and_wait_echo=False)
            self.publish(cookie, '')
 
-           echo_received_flag.acquire()
+        if not synced_flag.wait(self.sync_timeout):
+           self.lock.acquire()
+           try:
+              for cookie, flag in list(self.syncs_by_cookie.items()):
+                 if flag is synced_flag:
+                    del self.syncs_by_cookie[cookie]
+           finally:
+              self.lock.release()
+
+           raise Exception("The notifier didn't answer in %s seconds." % self.sync_timeout)
 
-        return result
+    def _valid_topic_to_subscribe(self, topic, allow_patterns=True):
+        topic = to_bytes(topic)
+        self._safe_topics.validate(topic, allow_empty=True, allow_patterns=allow_patterns)
+        return topic
+
+    def _register_callback(self, topic, callback):
+        # the caller must hold the lock
+        is_a_new_topic = topic not in self.callbacks_by_topic
+        if is_a_new_topic:
+            self.callbacks_by_topic[topic] = [(callback, {'id': self.next_valid_subscription_id})]
+            if is_pattern(topic):
+                self.matchers_by_pattern[topic] = compile_pattern(topic)
+        else:
+            self.callbacks_by_topic[topic].append((callback, {'id': self.next_valid_subscription_id}))
+
+        self.subscriptions_by_id[self.next_valid_subscription_id] = {
+              'callback': callback,
+              'topic': topic,
+              }
+
+        self.next_valid_subscription_id += 1
+        return self.next_valid_subscription_id - 1, is_a_new_topic
+
+    def _register_filtered_callback(self, topic, callback, compiled_filter):
+        # the caller must hold the lock; return the subscription id and the
+        # message to send (empty if the topic was already subscribed with
+        # the same filter)
+        meta = {'id': self.next_valid_subscription_id, 'filter': compiled_filter}
+        self.filtered_callbacks_by_topic.setdefault(topic, []).append((callback, meta))
+
+        self.subscriptions_by_id[self.next_valid_subscription_id] = {
+              'callback': callback,
+              'topic': topic,
+              'filter': compiled_filter.raw,
+              }
+
+        key = (topic, compiled_filter.raw)
+        count = self.filtered_subscriptions.get(key, 0)
+        self.filtered_subscriptions[key] = count + 1
+
+        message = b""
+        if not count:
+            message = self._pack_filtered_subscription('subscribe', topic, compiled_filter.raw)
+
+        self.next_valid_subscription_id += 1
+        return self.next_valid_subscription_id - 1, message
+
+    def _pack_filtered_subscription(self, message_type, topic, filter_raw):
+        # the notifiers of the version 6 of the protocol or older don't know
+        # about filters: they send all the events and they are filtered here
+        protocol_version = self.connection.protocol_version
+        if supports_filters(protocol_version):
+            return pack_message(message_type=message_type + '_filtered', topic=topic, filter_raw=filter_raw, protocol_version=protocol_version)
+
+        return pack_message(message_type=message_type, topic=topic, protocol_version=protocol_version)
 
-   
     def unsubscribe(self, subscription_id):
         self.lock.acquire()
         try:
@@ -153,6 +575,10 @@ class EventHandler(threading.Thread, Publisher):
         topic = subscription['topic']
         callbackToBeRemoved = subscription['callback']
 
+        if 'filter' in subscription:
+           self._unsubscribe_filtered(subscription_id, topic, subscription['filter'])
+           return
+
         for i, callback_and_meta in enumerate(self.callbacks_by_topic[topic]):
            callback, meta = callback_and_meta
            if callback == callbackToBeRemoved and meta['id'] == subscription_id:
@@ -161,10 +587,24 @@ class EventHandler(threading.Thread, Publisher):
 
         if not self.callbacks_by_topic[topic]:
            del self.callbacks_by_topic[topic]
-           self.connection.send_object(pack_message(message_type='unsubscribe', topic=topic))
+           self.matchers_by_pattern.pop(topic, None)
+           self._send(pack_message(message_type='unsubscribe', topic=topic, protocol_version=self.connection.protocol_version))
         
         del self.subscriptions_by_id[subscription_id]
 
+    def _unsubscribe_filtered(self, subscription_id, topic, filter_raw):
+        callbacks = self.filtered_callbacks_by_topic[topic]
+        callbacks[:] = [(callback, meta) for callback, meta in callbacks if meta['id'] != subscription_id]
+        if not callbacks:
+           del self.filtered_callbacks_by_topic[topic]
+
+        key = (topic, filter_raw)
+        self.filtered_subscriptions[key] -= 1
+        if not self.filtered_subscriptions[key]:
+           del self.filtered_subscriptions[key]
+           self._send(self._pack_filtered_subscription('unsubscribe', topic, filter_raw))
+
+        del self.subscriptions_by_id[subscription_id]
 
     def subscribe_for_once_call(self, topic, callback, **kargs):
        topic = to_bytes(topic)
@@ -202,16 +642,50 @@ class EventHandler(threading.Thread, Publisher):
        return subscription['id'] if return_subscription_id else None
 
     def run(self):
+        dispatch = self._dispatcher.submit if self._dispatcher else self.dispatch
         try:
            while not self.connection.end_of_the_communication:
+               began = tracing.begin() if tracing.active else None
                message_type, message_body = self.connection.receive_object()
+               if began is not None:
+                   tracing.end("client.receive", began)
+
+               content_typed = is_content_typed(self.connection.protocol_version)
+
+               if message_type == "publish_batch":
+                   began = tracing.begin() if tracing.active else None
+                   events = unpack_message_body(message_type, message_body, dont_unpack_object=False, content_typed=content_typed)
+                   if began is not None:
+                       tracing.end("client.unpack", began)
+
+                   for topic, obj in events:
+                       began = tracing.begin() if tracing.active else None
+                       dispatch(topic, obj)
+                       if began is not None:
+                           tracing.end("client.dispatch", began)
+                   continue
+
+               if message_type == "synced":
+                   self._release_synced(unpack_message_body(message_type, message_body))
+                   continue
+
+               if message_type == "ping":
+                   self._send(pack_message(message_type='pong', cookie=unpack_message_body(message_type, message_body), protocol_version=self.connection.protocol_version))
+                   continue
                
                if message_type != "publish":
                    self._log(syslog.LOG_ERR, "Unexpected message of type '%s' (expecting a 'publish' message). Dropping the message and moving on." % esc(message_type))
                    continue
 
-               topic, obj = unpack_message_body(message_type, message_body, dont_unpack_object=False)
-               self.dispatch(topic, obj)
+               began = tracing.begin() if tracing.active else None
+               topic, obj = unpack_message_body(message_type, message_body, dont_unpack_object=False, content_typed=content_typed)
+               if began is not None:
+                   tracing.end("client.unpack", began)
+
+               began = tracing.begin() if tracing.active else None
+               dispatch(topic, obj)
+               if began is not None:
+                   tracing.end("client.dispatch", began)
 
 
         except Exception as ex:
@@ -222,6 +696,26 @@ class EventHandler(threading.Thread, Publisher):
               self._log(syslog.LOG_ERR, "Exception when receiving a message: %s." % esc(traceback.format_exc()))
         finally:
            self.connection.close()
+           if self._dispatcher:
+              self._dispatcher.close()
+
+    def _release_synced(self, cookie):
+        self.lock.acquire()
+        try:
+           synced_flag = self.syncs_by_cookie.pop(cookie, None)
+        finally:
+           self.lock.release()
+
+        if synced_flag is None:
+           self._log(syslog.LOG_ERR, "Unexpected 'synced' message with the cookie %i. Dropping the message and moving on." % esc(cookie))
+           return
+
+        synced_flag.set()
+
+    def dispatch_stats(self):
+        ''' Return the metrics of the dispatch workers (see _DispatchPool.stats)
+            or None if the callbacks are called by the reader thread. '''
+        return self._dispatcher.stats() if self._dispatcher else None
 
     def dispatch(self, topic, obj):
         assert isinstance(topic, bytes)
@@ -233,6 +727,18 @@ class EventHandler(threading.Thread, Publisher):
            for t in topic_chain:
                callbacks = self.callbacks_by_topic.get(t, []);
                callbacks_collected.append(list(callbacks)) # get a copy!
+
+           # then the callbacks of the patterns that match the topic
+           for pattern, matches in self.matchers_by_pattern.items():
+               if matches(topic):
+                   callbacks_collected.append(list(self.callbacks_by_topic[pattern]))
+
+           # and the filtered ones: the notifier sends an event if it matches
+           # any of our filters of the topic so each one is checked again
+           filtered_callbacks = []
+           if self.filtered_callbacks_by_topic:
+               for t in topic_chain:
+                   filtered_callbacks.extend(self.filtered_callbacks_by_topic.get(t, ()))
         finally:
            self.lock.release()
          
@@ -240,6 +746,10 @@ class EventHandler(threading.Thread, Publisher):
             for callback, subscription in callbacks:
                 self._execute_callback(callback, obj, t) #TODO what is 't'?
 
+        for callback, subscription in filtered_callbacks:
+            if subscription['filter'].matches(obj):
+                self._execute_callback(callback, obj, t)
+
     def _execute_callback(self, callback, data, t):
        try:
           callback(data)
@@ -250,4 +760,6 @@ class EventHandler(threading.Thread, Publisher):
     def close(self, *args, **kargs):
        Publisher.close(self)
        self.join(*args,  **kargs)
+       if self._dispatcher:
+          self._dispatcher.join(*args, **kargs)
 
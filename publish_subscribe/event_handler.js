@@ -4,16 +4,50 @@ define(['message'], function (message) {
    var pack_message = message.pack_message;
    var unpack_message_header = message.unpack_message_header;
    var unpack_message_body = message.unpack_message_body;
+   var is_content_typed = message.is_content_typed;
+
+   // the subscriptions can have wildcards, each one a whole subtopic: '*'
+   // matches exactly one subtopic and '#' any number of them, none included.
+   // Like a subscription to a topic, a pattern matches the topics that begin
+   // with a match (see topic.py)
+   var is_pattern = function (topic) {
+      return topic.indexOf('*') !== -1 || topic.indexOf('#') !== -1;
+   };
+
+   var compile_pattern = function (pattern) {
+      var parts = pattern.split('.').map(function (subtopic) {
+         if (subtopic === '*') {
+            return '\\.[^.]+';
+         }
+         if (subtopic === '#') {
+            return '(?:\\.[^.]+)*';
+         }
+         return '\\.' + subtopic.replace(/[.*+?^${}()|[\]\\]/g, '\\$&');
+      });
+
+      // each subtopic is matched with its leading dot, so is the topic
+      var regex = new RegExp('^' + parts.join('') + '(?:\\.|$)');
+      return function (topic) {
+         return regex.test('.' + topic);
+      };
+   };
 
    // TODO extract the constants an put them in a external file
    // TODO wrap the errors into Error objects
    function EventHandler() {
       this.callbacks_by_topic = {};
+      this.matchers_by_pattern = {}; // the subscribed topics with wildcards
       this.max_buf_length = 1024 * 1024;
       this.log_to_console = false;
 
       this.subscriptions_by_id = {};
       this.next_valid_subscription_id = 0;
+
+      // the published objects are serialized with this serializer,
+      // 'json' or 'msgpack' (see message.js)
+      this.serializer = 'json';
+      this.protocol_version = 1;
+      this.pending_messages = null;
    }
    
    EventHandler.prototype.init = function (name) {
@@ -36,6 +70,11 @@ define(['message'], function (message) {
       var attempts = 0;
       var that = this;
 
+      // the messages are held until the notifier tells us which version
+      // of the protocol we must use
+      this.protocol_version = 1;
+      this.pending_messages = [];
+
       this.socket.on('error', function (err) {
          if (is_connected) {
             throw new Error(err);
@@ -53,19 +92,43 @@ define(['message'], function (message) {
 
       this.socket.on('connect', function () {
          is_connected = true;
-         that.socket.write(pack_message('introduce_myself', {name: name}));
+         that.socket.write(pack_message('hello', {name: name, max_protocol_version: message.ProtocolVersion}));
          that.init_dispacher();
       });
 
       this.socket.connect(5555, '');
    };
 
+   EventHandler.prototype._send = function (message_type, params) {
+      if (this.pending_messages !== null) {
+         this.pending_messages.push({message_type: message_type, params: params});
+         return;
+      }
+
+      if (message_type === 'publish' || message_type === 'publish_batch') {
+         params.serializer = is_content_typed(this.protocol_version) ? this.serializer : null;
+      }
+
+      this.socket.write(pack_message(message_type, params, this.protocol_version));
+   };
+
+   EventHandler.prototype._welcomed = function (protocol_version) {
+      this.protocol_version = protocol_version;
+
+      var pending_messages = this.pending_messages;
+      this.pending_messages = null;
+
+      for (var i = 0; i < pending_messages.length; i++) {
+         this._send(pending_messages[i].message_type, pending_messages[i].params);
+      }
+   };
+
    EventHandler.prototype.shutdown = function () {
       if(!this.socket) {
          return;
       }
 
-      this.socket.write(pack_message('goodbye', {name: name}));
+      this._send('goodbye', {name: this.name});
 
       this.socket.end();
       this.socket = null;
@@ -80,7 +143,19 @@ define(['message'], function (message) {
          throw "The topic must not be empty";
       }
 
-      this.socket.write(pack_message('publish', {topic: topic, obj: data}));
+      this._send('publish', {topic: topic, obj: data});
+   };
+
+   EventHandler.prototype.publish_many = function (events) {
+      // events is an array of {topic: ..., obj: ...}, all of them are sent
+      // in a single 'publish_batch' message
+      for (var i = 0; i < events.length; i++) {
+         if(!events[i].topic) {
+            throw "The topic must not be empty";
+         }
+      }
+
+      this._send('publish_batch', {events: events});
    };
 
    EventHandler.prototype.subscribe = function (topic, callback) {
@@ -88,7 +163,10 @@ define(['message'], function (message) {
       var callbacks = this.callbacks_by_topic[topic];
       if(!callbacks) {
          this.callbacks_by_topic[topic] = [callback];
-         this.socket.write(pack_message('subscribe', {topic: topic}));
+         if(is_pattern(topic)) {
+            this.matchers_by_pattern[topic] = compile_pattern(topic);
+         }
+         this._send('subscribe', {topic: topic});
       }
       else {
          this.callbacks_by_topic[topic].push(callback);
@@ -127,7 +205,8 @@ define(['message'], function (message) {
       // remove the topic if there isn't any callback
       if (this.callbacks_by_topic[topic].length === 0) {
          delete this.callbacks_by_topic[topic];
-         this.socket.write(pack_message('unsubscribe', {topic: topic}));
+         delete this.matchers_by_pattern[topic];
+         this._send('unsubscribe', {topic: topic});
       }
 
       // remove the subscription
@@ -169,11 +248,12 @@ define(['message'], function (message) {
          }
 
          if (is_waiting_the_header) {
-            if (previous_chunk.length >= 3) {
-                var header = previous_chunk.slice(0, 3);
-                previous_chunk = previous_chunk.slice(3);
+            var header_len = message.HeaderLenByVersion[self.protocol_version];
+            if (previous_chunk.length >= header_len) {
+                var header = previous_chunk.slice(0, header_len);
+                previous_chunk = previous_chunk.slice(header_len);
 
-                var r = unpack_message_header(header);
+                var r = unpack_message_header(header, self.protocol_version);
                 message_type = r.message_type;
                 message_body_len = r.message_body_len;
 
@@ -189,12 +269,26 @@ define(['message'], function (message) {
                 var message_body = previous_chunk.slice(0, message_body_len);
                 previous_chunk = previous_chunk.slice(message_body_len);
 
-                if (message_type !== 'publish') {
+                var content_typed = is_content_typed(self.protocol_version);
+                if (message_type === 'welcome') {
+                    is_waiting_the_header = true;
+                    self._welcomed(unpack_message_body(message_type, message_body));
+                }
+                else if (message_type === 'publish_batch') {
+                    var events = unpack_message_body(message_type, message_body, content_typed);
+
+                    is_waiting_the_header = true;
+                    for (var i = 0; i < events.length; i++) {
+                        self.dispatch(events[i].topic, events[i].obj);
+                    }
+                }
+                else if (message_type !== 'publish') {
                     console.warn("Unexpected message of type '"+message_type+"' (expecting a 'publish' message). Dropping the message and moving on.");
+                    is_waiting_the_header = true;
                     // continue, move on
                 }
                 else {
-                    var r = unpack_message_body(message_type, message_body);
+                    var r = unpack_message_body(message_type, message_body, content_typed);
                     var topic = r.topic;
                     var obj = r.obj;
                     
@@ -261,6 +355,23 @@ define(['message'], function (message) {
             }
          }
       }
+
+      // then the callbacks of the patterns that match the topic
+      for(var pattern in this.matchers_by_pattern) {
+         if(!this.matchers_by_pattern[pattern](topic)) {
+            continue;
+         }
+
+         var pattern_callbacks = (this.callbacks_by_topic[pattern] || []).slice();
+         for(var k = 0; k < pattern_callbacks.length; k++) {
+            try {
+               pattern_callbacks[k](data, topic);
+            }
+            catch (e) {
+               console.warn("Error in callback (pattern: "+pattern+"): " + e + "\n" + e.stack);
+            }
+         }
+      }
    };
    
    EventHandler.prototype.toString = function(){
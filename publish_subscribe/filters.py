@@ -0,0 +1,178 @@
+''' Content filters of the subscriptions.
+
+    A subscription can carry a filter so the notifier sends only the events
+    whose object matches it. A filter is a dict that maps fields of the
+    object to conditions, all of them must hold:
+
+        {"thread-id": 3}                            equality
+        {"bkpt.number": {">=": 2, "<": 10}}         range
+        {"reason": {"in": ["breakpoint-hit", "signal-received"]}}
+
+    A field is a path of keys separated by dots; a key made of digits
+    indexes a list too ("frames.0.line"). A condition is a value (equality)
+    or a dict of operators: ==, !=, <, <=, >, >= and in. To compare with a
+    dict use the operator == explicitly.
+
+    A missing field never matches (not even with !=) and the ranges compare
+    only numbers with numbers and strings with strings. The booleans are
+    not numbers: true is not equal to 1.
+
+    The filters travel in the wire as canonical json (see canonical_filter)
+    so the same filter is compiled once and shared by all its subscribers
+    (see FiltersCache).
+    '''
+import json
+from .esc import esc, to_bytes, to_text
+
+try:
+   _number_t = (int, long, float)
+   _text_t = (unicode, str)
+except NameError:
+   _number_t = (int, float)
+   _text_t = (str,)
+
+_Missing = object()
+
+def _equal(a, b):
+   if isinstance(a, bool) != isinstance(b, bool):
+      return False
+
+   return a == b
+
+def _comparable(a, b):
+   if isinstance(a, bool) or isinstance(b, bool):
+      return False
+
+   return (isinstance(a, _number_t) and isinstance(b, _number_t)) or (isinstance(a, _text_t) and isinstance(b, _text_t))
+
+_Operators = {
+      "==": _equal,
+      "!=": lambda a, b: not _equal(a, b),
+      "<":  lambda a, b: _comparable(a, b) and a < b,
+      "<=": lambda a, b: _comparable(a, b) and a <= b,
+      ">":  lambda a, b: _comparable(a, b) and a > b,
+      ">=": lambda a, b: _comparable(a, b) and a >= b,
+      "in": lambda a, b: any(_equal(a, value) for value in b),
+      }
+
+def _getter_of(field):
+   keys = field.split(".")
+   if not all(keys):
+      raise Exception("The field '%s' of the filter is not valid: its keys cannot be empty." % esc(field))
+
+   def get(obj):
+      for key in keys:
+         if isinstance(obj, dict):
+            obj = obj.get(key, _Missing)
+         elif isinstance(obj, list) and key.isdigit() and int(key) < len(obj):
+            obj = obj[int(key)]
+         else:
+            return _Missing
+
+         if obj is _Missing:
+            return _Missing
+
+      return obj
+
+   return get
+
+def _conditions_of(spec):
+   if not isinstance(spec, dict) or not spec:
+      raise Exception("The filter must be a non empty dict of fields and conditions, not '%s'." % esc(repr(spec)))
+
+   conditions = []
+   for field, condition in sorted(spec.items()):
+      get = _getter_of(field)
+      if not isinstance(condition, dict):
+         condition = {"==": condition}
+
+      for operator, value in sorted(condition.items()):
+         if operator not in _Operators:
+            raise Exception("Unknown operator '%s' in the condition of the field '%s' of the filter." % esc(operator, field))
+
+         if operator == "in" and not isinstance(value, list):
+            raise Exception("The operator 'in' of the field '%s' of the filter requires a list." % esc(field))
+
+         conditions.append((get, _Operators[operator], value))
+
+   return conditions
+
+
+class Filter(object):
+   ''' A compiled filter. 'raw' is its canonical json. '''
+   __slots__ = ("raw", "conditions")
+
+   def __init__(self, raw, spec):
+      self.raw = raw
+      self.conditions = _conditions_of(spec)
+
+   def matches(self, obj):
+      for get, test, value in self.conditions:
+         field = get(obj)
+         if field is _Missing or not test(field, value):
+            return False
+
+      return True
+
+   def __repr__(self):
+      return to_text(self.raw)
+
+def canonical_filter(spec):
+   ''' Validate the filter and return it as canonical json (bytes): the
+       equivalent filters are equal byte by byte. '''
+   _conditions_of(spec)
+   return to_bytes(json.dumps(spec, sort_keys=True, separators=(",", ":")))
+
+def compile_filter(raw):
+   ''' Compile the filter from its json (see canonical_filter). Raise an
+       exception if it is not valid. '''
+   try:
+      spec = json.loads(to_text(raw))
+   except ValueError:
+      raise Exception("The filter '%s' is not valid json." % esc(raw))
+
+   return Filter(raw, spec)
+
+
+class FiltersCache(object):
+   ''' The compiled filters by their json so each distinct filter is
+       compiled once and its subscribers share it: the notifier evaluates
+       it once per event no matter how many subscribers have it.
+
+       Like the ValidTopicsCache, it holds at most 'max_len' filters and
+       when it is full it starts over.
+       '''
+   def __init__(self, max_len=1024):
+      self.max_len = max_len
+      self.filters = {}
+      self.hits = self.misses = self.resets = 0
+
+   def compile(self, raw):
+      try:
+         compiled = self.filters[raw]
+         self.hits += 1
+         return compiled
+      except KeyError:
+         pass
+
+      self.misses += 1
+      compiled = compile_filter(raw)
+
+      if len(self.filters) >= self.max_len:
+         self.filters.clear()
+         self.resets += 1
+
+      self.filters[raw] = compiled
+      return compiled
+
+   def __len__(self):
+      return len(self.filters)
+
+   def stats(self):
+      return {
+            'len': len(self.filters),
+            'max_len': self.max_len,
+            'hits': self.hits,
+            'misses': self.misses,
+            'resets': self.resets,
+            }
@@ -3,6 +3,299 @@ define(function () {
 
     var ByteMax  = 0x000000ff;
     var ShortMax = 0x0000ffff;
+    var IntMax   = 0xffffffff;
+
+    // See message.py: the version 2 frames the messages with a 32 bits
+    // length and the version 3 prefixes each object with its content type.
+    var ProtocolVersion = 3;
+    var HeaderLenByVersion = {1: 3, 2: 5, 3: 5};
+    var MessageMaxLenByVersion = {1: ShortMax, 2: IntMax, 3: IntMax};
+
+    function is_content_typed(protocol_version) {
+        return protocol_version >= 3;
+    }
+
+
+    // Compact binary serializer, the same subset of MessagePack that
+    // serializers.py implements.
+    function msgpack_pack_length(parts, length, fix_op, fix_max, op8, op16, op32) {
+        var header;
+        if (length <= fix_max) {
+            header = new Buffer([fix_op | length]);
+        }
+        else if (op8 !== null && length <= ByteMax) {
+            header = new Buffer([op8, length]);
+        }
+        else if (length <= ShortMax) {
+            header = new Buffer(3);
+            header.writeUInt8(op16);
+            header.writeUInt16BE(length, 1);
+        }
+        else {
+            header = new Buffer(5);
+            header.writeUInt8(op32);
+            header.writeUInt32BE(length, 1);
+        }
+
+        parts.push(header);
+    }
+
+    function msgpack_pack_number(parts, obj) {
+        var raw;
+        if (obj % 1 !== 0 || !isFinite(obj) || obj < -0x80000000 || obj > 9007199254740991) {
+            raw = new Buffer(9);
+            raw.writeUInt8(0xcb);
+            raw.writeDoubleBE(obj, 1);
+        }
+        else if (0 <= obj && obj <= 0x7f) {
+            raw = new Buffer([obj]);
+        }
+        else if (-32 <= obj && obj < 0) {
+            raw = new Buffer([obj & 0xff]);
+        }
+        else if (0 <= obj && obj <= ByteMax) {
+            raw = new Buffer([0xcc, obj]);
+        }
+        else if (0 <= obj && obj <= ShortMax) {
+            raw = new Buffer(3);
+            raw.writeUInt8(0xcd);
+            raw.writeUInt16BE(obj, 1);
+        }
+        else if (0 <= obj && obj <= IntMax) {
+            raw = new Buffer(5);
+            raw.writeUInt8(0xce);
+            raw.writeUInt32BE(obj, 1);
+        }
+        else if (0 <= obj) {
+            raw = new Buffer(9);
+            raw.writeUInt8(0xcf);
+            raw.writeUInt32BE(Math.floor(obj / 0x100000000), 1);
+            raw.writeUInt32BE(obj % 0x100000000, 5);
+        }
+        else if (-0x80 <= obj) {
+            raw = new Buffer(2);
+            raw.writeUInt8(0xd0);
+            raw.writeInt8(obj, 1);
+        }
+        else if (-0x8000 <= obj) {
+            raw = new Buffer(3);
+            raw.writeUInt8(0xd1);
+            raw.writeInt16BE(obj, 1);
+        }
+        else {
+            raw = new Buffer(5);
+            raw.writeUInt8(0xd2);
+            raw.writeInt32BE(obj, 1);
+        }
+
+        parts.push(raw);
+    }
+
+    function msgpack_pack_obj(parts, obj) {
+        if (obj === null || obj === undefined) {
+            parts.push(new Buffer([0xc0]));
+        }
+        else if (obj === true || obj === false) {
+            parts.push(new Buffer([obj ? 0xc3 : 0xc2]));
+        }
+        else if (typeof obj === 'number') {
+            msgpack_pack_number(parts, obj);
+        }
+        else if (typeof obj === 'string') {
+            var raw = new Buffer(obj, 'utf8');
+            msgpack_pack_length(parts, raw.length, 0xa0, 31, 0xd9, 0xda, 0xdb);
+            parts.push(raw);
+        }
+        else if (Buffer.isBuffer(obj)) {
+            msgpack_pack_length(parts, obj.length, 0xc4, -1, 0xc4, 0xc5, 0xc6);
+            parts.push(obj);
+        }
+        else if (Array.isArray(obj)) {
+            msgpack_pack_length(parts, obj.length, 0x90, 15, null, 0xdc, 0xdd);
+            for (var i = 0; i < obj.length; i++) {
+                msgpack_pack_obj(parts, obj[i]);
+            }
+        }
+        else if (typeof obj === 'object') {
+            if (typeof obj.toJSON === 'function') {   // like JSON.stringify does (Date objects for example)
+                return msgpack_pack_obj(parts, obj.toJSON());
+            }
+
+            var keys = Object.keys(obj).filter(function (key) {
+                return obj[key] !== undefined && typeof obj[key] !== 'function';
+            });
+
+            msgpack_pack_length(parts, keys.length, 0x80, 15, null, 0xde, 0xdf);
+            for (var i = 0; i < keys.length; i++) {
+                msgpack_pack_obj(parts, keys[i]);
+                msgpack_pack_obj(parts, obj[keys[i]]);
+            }
+        }
+        else {
+            throw new Error("Object of type '" + typeof obj + "' cannot be serialized.");
+        }
+    }
+
+    function msgpack_dumps(obj) {
+        var parts = [];
+        msgpack_pack_obj(parts, obj);
+        return Buffer.concat(parts);
+    }
+
+    function msgpack_unpack_obj(raw, state) {
+        var op = raw.readUInt8(state.offset);
+        state.offset += 1;
+
+        var length = null;
+        var value;
+
+        if (op <= 0x7f) {
+            return op;
+        }
+        if (op >= 0xe0) {
+            return op - 0x100;
+        }
+        if (0x80 <= op && op <= 0x8f) {
+            return msgpack_unpack_map(raw, state, op & 0x0f);
+        }
+        if (0x90 <= op && op <= 0x9f) {
+            return msgpack_unpack_array(raw, state, op & 0x0f);
+        }
+        if (0xa0 <= op && op <= 0xbf) {
+            length = op & 0x1f;
+            value = raw.toString('utf8', state.offset, state.offset + length);
+            state.offset += length;
+            return value;
+        }
+
+        switch (op) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+
+            case 0xca: value = raw.readFloatBE(state.offset);  state.offset += 4; return value;
+            case 0xcb: value = raw.readDoubleBE(state.offset); state.offset += 8; return value;
+
+            case 0xcc: value = raw.readUInt8(state.offset);    state.offset += 1; return value;
+            case 0xcd: value = raw.readUInt16BE(state.offset); state.offset += 2; return value;
+            case 0xce: value = raw.readUInt32BE(state.offset); state.offset += 4; return value;
+            case 0xcf: value = raw.readUInt32BE(state.offset) * 0x100000000 + raw.readUInt32BE(state.offset + 4);
+                       state.offset += 8; return value;
+
+            case 0xd0: value = raw.readInt8(state.offset);    state.offset += 1; return value;
+            case 0xd1: value = raw.readInt16BE(state.offset); state.offset += 2; return value;
+            case 0xd2: value = raw.readInt32BE(state.offset); state.offset += 4; return value;
+            case 0xd3: value = raw.readInt32BE(state.offset) * 0x100000000 + raw.readUInt32BE(state.offset + 4);
+                       state.offset += 8; return value;
+
+            case 0xc4: case 0xd9:                  length = raw.readUInt8(state.offset);    state.offset += 1; break;
+            case 0xc5: case 0xda: case 0xdc: case 0xde: length = raw.readUInt16BE(state.offset); state.offset += 2; break;
+            case 0xc6: case 0xdb: case 0xdd: case 0xdf: length = raw.readUInt32BE(state.offset); state.offset += 4; break;
+
+            default:
+                throw new Error("Unsupported type " + op + " at " + (state.offset - 1) + ".");
+        }
+
+        if (op <= 0xc6) {
+            value = raw.slice(state.offset, state.offset + length);
+            state.offset += length;
+            return value;
+        }
+        else if (op <= 0xdb) {
+            value = raw.toString('utf8', state.offset, state.offset + length);
+            state.offset += length;
+            return value;
+        }
+        else if (op <= 0xdd) {
+            return msgpack_unpack_array(raw, state, length);
+        }
+        else {
+            return msgpack_unpack_map(raw, state, length);
+        }
+    }
+
+    function msgpack_unpack_array(raw, state, length) {
+        var array = [];
+        for (var i = 0; i < length; i++) {
+            array.push(msgpack_unpack_obj(raw, state));
+        }
+        return array;
+    }
+
+    function msgpack_unpack_map(raw, state, length) {
+        var map = {};
+        for (var i = 0; i < length; i++) {
+            var key = msgpack_unpack_obj(raw, state);
+            map[key] = msgpack_unpack_obj(raw, state);
+        }
+        return map;
+    }
+
+    function msgpack_loads(raw) {
+        var state = {offset: 0};
+        var obj = msgpack_unpack_obj(raw, state);
+
+        if (state.offset !== raw.length) {
+            throw new Error("Extra data after the serialized object (" + (raw.length - state.offset) + " bytes).");
+        }
+        return obj;
+    }
+
+
+    function json_dumps(obj) {
+        try {
+           return new Buffer(JSON.stringify(obj));
+        } catch(e) {
+            throw new Error("Serialization of the object failed (json stringify): " + e);
+        }
+    }
+
+    function json_loads(raw) {
+        try {
+            return JSON.parse(raw);
+        } catch(e) {
+            throw new Error("Deserialization of the object failed (json parse): " + e);
+        }
+    }
+
+    var SerializerByName = {
+        json:    {content_type: 0x1, dumps: json_dumps,    loads: json_loads},
+        msgpack: {content_type: 0x2, dumps: msgpack_dumps, loads: msgpack_loads},
+    };
+
+    var SerializerByContentType = {};
+    Object.keys(SerializerByName).forEach(function (name) {
+        SerializerByContentType[SerializerByName[name].content_type] = SerializerByName[name];
+    });
+
+    // Serialize the object with the given serializer (its name) prefixed
+    // by its content type. Without serializer, the object is serialized as
+    // json without any prefix (protocol version < 3).
+    function pack_object(obj, serializer) {
+        if (!serializer) {
+            return json_dumps(obj);
+        }
+
+        var s = SerializerByName[serializer];
+        if (!s) {
+            throw new Error("Unknown serializer '" + serializer + "'.");
+        }
+
+        return Buffer.concat([new Buffer([s.content_type]), s.dumps(obj)]);
+    }
+
+    function unpack_object(obj_raw, content_typed) {
+        if (!content_typed) {
+            return json_loads(obj_raw);
+        }
+
+        var s = SerializerByContentType[obj_raw.readUInt8()];
+        if (!s) {
+            throw new Error("Unknown content type " + obj_raw.readUInt8() + ".");
+        }
+
+        return s.loads(obj_raw.slice(1));
+    }
 
     function pack_introduce_myself_or_goodbye_msg(params) {
         var name = params.name;
@@ -16,48 +309,109 @@ define(function () {
     }
 
     function unpack_introduce_myself_or_goodbye_msg(raw_buf) {
-        return b.toString();  // the name
+        return raw_buf.toString();  // the name
     }
 
 
-    function pack_publish_msg(params) {
-        var topic = params.topic;
-        var obj   = params.obj;
+    function pack_hello_msg(params) {
+        var name = new Buffer(params.name);
 
-        var topic_length = topic.length;
-        try {
-           var obj_raw = JSON.stringify(obj);
-        } catch(e) {
-            throw new Error("Serialization of the object failed (json stringify): " + e);
+        if ((! (0 <= name.length && name.length <= ByteMax)) ||
+            (! (1 <= params.max_protocol_version && params.max_protocol_version <= ByteMax))) {
+                throw new Error();
+            }
+
+        return Buffer.concat([new Buffer([params.max_protocol_version]), name]);
+    }
+
+    function unpack_hello_msg(raw) {
+        return {name: raw.slice(1).toString(), max_protocol_version: raw.readUInt8()};
+    }
+
+    function pack_welcome_msg(params) {
+        if (! (1 <= params.accepted_protocol_version && params.accepted_protocol_version <= ByteMax)) {
+            throw new Error();
         }
 
-        var obj_lenth = Buffer.byteLength(obj_raw); // return the length in bytes, not in "characters"
+        return new Buffer([params.accepted_protocol_version]);
+    }
 
-        if ((! (0 <= topic_length && topic_length <= ShortMax)) ||
-            (! (0 <= obj_lenth && obj_lenth <= ShortMax))) {
-                throw new Error();
-            }
+    function unpack_welcome_msg(raw) {
+        return raw.readUInt8();  // the accepted protocol version
+    }
 
-        var raw = new Buffer(2 + topic_length + obj_lenth);
-        raw.writeUInt16BE(topic_length);
-        raw.write(topic,   2);
-        raw.write(obj_raw, 2 + topic_length);
 
-        return raw;
+    function pack_publish_msg(params) {
+        var topic = new Buffer(params.topic);
+        var obj_raw = pack_object(params.obj, params.serializer);
+
+        // the length of the object is limited by the length of the whole message
+        if (! (0 <= topic.length && topic.length <= ShortMax)) {
+            throw new Error();
+        }
+
+        var topic_length = new Buffer(2);
+        topic_length.writeUInt16BE(topic.length);
+
+        return Buffer.concat([topic_length, topic, obj_raw]);
     }
 
-    function unpack_publish_msg(raw) {
+    function unpack_publish_msg(raw, content_typed) {
         var topic_length = raw.readUInt16BE();
         var topic   = raw.slice(2, 2+topic_length);
         var obj_raw = raw.slice(2+topic_length);
 
-        try {
-            var obj = JSON.parse(obj_raw);
-        } catch(e) {
-            throw new Error("Deserialization of the object failed (json parse): " + e);
+        return {topic: topic.toString(), obj: unpack_object(obj_raw, content_typed)};
+    }
+
+
+    function pack_publish_batch_msg(params) {
+        var events = params.events;  // array of {topic: ..., obj: ...}
+
+        if (! (0 <= events.length && events.length <= ShortMax)) {
+            throw new Error();
+        }
+
+        var records = [new Buffer(2)];
+        records[0].writeUInt16BE(events.length);
+
+        for (var i = 0; i < events.length; i++) {
+            var topic = new Buffer(events[i].topic);
+            var obj_raw = pack_object(events[i].obj, params.serializer);
+
+            if ((! (0 <= topic.length && topic.length <= ShortMax)) ||
+                (! (0 <= obj_raw.length && obj_raw.length <= IntMax))) {
+                    throw new Error();
+                }
+
+            var record_header = new Buffer(2 + 4);
+            record_header.writeUInt16BE(topic.length);
+            record_header.writeUInt32BE(obj_raw.length, 2);
+
+            records.push(record_header, topic, obj_raw);
+        }
+
+        return Buffer.concat(records);
+    }
+
+    function unpack_publish_batch_msg(raw, content_typed) {
+        var count = raw.readUInt16BE();
+        var offset = 2;
+
+        var events = [];
+        for (var i = 0; i < count; i++) {
+            var topic_length = raw.readUInt16BE(offset);
+            var obj_length = raw.readUInt32BE(offset + 2);
+            offset += 6;
+
+            var topic = raw.slice(offset, offset + topic_length);
+            var obj_raw = raw.slice(offset + topic_length, offset + topic_length + obj_length);
+            offset += topic_length + obj_length;
+
+            events.push({topic: topic.toString(), obj: unpack_object(obj_raw, content_typed)});
         }
 
-        return {topic: topic.toString(), obj: obj};
+        return events;
     }
 
 
@@ -77,7 +431,11 @@ define(function () {
     }
 
 
-    function pack_message(message_type, params) {
+    // The messages are framed as in the version 1 of the protocol unless
+    // other 'protocol_version' is given.
+    function pack_message(message_type, params, protocol_version) {
+        protocol_version = protocol_version || 1;
+
         if (message_type === 'publish') {
             var op = 0x1;
             var message_body = pack_publish_msg(params);
@@ -98,32 +456,53 @@ define(function () {
             var op  = 0x5;
             var message_body = pack_introduce_myself_or_goodbye_msg(params);
         }
+        else if (message_type === 'publish_batch') {
+            var op  = 0x6;
+            var message_body = pack_publish_batch_msg(params);
+        }
+        else if (message_type === 'hello') {
+            var op  = 0x7;
+            var message_body = pack_hello_msg(params);
+        }
+        else if (message_type === 'welcome') {
+            var op  = 0x8;
+            var message_body = pack_welcome_msg(params);
+        }
         else {
             throw new Error();
         }
 
         var message_body_len = message_body.length;
+        var header_len = HeaderLenByVersion[protocol_version];
 
-        var msg = new Buffer(1 + 2 + message_body_len);
-        msg.writeUInt8(op);
-        msg.writeUInt16BE(message_body_len, 1);
-        msg.write(message_body.toString(), 1+2);
+        if (header_len + message_body_len > MessageMaxLenByVersion[protocol_version]) {
+            throw new Error("The message of " + (header_len + message_body_len) + " bytes is too large for the version " + protocol_version + " of the protocol.");
+        }
 
-        if (msg.length > ShortMax) {
-            throw new Error();
+        var msg = new Buffer(header_len + message_body_len);
+        msg.writeUInt8(op);
+        if (header_len === 3) {
+            msg.writeUInt16BE(message_body_len, 1);
+        }
+        else {
+            msg.writeUInt32BE(message_body_len, 1);
         }
+        message_body.copy(msg, header_len);  // copy the bytes: the body may not be valid utf-8 text
 
         return msg;
     }
 
 
-    function unpack_message_header(raw) {
-        if (raw.length !== 3) {
+    function unpack_message_header(raw, protocol_version) {
+        protocol_version = protocol_version || 1;
+        var header_len = HeaderLenByVersion[protocol_version];
+
+        if (raw.length !== header_len) {
             throw new Error();
         }
 
         var op = raw.readUInt8();
-        var message_body_len = raw.readUInt16BE(1);
+        var message_body_len = (header_len === 3) ? raw.readUInt16BE(1) : raw.readUInt32BE(1);
 
         var message_type = {
             0x1: "publish",
@@ -131,6 +510,9 @@ define(function () {
             0x3: "introduce_myself",
             0x4: "unsubscribe",
             0x5: "goodbye",
+            0x6: "publish_batch",
+            0x7: "hello",
+            0x8: "welcome",
             }[op];
 
         if (!message_type) {
@@ -141,9 +523,9 @@ define(function () {
     }
 
 
-    function unpack_message_body(message_type, message_body) {
+    function unpack_message_body(message_type, message_body, content_typed) {
         if (message_type === 'publish') {
-            return unpack_publish_msg(message_body);
+            return unpack_publish_msg(message_body, content_typed);
         }
         else if (message_type === 'subscribe') {
             return unpack_subscribe_unsubscribe_msg(message_body);
@@ -157,12 +539,26 @@ define(function () {
         else if (message_type === 'goodbye') {
             return unpack_introduce_myself_or_goodbye_msg(message_body);
         }
+        else if (message_type === 'publish_batch') {
+            return unpack_publish_batch_msg(message_body, content_typed);
+        }
+        else if (message_type === 'hello') {
+            return unpack_hello_msg(message_body);
+        }
+        else if (message_type === 'welcome') {
+            return unpack_welcome_msg(message_body);
+        }
         else {
             throw new Error();
         }
     }
 
     return {
+        ProtocolVersion: ProtocolVersion,
+        HeaderLenByVersion: HeaderLenByVersion,
+        is_content_typed: is_content_typed,
+        pack_object: pack_object,
+        unpack_object: unpack_object,
         pack_message: pack_message,
         unpack_message_header: unpack_message_header,
         unpack_message_body: unpack_message_body,
@@ -5,9 +5,74 @@ except ImportError:
     import json
 
 from .esc import to_bytes, to_text
+from .serializers import serializer_by_name, serializer_by_content_type
 
 ByteMax  =  (2**8)-1
 ShortMax = (2**16)-1
+IntMax   = (2**32)-1
+
+# The version 1 of the protocol frames each message with a 3 bytes header:
+# the op and a 16 bits length. The version 2 uses a 32 bits length so the
+# messages are not limited to 64 KiB.
+# The version 3 is framed as the 2 but each published object is prefixed
+# by a content type byte that tells how it was serialized (see serializers);
+# in the previous versions the objects are always json.
+# The version 4 adds the 'sync' message, answered by the notifier with a
+# 'synced' message once it processed everything received before, and the
+# 'subscribe_many' message.
+# The version 5 adds the keepalive: the notifier sends a 'ping' to the idle
+# endpoints and they must answer it with a 'pong' (the notifier answers
+# the pings of the endpoints too).
+# The version 6 adds the 'bridge' message: a notifier connected to another
+# tells it that the connection is a bridge between both (see the bridges
+# of the notifier) and not a regular endpoint.
+# The version 7 adds the 'subscribe_filtered' and 'unsubscribe_filtered'
+# messages: a subscription with a filter over the content of the events
+# (see filters).
+# The version 8 adds the 'publish_retained' message: a 'publish' whose event
+# the notifier keeps for the endpoints that subscribe later (see retained).
+# The version 9 answers the 'bridge' message with another 'bridge' message
+# so both ends of a bridge know the id of the other one (see the bridges of
+# the notifier).
+# The version 10 adds the 'no_pings' message: an endpoint that never reads its
+# connection (a Publisher) tells the notifier not to ping it, so it can use
+# the later versions too.
+# The version is negotiated with the 'hello' and 'welcome' messages which
+# are always framed as in the version 1.
+ProtocolVersion = 10
+
+HeaderFormatByVersion = {1: ">BH", 2: ">BI", 3: ">BI", 4: ">BI", 5: ">BI", 6: ">BI", 7: ">BI", 8: ">BI", 9: ">BI", 10: ">BI"}
+HeaderLenByVersion    = {1: 3,     2: 5,     3: 5,     4: 5,     5: 5,     6: 5,     7: 5,     8: 5,     9: 5,     10: 5}
+MessageMaxLenByVersion = {1: ShortMax, 2: IntMax, 3: IntMax, 4: IntMax, 5: IntMax, 6: IntMax, 7: IntMax, 8: IntMax, 9: IntMax, 10: IntMax}
+
+def is_content_typed(protocol_version):
+    return protocol_version >= 3
+
+def supports_sync(protocol_version):
+    return protocol_version >= 4
+
+def supports_keepalive(protocol_version):
+    return protocol_version >= 5
+
+def supports_bridges(protocol_version):
+    return protocol_version >= 6
+
+def supports_filters(protocol_version):
+    return protocol_version >= 7
+
+def supports_retained(protocol_version):
+    return protocol_version >= 8
+
+def supports_bridge_ids(protocol_version):
+    return protocol_version >= 9
+
+def supports_no_pings(protocol_version):
+    return protocol_version >= 10
+
+class MessageTooLarge(Exception):
+    def __init__(self, message_len, protocol_version):
+        Exception.__init__(self, "The message of %i bytes is too large for the version %i of the protocol (max %i bytes)." % (
+                                       message_len, protocol_version, MessageMaxLenByVersion[protocol_version]))
 
 def pack_introduce_myself_or_goodbye_msg(name):
     assert isinstance(name, bytes)
@@ -20,41 +85,203 @@ def pack_introduce_myself_or_goodbye_msg(name):
     return raw
 
 def unpack_introduce_myself_or_goodbye_msg(raw):
-    return raw  # the name
+    return bytes(raw)  # the name
 
 
+def pack_hello_msg(name, max_protocol_version):
+    assert isinstance(name, bytes)
+    name_length = len(name)
+
+    if not (0 <= name_length <= ByteMax) or not (1 <= max_protocol_version <= ByteMax):
+        raise Exception()
+
+    raw = struct.pack(">B", max_protocol_version) + name
+    return raw
+
+def unpack_hello_msg(raw):
+    max_protocol_version, = struct.unpack(">B", bytes(raw[:1]))
+    name = bytes(raw[1:])
+    return name, max_protocol_version
+
+def pack_welcome_msg(accepted_protocol_version):
+    if not (1 <= accepted_protocol_version <= ByteMax):
+        raise Exception()
+
+    raw = struct.pack(">B", accepted_protocol_version)
+    return raw
+
+def unpack_welcome_msg(raw):
+    accepted_protocol_version, = struct.unpack(">B", bytes(raw[:1]))
+    return accepted_protocol_version
+
+
+
+def pack_object(obj, serializer=None):
+    ''' Serialize the object with the given serializer (its name) and
+        prefix it with its content type. Without a serializer, the object
+        is serialized as json without any prefix (protocol version < 3). '''
+    if serializer is None:
+        return to_bytes(json.dumps(obj))
 
-def pack_publish_msg(topic, obj, dont_pack_object):
+    serializer = serializer_by_name(serializer)
+    return struct.pack(">B", serializer.content_type) + serializer.dumps(obj)
+
+def unpack_object(obj_raw, content_typed=False):
+    if not content_typed:
+        return json.loads(to_text(obj_raw))
+
+    content_type, = struct.unpack(">B", bytes(obj_raw[:1]))
+    return serializer_by_content_type(content_type).loads(obj_raw[1:])
+
+JSONContentTypePrefix = struct.pack(">B", serializer_by_name("json").content_type)
+
+def to_content_typed_object(obj_raw):
+    ''' Prefix a json object packed without content type. '''
+    return JSONContentTypePrefix + obj_raw
+
+def to_untyped_object(obj_raw):
+    ''' Return the object without its content type prefix, serialized
+        as json (transcoding it if it is not). '''
+    if obj_raw[:1] == JSONContentTypePrefix:
+        return obj_raw[1:]
+
+    return pack_object(unpack_object(obj_raw, content_typed=True))
+
+
+def pack_publish_msg(topic, obj, dont_pack_object, serializer=None):
     assert isinstance(topic, bytes)
     topic_length = len(topic)
 
     if dont_pack_object:
         obj_raw = obj
     else:
-        obj_raw = to_bytes(json.dumps(obj))
+        obj_raw = pack_object(obj, serializer)
 
     assert isinstance(obj_raw, bytes)
-    obj_lenth = len(obj_raw)
 
-    if not (0 <= topic_length <= ShortMax) or not (0 <= obj_lenth <= ShortMax):
+    # the length of the object is limited by the length of the whole message
+    if not (0 <= topic_length <= ShortMax):
         raise Exception()
 
     raw = struct.pack(">H", topic_length) + topic + obj_raw
     return raw
 
-def unpack_publish_msg(raw, dont_unpack_object):
-    topic_length, = struct.unpack(">H", raw[:2])
-    topic   = raw[2: 2+topic_length]
-    obj_raw = raw[2+topic_length:]
+def pack_publish_frame(topic, obj_raw, protocol_version=1):
+    ''' Pack a whole 'publish' message of an already packed object as two
+        chunks: the header with the topic and the object itself, so the
+        object is not copied. The chunks are meant to be sent as they are
+        (see connection.send_chunks). '''
+    assert isinstance(topic, bytes)
+    topic_length = len(topic)
+
+    if not (0 <= topic_length <= ShortMax):
+        raise Exception()
+
+    message_body_len = 2 + topic_length + len(obj_raw)
+    msg_len = HeaderLenByVersion[protocol_version] + message_body_len
+
+    if msg_len > MessageMaxLenByVersion[protocol_version]:
+        raise MessageTooLarge(msg_len, protocol_version)
+
+    head = struct.pack(HeaderFormatByVersion[protocol_version] + "H", 0x1, message_body_len, topic_length) + topic
+    return head, obj_raw
+
+def unpack_publish_msg(raw, dont_unpack_object, content_typed=False):
+    topic_length, = struct.unpack(">H", bytes(raw[:2]))
+    topic   = bytes(raw[2: 2+topic_length])
+    obj_raw = bytes(raw[2+topic_length:])
 
     if dont_unpack_object:
         return topic, obj_raw
 
     else:
-        obj = json.loads(to_text(obj_raw))
+        obj = unpack_object(obj_raw, content_typed)
         return topic, obj
 
 
+def _pack_publish_record(topic, obj, dont_pack_object, serializer):
+    assert isinstance(topic, bytes)
+    topic_length = len(topic)
+
+    if dont_pack_object:
+        obj_raw = obj
+    else:
+        obj_raw = pack_object(obj, serializer)
+
+    assert isinstance(obj_raw, bytes)
+    obj_lenth = len(obj_raw)
+
+    if not (0 <= topic_length <= ShortMax) or not (0 <= obj_lenth <= IntMax):
+        raise Exception()
+
+    return struct.pack(">HI", topic_length, obj_lenth) + topic + obj_raw
+
+def pack_publish_batch_msg(events, dont_pack_object, serializer=None):
+    if not (0 <= len(events) <= ShortMax):
+        raise Exception()
+
+    records = [struct.pack(">H", len(events))]
+    for topic, obj in events:
+        records.append(_pack_publish_record(topic, obj, dont_pack_object, serializer))
+
+    raw = b"".join(records)
+    return raw
+
+def unpack_publish_batch_msg(raw, dont_unpack_object, content_typed=False):
+    count, = struct.unpack(">H", bytes(raw[:2]))
+    offset = 2
+
+    events = []
+    for i in range(count):
+        topic_length, obj_lenth = struct.unpack(">HI", bytes(raw[offset:offset+6]))
+        offset += 6
+
+        topic   = bytes(raw[offset: offset+topic_length])
+        obj_raw = bytes(raw[offset+topic_length: offset+topic_length+obj_lenth])
+        offset += topic_length + obj_lenth
+
+        if dont_unpack_object:
+            events.append((topic, obj_raw))
+        else:
+            events.append((topic, unpack_object(obj_raw, content_typed)))
+
+    return events
+
+def pack_publish_batches(events, dont_pack_object, protocol_version=1, serializer=None):
+    ''' Pack the events, a sequence of (topic, obj), in as few
+        'publish_batch' messages as possible without exceeding the
+        maximum size of a message. Return the list of messages. '''
+    header_len = HeaderLenByVersion[protocol_version]
+    max_len = min(MessageMaxLenByVersion[protocol_version], header_len + ShortMax)  # the count of records is a short too
+
+    messages = []
+    records = []
+    message_len = header_len + 2   # header + count of records
+
+    for topic, obj in events:
+        record = _pack_publish_record(topic, obj, dont_pack_object, serializer)
+        if header_len + 2 + len(record) > MessageMaxLenByVersion[protocol_version]:
+            raise MessageTooLarge(header_len + 2 + len(record), protocol_version)
+
+        if records and (message_len + len(record) > max_len or len(records) == ShortMax):
+            messages.append(_pack_publish_batch_records(records, message_len, protocol_version))
+            records = []
+            message_len = header_len + 2
+
+        records.append(record)
+        message_len += len(record)
+
+    if records:
+        messages.append(_pack_publish_batch_records(records, message_len, protocol_version))
+
+    return messages
+
+def _pack_publish_batch_records(records, message_len, protocol_version):
+    header_len = HeaderLenByVersion[protocol_version]
+    header = struct.pack(HeaderFormatByVersion[protocol_version], 0x6, message_len - header_len)
+    return header + struct.pack(">H", len(records)) + b"".join(records)
+
+
 def pack_subscribe_unsubscribe_msg(topic):
     assert isinstance(topic, bytes)
     topic_length = len(topic)
@@ -66,11 +293,97 @@ def pack_subscribe_unsubscribe_msg(topic):
     return raw
 
 def unpack_subscribe_unsubscribe_msg(raw):
-    return raw  # the topic
+    return bytes(raw)  # the topic
+
+def pack_subscribe_filtered_msg(topic, filter_raw):
+    assert isinstance(topic, bytes) and isinstance(filter_raw, bytes)
+    topic_length = len(topic)
+
+    if not (0 <= topic_length <= ShortMax):
+        raise Exception()
+
+    raw = struct.pack(">H", topic_length) + topic + filter_raw
+    return raw
+
+def unpack_subscribe_filtered_msg(raw):
+    raw = bytes(raw)
+    topic_length, = struct.unpack(">H", raw[:2])
+    topic = raw[2:2+topic_length]
+    filter_raw = raw[2+topic_length:]
+    return topic, filter_raw
+
+def pack_subscribe_many_msg(topics):
+    if not (0 <= len(topics) <= ShortMax):
+        raise Exception()
+
+    records = [struct.pack(">H", len(topics))]
+    for topic in topics:
+        assert isinstance(topic, bytes)
+        if not (0 <= len(topic) <= ShortMax):
+            raise Exception()
+
+        records.append(struct.pack(">H", len(topic)))
+        records.append(topic)
+
+    raw = b"".join(records)
+    return raw
+
+def unpack_subscribe_many_msg(raw):
+    raw = bytes(raw)
+    count, = struct.unpack(">H", raw[:2])
+    offset = 2
+
+    topics = []
+    for i in range(count):
+        topic_length, = struct.unpack(">H", raw[offset:offset+2])
+        offset += 2
+        topics.append(raw[offset:offset+topic_length])
+        offset += topic_length
+
+    return topics
+
+
+# the 'sync', 'synced', 'ping' and 'pong' messages carry just a cookie
+def pack_sync_msg(cookie):
+    if not (0 <= cookie <= IntMax):
+        raise Exception()
 
+    raw = struct.pack(">I", cookie)
+    return raw
 
+def unpack_sync_msg(raw):
+    cookie, = struct.unpack(">I", bytes(raw[:4]))
+    return cookie
+
+
+
+MessageTypeByOp = {
+        0x1: "publish",
+        0x2: "subscribe",
+        0x3: "introduce_myself",
+        0x4: "unsubscribe",
+        0x5: "goodbye",
+        0x6: "publish_batch",
+        0x7: "hello",
+        0x8: "welcome",
+        0x9: "sync",
+        0xa: "synced",
+        0xb: "subscribe_many",
+        0xc: "ping",
+        0xd: "pong",
+        0xe: "bridge",
+        0xf: "subscribe_filtered",
+        0x10: "unsubscribe_filtered",
+        0x11: "publish_retained",
+        0x12: "no_pings",
+        }
 
 def pack_message(message_type, *args, **kargs):
+    ''' Pack the message. The keyword argument 'protocol_version' (1 by
+        default) sets how the message is framed; the rest of the arguments
+        are for the packing of the body. '''
+    protocol_version = kargs.pop('protocol_version', 1)
+
     if message_type == 'publish':
         op = 0x1
         message_body = pack_publish_msg(*args, **kargs)
@@ -91,36 +404,82 @@ def pack_message(message_type, *args, **kargs):
         op  = 0x5
         message_body = pack_introduce_myself_or_goodbye_msg(*args, **kargs)
 
+    elif message_type == 'publish_batch':
+        op = 0x6
+        message_body = pack_publish_batch_msg(*args, **kargs)
+
+    elif message_type == 'hello':
+        op = 0x7
+        message_body = pack_hello_msg(*args, **kargs)
+
+    elif message_type == 'welcome':
+        op = 0x8
+        message_body = pack_welcome_msg(*args, **kargs)
+
+    elif message_type == 'sync':
+        op = 0x9
+        message_body = pack_sync_msg(*args, **kargs)
+
+    elif message_type == 'synced':
+        op = 0xa
+        message_body = pack_sync_msg(*args, **kargs)
+
+    elif message_type == 'subscribe_many':
+        op = 0xb
+        message_body = pack_subscribe_many_msg(*args, **kargs)
+
+    elif message_type == 'ping':
+        op = 0xc
+        message_body = pack_sync_msg(*args, **kargs)
+
+    elif message_type == 'pong':
+        op = 0xd
+        message_body = pack_sync_msg(*args, **kargs)
+
+    elif message_type == 'bridge':
+        op = 0xe
+        message_body = pack_introduce_myself_or_goodbye_msg(*args, **kargs)
+
+    elif message_type == 'subscribe_filtered':
+        op = 0xf
+        message_body = pack_subscribe_filtered_msg(*args, **kargs)
+
+    elif message_type == 'unsubscribe_filtered':
+        op = 0x10
+        message_body = pack_subscribe_filtered_msg(*args, **kargs)
+
+    elif message_type == 'publish_retained':
+        op = 0x11
+        message_body = pack_publish_msg(*args, **kargs)
+
+    elif message_type == 'no_pings':
+        op = 0x12
+        message_body = b""   # no body
+
     else:
         raise Exception()
 
     assert isinstance(message_body, bytes)
     message_body_len = len(message_body)
-    msg = struct.pack(">BH", op, message_body_len) + message_body
+    msg_len = HeaderLenByVersion[protocol_version] + message_body_len
 
-    if len(msg) > ShortMax:
-        raise Exception()
+    if msg_len > MessageMaxLenByVersion[protocol_version]:
+        raise MessageTooLarge(msg_len, protocol_version)
 
+    msg = struct.pack(HeaderFormatByVersion[protocol_version], op, message_body_len) + message_body
     return msg
 
-def unpack_message_header(raw):
-    assert len(raw) == 3
-
-    op, message_body_len = struct.unpack(">BH", raw)
+def unpack_message_header(raw, protocol_version=1):
+    assert len(raw) == HeaderLenByVersion[protocol_version]
 
-    message_type = {
-            0x1: "publish",
-            0x2: "subscribe",
-            0x3: "introduce_myself",
-            0x4: "unsubscribe",
-            0x5: "goodbye",
-            }[op]
+    op, message_body_len = struct.unpack(HeaderFormatByVersion[protocol_version], raw)
 
+    message_type = MessageTypeByOp[op]
     return message_type, message_body_len
 
 def unpack_message_body(message_type, message_body, **kargs):
-    assert isinstance(message_body, bytes)
-    if message_type == 'publish':
+    assert isinstance(message_body, (bytes, bytearray, memoryview))
+    if message_type in ('publish', 'publish_retained'):
         return unpack_publish_msg(message_body, **kargs)
     
     elif message_type == 'subscribe':
@@ -132,8 +491,29 @@ def unpack_message_body(message_type, message_body, **kargs):
     elif message_type == "unsubscribe":
         return unpack_subscribe_unsubscribe_msg(message_body, **kargs)
     
-    elif message_type == 'goodbye':
+    elif message_type in ('goodbye', 'bridge'):
         return unpack_introduce_myself_or_goodbye_msg(message_body, **kargs)
 
+    elif message_type == 'publish_batch':
+        return unpack_publish_batch_msg(message_body, **kargs)
+
+    elif message_type == 'hello':
+        return unpack_hello_msg(message_body, **kargs)
+
+    elif message_type == 'welcome':
+        return unpack_welcome_msg(message_body, **kargs)
+
+    elif message_type in ('sync', 'synced', 'ping', 'pong'):
+        return unpack_sync_msg(message_body, **kargs)
+
+    elif message_type == 'subscribe_many':
+        return unpack_subscribe_many_msg(message_body, **kargs)
+
+    elif message_type in ('subscribe_filtered', 'unsubscribe_filtered'):
+        return unpack_subscribe_filtered_msg(message_body, **kargs)
+
+    elif message_type == 'no_pings':
+        return None
+
     else:
         raise Exception()
@@ -1,30 +1,337 @@
-import socket, threading, json, sys
+import socket, threading, json, sys, os, stat, errno, collections, time, itertools, random, zlib
 import syslog, traceback, signal
 
 from .daemon import Daemon
-from .connection import Connection, ConnectionClosed
-from .topic import build_topic_chain, fail_if_topic_isnt_valid
+from .connection import Connection, ConnectionClosed, MessageReader, send_chunks, parse_address, UnixAddressPrefix
+from .topic import ValidTopicsCache
+from .subscriptions import TopicIndex
+from .filters import FiltersCache
+from .retained import RetainedStore
+from .poller import Poller, READ, WRITE, ERROR, ready_now
+from . import tracing
+
+from .esc import esc, to_bytes, to_text
+from .message import unpack_message_header, unpack_message_body, pack_message, pack_publish_batches, pack_publish_frame
+from .message import ProtocolVersion, HeaderLenByVersion, MessageTooLarge, supports_keepalive, supports_bridges
+from .message import supports_bridge_ids, supports_retained
+from .message import is_content_typed, to_content_typed_object, to_untyped_object, pack_object, unpack_object
+
+# the reserved topic on which the notifier publishes its metrics (see Notifier.metrics)
+MetricsTopic = b"notifier.metrics"
+
+def _recv_exactly(sock, length):
+   chunks = []
+   while length:
+      chunk = sock.recv(length)
+      if not chunk:
+         raise ConnectionClosed()
+
+      chunks.append(chunk)
+      length -= len(chunk)
+
+   return b"".join(chunks)
+
+
+class _OutboundQueue(object):
+   ''' Bounded queue of frames waiting to be sent to an endpoint. Each
+       frame is a tuple of chunks (bytes) that are sent one after the
+       other, so the chunks can be shared by the frames of several
+       endpoints (see _EncodedEvent).
+
+       When the queue is full the overflow policy decides what to do:
+        - block: wait until the writer makes some room
+        - drop-oldest: discard the oldest queued frame
+        - drop-newest: discard the frame being queued
+        - disconnect: give up and disconnect the endpoint
+
+       The control frames (the welcome, the answers to the syncs and the
+       pings, ...) are always queued, even beyond the bound, and they are
+       never dropped: the endpoint waits for them and they are few and
+       small. The queue keeps each frame with a flag that tells if it is
+       a control frame.
+
+       The counters (enqueued, dropped and max_depth) allow to see which
+       endpoint is lagging behind.
+       '''
+   POLICIES = ("block", "drop-oldest", "drop-newest", "disconnect")
+
+   def __init__(self, maxlen, overflow_policy):
+      self.frames = collections.deque()    # (is control, frame) pairs
+      self.maxlen = maxlen
+      self.overflow_policy = overflow_policy
+      self.cond = threading.Condition(threading.Lock())
+      self.closed = False
+
+      self.enqueued = 0
+      self.dropped = 0
+      self.max_depth = 0
+
+   def __len__(self):
+      return len(self.frames)
+
+   def is_full(self):
+      return len(self.frames) >= self.maxlen
+
+   def put(self, frame, control=False):
+      ''' Queue the frame. Return False if the endpoint must be disconnected
+          because the queue is full and the policy is 'disconnect'. A
+          control frame bypasses the overflow policy. '''
+      with self.cond:
+         if self.closed:
+            return True
+
+         if len(self.frames) >= self.maxlen and not control:
+            if self.overflow_policy == "block":
+               while len(self.frames) >= self.maxlen and not self.closed:
+                  self.cond.wait()
+
+               if self.closed:
+                  return True
+
+            elif self.overflow_policy == "drop-oldest":
+               self._drop_oldest_data_frame()
+
+            elif self.overflow_policy == "drop-newest":
+               self.dropped += 1
+               return True
 
-from .esc import esc
-from .message import unpack_message_body, pack_message
+            else:
+               return False
+
+         self.frames.append((control, frame))
+         self.enqueued += 1
+         self.max_depth = max(self.max_depth, len(self.frames))
+         self.cond.notify_all()
+         return True
+
+   def pop_all(self, wait=True):
+      ''' Take all the queued frames. If 'wait' is true, block until there is
+          at least one frame; return None if the queue was closed. '''
+      with self.cond:
+         while wait and not self.frames and not self.closed:
+            self.cond.wait()
+
+         if not self.frames and self.closed:
+            return None
+
+         frames = [frame for control, frame in self.frames]
+         self.frames.clear()
+         self.cond.notify_all()
+         return frames
+
+   def rebound(self, maxlen, overflow_policy):
+      ''' Change the bound and the overflow policy of the queue. '''
+      with self.cond:
+         self.maxlen = maxlen
+         self.overflow_policy = overflow_policy
+         self.cond.notify_all()
+
+   def _drop_oldest_data_frame(self):
+      for i, (control, frame) in enumerate(self.frames):
+         if not control:
+            del self.frames[i]
+            self.dropped += 1
+            return
 
-#TODO add keep alive
-class _Endpoint(threading.Thread):
-   def __init__(self, socket, notifier, codename):
-      threading.Thread.__init__(self)
-      self.connection = Connection(socket)
-      self.is_finished = False
-      self.notifier = notifier
-      self.codename = codename
+   def close(self):
+      ''' Discard any pending frame and wake up anyone waiting. '''
+      with self.cond:
+         self.closed = True
+         self.dropped += len(self.frames)
+         self.frames.clear()
+         self.cond.notify_all()
+
+   def stats(self):
+      return {
+            'depth': len(self.frames),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            }
+
+
+class _EncodedEvent(object):
+   ''' An event being distributed. Its frame is encoded once per protocol
+       version and shared by all the endpoints that use that version.
+       The object is never copied: it is the last chunk of the frame. '''
+   __slots__ = ("topic", "obj_raw", "frames_by_version")
+
+   def __init__(self, topic, obj_raw):
+      self.topic = topic
+      self.obj_raw = obj_raw    # prefixed by its content type
+      self.frames_by_version = {}
+
+   def frame_for(self, protocol_version):
+      ''' Return the frame for the given version of the protocol. Raise if
+          the event cannot be sent with that version (it is too large or
+          it cannot be transcoded to json). '''
+      try:
+         frame = self.frames_by_version[protocol_version]
+      except KeyError:
+         try:
+            obj_raw = self.obj_raw if is_content_typed(protocol_version) else to_untyped_object(self.obj_raw)
+            frame = pack_publish_frame(self.topic, obj_raw, protocol_version)
+         except Exception as ex:
+            frame = ex    # remember the failure, the other endpoints will fail too
+
+         self.frames_by_version[protocol_version] = frame
+
+      if isinstance(frame, Exception):
+         raise frame
+
+      return frame
+
+
+def _bucket_of(value):
+   ''' The histograms count by powers of 2: the bucket i counts the values
+       less than 2**i (and not less than 2**(i-1)). '''
+   return min(_Metrics.Buckets - 1, int(value).bit_length())
+
+class _Metrics(object):
+   ''' Counters of the distribution of the events:
+        - events_in/bytes_in: the events published, by the first subtopic
+          of their topic (the prefix)
+        - events_out/bytes_out: the events sent to the subscribers, by prefix
+        - fanout: histogram of to how many endpoints each event was sent
+        - distribution_us: histogram of the time spent distributing each
+          event or batch of events, in microseconds
+        - payloads_unpacked: how many events were unpacked to evaluate the
+          filters of the subscriptions (at most once per event)
+        - filtered_out: how many times an event was not sent to a
+          subscriber because it didn't match its filters
+
+       Each thread that distributes events has its own _Metrics (see
+       Notifier._thread_metrics) so they are updated without any lock.
+       '''
+   Buckets = 32
+   MaxPrefixes = 256
+   OtherPrefix = b"<other>"  # the prefixes seen beyond the MaxPrefixes
+
+   def __init__(self):
+      self.events_in = {}
+      self.bytes_in = {}
+      self.events_out = {}
+      self.bytes_out = {}
+      self.fanout = [0] * self.Buckets
+      self.distribution_us = [0] * self.Buckets
+      self.payloads_unpacked = 0
+      self.filtered_out = 0
+
+   def count_event(self, topic, size, fanout):
+      prefix = topic.split(b".", 1)[0]
+      if prefix not in self.events_in:
+         if len(self.events_in) >= self.MaxPrefixes:
+            prefix = self.OtherPrefix
+
+         if prefix not in self.events_in:
+            self.events_in[prefix] = self.bytes_in[prefix] = self.events_out[prefix] = self.bytes_out[prefix] = 0
+
+      self.events_in[prefix] += 1
+      self.bytes_in[prefix] += size
+      self.events_out[prefix] += fanout
+      self.bytes_out[prefix] += fanout * size
+      self.fanout[_bucket_of(fanout)] += 1
+
+   def count_distribution(self, elapsed):
+      self.distribution_us[_bucket_of(elapsed * 1000000)] += 1
+
+   def merge(self, other):
+      ''' Add the counters of the other metrics to these. The other metrics
+          may be being updated by another thread: we take a copy of its
+          dicts and lists first (atomic under the GIL). '''
+      for name in ("events_in", "bytes_in", "events_out", "bytes_out"):
+         counters = getattr(self, name)
+         for prefix, n in dict(getattr(other, name)).items():
+            counters[prefix] = counters.get(prefix, 0) + n
+
+      for name in ("fanout", "distribution_us"):
+         counters = getattr(self, name)
+         for i, n in enumerate(list(getattr(other, name))):
+            counters[i] += n
+
+      self.payloads_unpacked += other.payloads_unpacked
+      self.filtered_out += other.filtered_out
+
+   def as_dict(self):
+      ''' Return the counters in a json-friendly form: the prefixes as text
+          and the histograms as the pairs [upper bound, count] of their
+          non-empty buckets. '''
+      result = {}
+      for name in ("events_in", "bytes_in", "events_out", "bytes_out"):
+         result[name] = dict((prefix.decode("ascii"), n) for prefix, n in getattr(self, name).items())
+
+      for name in ("fanout", "distribution_us"):
+         result[name] = [[2 ** i, n] for i, n in enumerate(getattr(self, name)) if n]
+
+      result['payloads_unpacked'] = self.payloads_unpacked
+      result['filtered_out'] = self.filtered_out
+      return result
+
+
+class _FilteredSubscriber(object):
+   ''' An endpoint subscribed with a filter (see filters), as it is
+       indexed in the TopicIndex: there is one per endpoint and filter and
+       the endpoint receives the events of its topics only if they match
+       the filter (see Notifier._apply_filters).
+
+       The distribution skips the filters while no endpoint has one (see
+       Notifier.filtered_subscriptions), but a distribution that read the
+       subscriptions just before the last filtered one was removed may
+       still find it: then it evaluates its filter by itself. '''
+   __slots__ = ("endpoint", "filter")
+
+   def __init__(self, endpoint, filter):
+      self.endpoint = endpoint
+      self.filter = filter
+
+   @property
+   def is_finished(self):
+      return self.endpoint.is_finished
+
+   @property
+   def is_peer(self):
+      return self.endpoint.is_peer
+
+   def _matches(self, obj_raw):
+      try:
+         return self.filter.matches(unpack_object(obj_raw, content_typed=True))
+      except Exception:
+         return False
 
-      self.said_goodbye = False
+   def send_event(self, event):
+      if self._matches(event.obj_raw):
+         self.endpoint.send_event(event)
 
-      self.name = ""
+   def send_events(self, events):
+      events = [(topic, obj_raw) for topic, obj_raw in events if self._matches(obj_raw)]
+      if events:
+         self.endpoint.send_events(events)
 
-      self.start()
+   def __repr__(self):
+      return "%r if %r" % (self.endpoint, self.filter)
+
+
+class _EndpointBase(object):
+   ''' Common logic of the endpoints: how the received messages are
+       processed, no matter how they were received.
+
+       A peer is the endpoint of the link with another worker of the same
+       notifier (see Notifier.serve_with_workers) or with another notifier
+       (a bridge, see Notifier.accept_bridge): the events received from it
+       are distributed to the local endpoints only. '''
+   is_peer = False
+
+   # the ids of the notifier at the other end of a bridge and of the
+   # notifier that initiated it (see Notifier.accept_bridge)
+   peer_id = None
+   bridge_initiator = None
+
+   # false if the endpoint told us not to ping it (the 'no_pings' message)
+   answers_pings = True
 
    def _is_valid_message(self, message_type, message_body):
-      if not message_type in ("subscribe", "publish", "unsubscribe", "introduce_myself"):
+      if not message_type in ("subscribe", "subscribe_many", "publish", "publish_batch", "unsubscribe", "introduce_myself", "hello", "sync", "synced", "ping", "pong", "bridge",
+                              "subscribe_filtered", "unsubscribe_filtered", "publish_retained", "no_pings"):
          return False
 
       return True
@@ -34,9 +341,36 @@ class _Endpoint(threading.Thread):
             self._log(syslog.LOG_ERR, "Unexpected message after endpoint said goodbye. Message type: '%s'." % esc(message_type))
             raise Exception("Unexpected message.")
 
+         # the objects are distributed always prefixed by their content type
          if message_type == "publish":
+            began = tracing.begin() if tracing.active else None
+            topic, raw_obj = unpack_message_body(message_type, message_body, dont_unpack_object=True)
+            if not is_content_typed(self.protocol_version):
+               raw_obj = to_content_typed_object(raw_obj)
+
+            if began is not None:
+               tracing.end("notifier.unpack", began)
+
+            self.notifier.distribute_event(topic, raw_obj, from_peer=self.is_peer)
+
+         elif message_type == "publish_retained":
+            if not supports_retained(self.protocol_version):
+               self._log(syslog.LOG_ERR, "Unexpected retained event from an endpoint of version %s." % esc(self.protocol_version))
+               raise Exception("Unexpected message.")
+
             topic, raw_obj = unpack_message_body(message_type, message_body, dont_unpack_object=True)
-            self.notifier.distribute_event(topic, raw_obj)
+            self.notifier.retain_and_distribute_event(topic, raw_obj, from_peer=self.is_peer)
+
+         elif message_type == "publish_batch":
+            began = tracing.begin() if tracing.active else None
+            events = unpack_message_body(message_type, message_body, dont_unpack_object=True)
+            if not is_content_typed(self.protocol_version):
+               events = [(topic, to_content_typed_object(raw_obj)) for topic, raw_obj in events]
+
+            if began is not None:
+               tracing.end("notifier.unpack", began)
+
+            self.notifier.distribute_events(events, from_peer=self.is_peer)
 
          elif message_type == "unsubscribe":
             topic = unpack_message_body(message_type, message_body)
@@ -45,10 +379,64 @@ class _Endpoint(threading.Thread):
          elif message_type == "introduce_myself":
             self.name = unpack_message_body(message_type, message_body)
             self._log(syslog.LOG_NOTICE, "Introduced himself as '%s'." % esc(self.name))
+
+         elif message_type == "hello":
+            self.name, max_protocol_version = unpack_message_body(message_type, message_body)
+            protocol_version = min(max_protocol_version, ProtocolVersion)
+            self._log(syslog.LOG_NOTICE, "Introduced himself as '%s' (protocol version %i)." % esc(self.name, protocol_version))
+
+            # the welcome is framed with the version 1, the messages after it use the accepted version
+            self._queue_frame((pack_message(message_type="welcome", accepted_protocol_version=protocol_version),), control=True)
+            self._switch_protocol_version(protocol_version)
          
          elif message_type == "subscribe":
             topic = unpack_message_body(message_type, message_body)
             self.notifier.register_subscriber(topic, self)
+
+         elif message_type == "no_pings":
+            # it never reads: its TCP keepalive detects if it is gone
+            self.answers_pings = False
+
+         elif message_type == "subscribe_many":
+            for topic in unpack_message_body(message_type, message_body):
+               self.notifier.register_subscriber(topic, self)
+
+         elif message_type == "subscribe_filtered":
+            topic, filter_raw = unpack_message_body(message_type, message_body)
+            self.notifier.register_filtered_subscriber(topic, filter_raw, self)
+
+         elif message_type == "unsubscribe_filtered":
+            topic, filter_raw = unpack_message_body(message_type, message_body)
+            self.notifier.unsubscribe_filtered(topic, filter_raw, self)
+
+         elif message_type == "sync":
+            # everything received before was processed: the events that
+            # it may have generated are already queued before the answer
+            cookie = unpack_message_body(message_type, message_body)
+            if self.is_peer or not self.notifier.peers:
+               self._queue_frame((pack_message(message_type="synced", cookie=cookie, protocol_version=self.protocol_version),), control=True)
+            else:
+               # the subscriptions are propagated to the other workers:
+               # answer once all of them processed them too
+               self.notifier.sync_with_peers(self, cookie)
+
+         elif message_type == "synced" and self.is_peer:
+            cookie = unpack_message_body(message_type, message_body)
+            self.notifier.peer_synced(self, cookie)
+
+         elif message_type == "bridge":
+            name = unpack_message_body(message_type, message_body)
+            if self.is_peer:
+               self.notifier.bridge_answered(self, name)
+            else:
+               self.notifier.accept_bridge(self, name)
+
+         elif message_type == "ping":
+            cookie = unpack_message_body(message_type, message_body)
+            self._queue_frame((pack_message(message_type="pong", cookie=cookie, protocol_version=self.protocol_version),), control=True)
+
+         elif message_type == "pong":
+            pass # any message received, this one included, proves that the endpoint is alive
          
          elif message_type == "goodbye":
             name = unpack_message_body(message_type, message_body)
@@ -59,48 +447,354 @@ class _Endpoint(threading.Thread):
             self._log(syslog.LOG_ERR, "Invalid message. Unknown type: '%s'." % esc(message_type))
             raise Exception("Invalid message.")
 
+   def _switch_protocol_version(self, protocol_version):
+      self.protocol_version = protocol_version
+
+   def _adapt_object(self, topic, obj_raw):
+      ''' Return the object as this endpoint understands it: the endpoints
+          of the protocol version < 3 know only json without a content type
+          prefix. Return None if the object cannot be transcoded. '''
+      if is_content_typed(self.protocol_version):
+         return obj_raw
+
+      try:
+         return to_untyped_object(obj_raw)
+      except Exception as ex:
+         self._log(syslog.LOG_ERR, "Event on the topic '%s' dropped: it cannot be transcoded to json: %s" % esc(topic, str(ex)))
+         return None
+
+   def send_event(self, event, control=False):
+      ''' Send an _EncodedEvent. '''
+      try:
+         frame = event.frame_for(self.protocol_version)
+      except Exception as ex:
+         self._log(syslog.LOG_ERR, "Event on the topic '%s' dropped: %s" % esc(event.topic, str(ex)))
+         return
+
+      self._queue_frame(frame, control)
+
+   def send_events(self, events, control=False):
+      if len(events) == 1:
+         return self.send_event(_EncodedEvent(*events[0]), control)
+
+      adapted_events = events
+      if not is_content_typed(self.protocol_version):
+         adapted_events = []
+         for topic, obj_raw in events:
+            obj_raw = self._adapt_object(topic, obj_raw)
+            if obj_raw is not None:
+               adapted_events.append((topic, obj_raw))
+
+      try:
+         for frame in pack_publish_batches(adapted_events, dont_pack_object=True, protocol_version=self.protocol_version):
+            self._queue_frame((frame,), control)
+      except MessageTooLarge as ex:
+         # send them one by one, only the too large events are dropped
+         for topic, obj_raw in events:
+            self.send_event(_EncodedEvent(topic, obj_raw), control)
+      except:
+         self._log(syslog.LOG_ERR, "An exception when sending a message to it: %s." % esc(traceback.format_exc()))
+         self.is_finished = True
+
+   def ping_if_idle(self, now, keepalive_interval, idle_timeout):
+      ''' Check if the endpoint is alive: if it showed no sign of life in
+          the last 'idle_timeout' seconds, it is finished (and return
+          True); if it didn't in the last 'keepalive_interval' seconds,
+          ping it. Only the endpoints of the version 5 of the protocol or
+          higher answer the pings, and not the ones that asked not to be
+          pinged (a Publisher).
+
+          A sign of life is a message received from it or a write that
+          made progress while it had a backlog of frames to receive (a
+          slow subscriber that never publishes is still reading). If the
+          notifier is the one behind (the endpoint sent bytes that we
+          didn't read yet or it has room for the ones that we didn't write
+          yet) the endpoint is not idle. '''
+      if not supports_keepalive(self.protocol_version) or not self.answers_pings:
+         return False
+
+      alive_at = max(self.last_received_at, self.last_sent_at)
+      if now - alive_at >= keepalive_interval and self._is_notifier_behind():
+         alive_at = now
+
+      idle = now - alive_at
+      if idle >= idle_timeout:
+         self._log(syslog.LOG_ERR, "Nothing received in %.1f seconds, disconnecting the endpoint." % esc(idle))
+         self.is_finished = True
+         return True
+
+      # ping once per idle period; the ping is a control frame so it is
+      # queued even if the queue is full, after the frames already queued
+      if idle >= keepalive_interval and self.ping_sent_at < alive_at:
+         self.ping_sent_at = now
+         self._queue_frame((pack_message(message_type="ping", cookie=int(now) & 0xffffffff, protocol_version=self.protocol_version),), control=True)
+         self.notifier.count("pings")
+
+      return False
+
+   def _is_notifier_behind(self):
+      ready = ready_now(self._fileno(), READ | WRITE)
+      return bool(ready & READ) or (bool(ready & WRITE) and self._has_frames_to_write())
+
+   def _has_frames_to_write(self):
+      return bool(self.outbound)
+
+   def _sent_some(self, remaining_chunks):
+      # a write that made progress counts as a sign of life only if the
+      # endpoint had a backlog: the writes to an endpoint that doesn't
+      # read succeed until its socket buffers are full
+      if remaining_chunks or self._has_frames_to_write():
+         self.last_sent_at = time.time()
+
+   def _queue_frame(self, frame, control=False):
+      if not self.outbound.put(frame, control):
+         self._log(syslog.LOG_ERR, "The outbound queue is full (%i frames), disconnecting the endpoint." % esc(len(self.outbound)))
+         self.is_finished = True
+         self.outbound.close()
+
+   def __repr__(self):
+      return "%s%s%s" % (self.codename, ((" (%s)" % self.name) if self.name else ""), (" [dead]" if self.is_finished else ""))
+
+   def _log(self, level, message):
+      message = ("%s: " % esc(repr(self))) + message
+      syslog.syslog(level, message)
+
+
+class _Endpoint(_EndpointBase, threading.Thread):
+   ''' Endpoint served by two threads: this one reads and processes the
+       messages and the writer thread sends the frames queued for the
+       endpoint so a slow endpoint cannot stall the distribution. '''
+   def __init__(self, socket, notifier, codename, peer=False, protocol_version=ProtocolVersion):
+      threading.Thread.__init__(self)
+      self.connection = Connection(socket, max_message_len=notifier.max_message_bytes)
+      self.is_finished = False
+      self.notifier = notifier
+      self.codename = codename
+      self.is_peer = peer
+
+      self.said_goodbye = False
+
+      self.name = ""
+      self.protocol_version = 1
+      if peer:
+         self._switch_protocol_version(protocol_version)
+
+      self.last_received_at = time.time()
+      self.last_sent_at = 0
+      self.ping_sent_at = 0
+
+      self.outbound = notifier._new_outbound_queue(peer)
+      self.writer = threading.Thread(target=self._write_queued_frames)
+      self.writer.daemon = True
+
+      self.start()
+      self.writer.start()
+
    def run(self):
       try:
          while not self.connection.end_of_the_communication:
+            began = tracing.begin() if tracing.active else None
             message_type, message_body = self.connection.receive_object()
+            if began is not None:
+               tracing.end("notifier.receive", began)
+
+            self.last_received_at = time.time()
             self._process_message(message_type, message_body)
 
          self._log(syslog.LOG_NOTICE, "The connection was closed by the other point of the connection.")
       except Exception as ex:
-         if isinstance(ex, ConnectionClosed) and self.said_goodbye:
+         if isinstance(ex, ConnectionClosed) and (self.said_goodbye or (self.is_peer and self.notifier._shutting_down_gracefully)):
             self._log(syslog.LOG_NOTICE, "The connection was closed by the other point of the connection.")
-            pass # okay, the endpoint said goodbye and then closed the connection
+            pass # okay, the endpoint said goodbye (or the workers are stopping) and then closed the connection
          else:
             self._log(syslog.LOG_ERR, "An exception has occurred when receiving/processing the messages: %s." % esc(traceback.format_exc()))
       finally:
+         # clean up now, don't wait for the notifier to reap us: this
+         # stops the writer and releases the socket
          self.is_finished = True
+         self.notifier.forget_subscriptions_of(self)
+         self.close()
 
 
-   def send_event(self, topic, obj_raw):
+   def _switch_protocol_version(self, protocol_version):
+      self.protocol_version = protocol_version
+      self.connection.protocol_version = protocol_version
+
+   def _write_queued_frames(self):
       try:
-         self.connection.send_object(pack_message(message_type="publish", topic=topic, obj=obj_raw, dont_pack_object=True))
+         while True:
+            frames = self.outbound.pop_all()
+            if frames is None:
+               break
+
+            began = tracing.begin() if tracing.active else None
+            self.connection.send_chunks([chunk for frame in frames for chunk in frame], self._sent_some)
+            if began is not None:
+               tracing.end("notifier.send", began)
       except:
-         self._log(syslog.LOG_ERR, "An exception when sending a message to it: %s." % esc(traceback.format_exc()))
+         if not self.connection.closed:
+            self._log(syslog.LOG_ERR, "An exception when sending a message to it: %s." % esc(traceback.format_exc()))
          self.is_finished = True
+      finally:
+         self.outbound.close()
+
+   def _fileno(self):
+      return self.connection.socket.fileno()
 
    def close(self):
       self._log(syslog.LOG_NOTICE, "Closing the connection with the endpoint.")
       self.is_finished = True
+      self.outbound.close()
       self.connection.close()
       self._log(syslog.LOG_NOTICE, "Connection closed")
 
-   def __repr__(self):
-      return "%s%s%s" % (self.codename, ((" (%s)" % self.name) if self.name else ""), (" [dead]" if self.is_finished else ""))
+   def join(self, *args, **kargs):
+      threading.Thread.join(self, *args, **kargs)
+      self.writer.join(*args, **kargs)
+
+
+class _LoopEndpoint(_EndpointBase):
+   ''' Endpoint served by the event loop of the notifier (the 'eventloop'
+       engine). Unlike _Endpoint, it doesn't own a thread: the notifier
+       calls on_readable/on_writable when its socket is ready and the
+       endpoint keeps any partial message in its read and write buffers.
+
+       The frames to be sent wait in the outbound queue until the socket
+       is writable; then their chunks are moved to the write buffer and
+       sent with a single scatter/gather write. The 'block' overflow
+       policy is not allowed (see Notifier): it would block the whole
+       loop, and so every endpoint, on a single slow one.
+
+       The received bytes are held by a MessageReader, like the ones of
+       a Connection.
+       '''
+   def __init__(self, socket, notifier, codename, peer=False, protocol_version=ProtocolVersion):
+      socket.setblocking(False)
+      self.socket = socket
+      self.fileno = socket.fileno()
+      self.is_finished = False
+      self.notifier = notifier
+      self.codename = codename
+      self.is_peer = peer
 
-   def _log(self, level, message):
-      message = ("%s: " % esc(repr(self))) + message
-      syslog.syslog(level, message)
+      self.said_goodbye = False
+
+      self.name = ""
+      self.protocol_version = protocol_version if peer else 1
+
+      self.reader = MessageReader(notifier.recv_buffer_len, notifier.max_message_bytes)
+      self.write_chunks = []     # the chunks of the frames being sent
+      self.waiting_writable = False
+
+      self.last_received_at = time.time()
+      self.last_sent_at = 0
+      self.ping_sent_at = 0
+
+      self.outbound = notifier._new_outbound_queue(peer)
+
+   def _fileno(self):
+      return self.fileno
+
+   def _has_frames_to_write(self):
+      return bool(self.write_chunks) or bool(self.outbound)
+
+   def on_readable(self):
+      began = tracing.begin() if tracing.active else None
+      try:
+         received = self.reader.recv_from(self.socket)
+      except socket.error as e:
+         if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return
+         raise
+
+      if began is not None:
+         tracing.end("notifier.receive", began)
+
+      if not received:
+         if self.reader.is_in_the_middle_of_a_message():
+            self._log(syslog.LOG_ERR, "The message was received partially due an unexpected connection close (%i bytes pending)." % esc(self.reader.pending_len()))
+         else:
+            self._log(syslog.LOG_NOTICE, "The connection was closed by the other point of the connection.")
+
+         self.is_finished = True
+         return
+
+      self.last_received_at = time.time()
+      self._process_buffered_messages()
+
+   def _process_buffered_messages(self):
+      # process all the complete messages received; their bodies are
+      # views of the reader's buffer, valid until the next read
+      while not self.is_finished:
+         message = self.reader.next_message(self.protocol_version)
+         if message is None:
+            break
+
+         self._process_message(*message)
+
+   def _queue_frame(self, frame, control=False):
+      was_idle = not self.waiting_writable
+      _EndpointBase._queue_frame(self, frame, control)
+
+      if was_idle and not self.is_finished:
+         self.on_writable() # optimistic write, most of the times the socket is ready
+
+   def _take_queued_frames(self):
+      for frame in self.outbound.pop_all(wait=False) or []:
+         self.write_chunks.extend(frame)
+
+   def on_writable(self):
+      if not self.write_chunks:
+         self._take_queued_frames()
+
+      if self.write_chunks:
+         began = tracing.begin() if tracing.active else None
+         try:
+            if send_chunks(self.socket, self.write_chunks) and self.waiting_writable:
+               # the socket was full and now there is room: the endpoint
+               # is reading its backlog
+               self.last_sent_at = time.time()
+            else:
+               self._sent_some(self.write_chunks)
+         except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+               raise
+
+         if began is not None:
+            tracing.end("notifier.send", began)
 
+      # ask for the writable event only while we have something to write
+      if (bool(self.write_chunks) or bool(self.outbound)) != self.waiting_writable:
+         self.waiting_writable = not self.waiting_writable
+         self.notifier.poller.modify(self.fileno, (READ | WRITE) if self.waiting_writable else READ)
+
+   def close(self):
+      self._log(syslog.LOG_NOTICE, "Closing the connection with the endpoint.")
+      self.is_finished = True
+      self.outbound.close()
+      try:
+         self.notifier.poller.unregister(self.fileno)
+      except:
+         pass # already unregistered
+
+      try:
+         self.socket.shutdown(socket.SHUT_RDWR)
+      except:
+         pass # the other point may closed it first
+
+      self.socket.close()
+      self._log(syslog.LOG_NOTICE, "Connection closed")
+
+   def join(self, *args, **kargs):
+      pass # there isn't any thread to wait for
 
-# TODO endpoints_by_topic (and endpoint_subscription_lock) as a single object
 
 class Notifier(Daemon):
-   def __init__(self, address, pidfile, name, foreground, listen_queue_len, show_stats, stats_file):
+   def __init__(self, address, pidfile, name, foreground, listen_queue_len, show_stats, stats_file, engine="threads",
+         outbound_queue_len=1024, outbound_queue_overflow="drop-oldest", reap_interval=5,
+         keepalive_interval=30, idle_timeout=90, workers=1, bridges=(), metrics_interval=10,
+         tracing_sample_every=0, retained_max_bytes=16*1024*1024, bridge_queue_len=16384,
+         max_message_bytes=64*1024*1024):
       Daemon.__init__(self,
             pidfile=pidfile, 
             name=name,
@@ -110,17 +804,144 @@ class Notifier(Daemon):
       self.address = address
       self.listen_queue_len = listen_queue_len
       self.endpoints = []
-      self.endpoints_by_topic = {}
-      self.endpoint_subscription_lock = threading.Lock()
+      self.endpoints_lock = threading.Lock()
+      self.subscriptions = TopicIndex()
+      self.stats_lock = threading.Lock()
 
       self.show_stats = show_stats
       self.stats_file = stats_file
 
       self.socket = None
-      self._safe_topics = set()
+      self._safe_topics = ValidTopicsCache()
+
+      # the _FilteredSubscriber of each endpoint by the json of its filter
+      # and how many filtered subscriptions there are (see _apply_filters)
+      self._filters = FiltersCache()
+      self._filtered_by_endpoint = {}
+      self.filtered_subscriptions = 0
 
       self._shutting_down_gracefully = False
 
+      if engine not in ("threads", "eventloop"):
+         raise ValueError("Unknown engine '%s' for the notifier (expected 'threads' or 'eventloop')." % esc(engine))
+
+      self.engine = engine
+
+      if outbound_queue_overflow not in _OutboundQueue.POLICIES:
+         raise ValueError("Unknown overflow policy '%s' for the outbound queues (expected one of %s)." % esc(outbound_queue_overflow, ", ".join(_OutboundQueue.POLICIES)))
+
+      # the event loop is the only thread of its engine: blocking it on a
+      # slow endpoint would stall all the others
+      if engine == "eventloop" and outbound_queue_overflow == "block":
+         raise ValueError("The 'block' overflow policy cannot be used with the 'eventloop' engine.")
+
+      self.outbound_queue_len = outbound_queue_len
+      self.outbound_queue_overflow = outbound_queue_overflow
+
+      # the dead endpoints are reaped as soon as they are noticed and,
+      # in any case, every 'reap_interval' seconds by a sweeper
+      self.reap_interval = reap_interval
+      self.reaping_counters = {'sweeps': 0, 'reaped': 0, 'subscriptions_removed': 0, 'pings': 0, 'idle_evicted': 0}
+      self._sweeper = None
+      self._sweeper_stop = threading.Event()
+
+      # the idle endpoints are pinged every 'keepalive_interval' seconds
+      # and disconnected after 'idle_timeout' seconds without answering
+      # (0 disables the keepalive). The sweeper checks them so it must
+      # run often enough.
+      if keepalive_interval and idle_timeout <= keepalive_interval:
+         raise ValueError("The idle timeout (%s secs) must be greater than the keepalive interval (%s secs)." % esc(idle_timeout, keepalive_interval))
+
+      self.keepalive_interval = keepalive_interval
+      self.idle_timeout = idle_timeout
+      self.sweep_interval = min(reap_interval, keepalive_interval / 2.0) if keepalive_interval else reap_interval
+
+      # the sockets of the in-process endpoints waiting to be served
+      # (see socketpair) and how we wake up the event loop to serve them
+      self._endpoints_to_attach = []
+      self._endpoints_to_attach_lock = threading.Lock()
+      self._wakeup_sockets = None
+      self._in_process_ids = itertools.count(1)
+
+      # used by the eventloop engine only
+      self.poller = None
+      self.endpoints_by_fileno = {}
+      self.recv_buffer_len = 64 * 1024
+
+      # the endpoints that announce a larger message are disconnected
+      # before receiving it (see MessageReader)
+      if max_message_bytes < 1:
+         raise ValueError("The messages must be allowed to have at least 1 byte, not %s." % esc(max_message_bytes))
+
+      self.max_message_bytes = max_message_bytes
+      self.poll_timeout = min(1, self.sweep_interval) # secs, how often we check if we need to shutdown or to sweep
+
+      # the events are distributed by 'workers' processes (see
+      # serve_with_workers); each one knows the others as its peers and
+      # tells them to which topics its own endpoints are subscribed
+      if workers < 1:
+         raise ValueError("The number of workers must be at least 1, not %i." % esc(workers))
+
+      self.workers = workers
+      self.worker_id = None       # None in the process that accepts the endpoints or spawns the workers
+      self.worker_pids = []
+      self.peers = []
+      self.peers_lock = threading.RLock()
+      self.local_subscriptions = {}  # topic -> how many subscriptions of the non-peer endpoints
+      self._pending_syncs = {}       # sync id -> (endpoint, its cookie, peers that didn't answer yet)
+      self._sync_ids = itertools.count(1)
+
+      # the notifier keeps a bridge with each notifier in 'bridges' (see
+      # _keep_bridges), reconnecting every 'bridge_retry_interval' secs
+      # if it is lost. The events received from a bridge are not
+      # forwarded to other bridges so every pair of notifiers of a
+      # federation must be bridged, and only once: if both notifiers
+      # list each other, one of the two bridges is dropped (see
+      # _drop_duplicated_bridges). The 'bridge_id' identifies this
+      # notifier in the bridges. A bridge that queues more than
+      # 'bridge_queue_len' frames is disconnected (and reconnected).
+      if bridges and workers > 1:
+         raise ValueError("A notifier with several workers cannot be bridged with other notifiers.")
+
+      if bridge_queue_len < 1:
+         raise ValueError("The queue of the bridges must hold at least 1 frame, not %s." % esc(bridge_queue_len))
+
+      self.bridges = list(bridges)
+      self.bridge_queue_len = bridge_queue_len
+      self.bridge_id = "%s/%08x" % (name, random.getrandbits(32))
+      self.bridge_retry_interval = 2
+      self._bridger = None
+
+      # the metrics (see _Metrics and metrics) are published on the
+      # MetricsTopic and written to the stats file (if show_stats) every
+      # 'metrics_interval' secs (0 disables both), never by the distribution
+      if show_stats and not metrics_interval:
+         raise ValueError("The stats file is written every metrics interval so it cannot be 0.")
+
+      self.metrics_interval = metrics_interval
+      self.started_at = time.time()
+      self._metrics_local = threading.local()
+      self._metrics_of_threads = []     # (thread, its _Metrics)
+      self._metrics_of_dead_threads = _Metrics()
+      self._metrics_lock = threading.Lock()
+      self._next_metrics = (time.time() + metrics_interval) if metrics_interval else float("inf")
+
+      # one of every 'tracing_sample_every' stages of the hot path is
+      # timed by a tracing.Sampler (0 disables it); its histograms are
+      # added to the metrics
+      self.tracing_sample_every = tracing_sample_every
+      self.sampler = None
+
+      # the last event published with the retain flag on each topic, sent
+      # to the endpoints when they subscribe (see RetainedStore); its
+      # events (topics and objects) take at most 'retained_max_bytes' (0
+      # disables it)
+      if retained_max_bytes < 0:
+         raise ValueError("The bytes of the retained events cannot be negative (%s)." % esc(retained_max_bytes))
+
+      self.retained = RetainedStore(retained_max_bytes)
+      self._retain_locks = [threading.Lock() for i in range(64)]
+
    def mark_shutdown_gracefully(self, *args, **kargs):
       self._shutting_down_gracefully = True
 
@@ -132,134 +953,917 @@ class Notifier(Daemon):
 
       syslog.syslog(syslog.LOG_NOTICE, "Starting 'publish_subscribe_notifier' daemon on %s." % esc(str(self.address)))
       self.init()
-      self.wait_for_new_endpoints()
+      self.serve()
+
+   def serve(self):
+      if self.workers > 1 and self.worker_id is None:
+         return self.serve_with_workers()
+
+      if self.bridges:
+         self._bridger = threading.Thread(target=self._keep_bridges)
+         self._bridger.daemon = True
+         self._bridger.start()
+
+      if self.engine == "eventloop":
+         self.serve_in_event_loop()
+      else:
+         self.wait_for_new_endpoints()
 
    def at_the_end(self):
       self.close()
 
    def init(self):
       try:
-         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-         self.socket.bind(self.address)
+         family, address = parse_address(self.address)
+         self.socket = socket.socket(family, socket.SOCK_STREAM)
+         if family == socket.AF_INET:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+         else:
+            self._remove_stale_unix_socket(address)
+
+         self.socket.bind(address)
          self.socket.listen(self.listen_queue_len)
+
+         if self.tracing_sample_every:
+            self.sampler = tracing.start_sampling(self.tracing_sample_every)
       except:
          syslog.syslog(syslog.LOG_ERR, "Exception in the init of the notifier: %s" % esc((traceback.format_exc())))
          sys.exit(1)
 
    
+   def _remove_stale_unix_socket(self, path):
+      # the file of a Unix domain socket outlives its notifier if it was
+      # not closed cleanly; remove it (but only if it is a socket)
+      try:
+         if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+      except OSError:
+         pass # it doesn't exist
+
+   def _codename_of(self, sock, address):
+      if sock.family == socket.AF_INET:
+         return "Endpoint to %s:%s" % (str(address[0]), str(address[1]))
+
+      return "Endpoint to %s (fd %i)" % (self.address, sock.fileno())
+
+   def socketpair(self):
+      ''' Create a connected pair of sockets, serve one end as any other
+          endpoint and return the other end. This is an in-process
+          transport: give it to a client (like EventHandler(address=...))
+          running in the same process as the notifier. '''
+      if self.workers > 1:
+         raise Exception("The in-process transport is not available when the notifier runs several workers.")
+
+      client_end, notifier_end = socket.socketpair()
+      codename = "In-process endpoint #%i" % next(self._in_process_ids)
+
+      self._attach(notifier_end, codename)
+      syslog.syslog(syslog.LOG_NOTICE, "New endpoint connected: %s." % esc(codename))
+      return client_end
+
+   def _attach(self, sock, codename, peer=False, protocol_version=ProtocolVersion, bridge=False):
+      if self.engine == "eventloop":
+         # the event loop registers the new endpoint itself
+         endpoint = _LoopEndpoint(sock, self, codename, peer, protocol_version)
+         if bridge:
+            self._bound_bridge_queue(endpoint)
+
+         with self._endpoints_to_attach_lock:
+            self._endpoints_to_attach.append(endpoint)
+            wakeup_sockets = self._wakeup_sockets
+
+         if wakeup_sockets:
+            wakeup_sockets[1].send(b"x")
+      else:
+         endpoint = _Endpoint(sock, self, codename, peer, protocol_version)
+         if bridge:
+            self._bound_bridge_queue(endpoint)
+
+         with self.endpoints_lock:
+            self.endpoints.append(endpoint)
+
+         if peer:
+            self._add_peer(endpoint)
+
+      return endpoint
+
+   def _new_outbound_queue(self, peer):
+      # the queues of the links between the workers are unbounded: two
+      # workers blocked writing to each other would never read again.
+      # The bridges are bounded instead (see _bound_bridge_queue).
+      if peer:
+         return _OutboundQueue(sys.maxsize, "block")
+
+      return _OutboundQueue(self.outbound_queue_len, self.outbound_queue_overflow)
+
+   def _bound_bridge_queue(self, endpoint):
+      # a bridge crosses hosts: a slow link or a stalled notifier must not
+      # grow its queue without bound nor block the distribution, so the
+      # bridge is disconnected instead and the notifier that initiated it
+      # reconnects it (see _keep_bridges), resending its subscriptions
+      # and retained events
+      endpoint.outbound.rebound(self.bridge_queue_len, "disconnect")
+
+   def serve_with_workers(self):
+      ''' Fork 'workers' processes that accept the endpoints from the
+          same listening socket and distribute the events, each one in
+          its own core. Each pair of workers is linked by a socketpair:
+          a worker forwards to the others only the events to which their
+          endpoints are subscribed and the events received from a link
+          are not forwarded again. The events of a publisher, served by
+          a single worker, are still delivered in order.
+
+          This process only waits for the workers and stops them on
+          shutdown. '''
+      links = dict(((i, j), socket.socketpair()) for i in range(self.workers) for j in range(i+1, self.workers))
+
+      for worker_id in range(self.workers):
+         pid = os.fork()
+         if pid == 0:
+            exit_code = 0
+            try:
+               self._become_worker(worker_id, links)
+               self.serve()
+            except:
+               syslog.syslog(syslog.LOG_ERR, "Exception in the worker #%i of the notifier: %s" % esc(worker_id, traceback.format_exc()))
+               exit_code = 1
+            finally:
+               try:
+                  self.close()
+               finally:
+                  os._exit(exit_code)
+
+         self.worker_pids.append(pid)
+
+      for pair in links.values():
+         for sock in pair:
+            sock.close()
+
+      syslog.syslog(syslog.LOG_NOTICE, "Started %i workers: %s." % esc(self.workers, ", ".join(str(pid) for pid in self.worker_pids)))
+
+      alive = set(self.worker_pids)
+      terminated = False
+      while alive:
+         if self._shutting_down_gracefully and not terminated:
+            for pid in alive:
+               try:
+                  os.kill(pid, signal.SIGTERM)
+               except OSError:
+                  pass # it is already dead
+            terminated = True
+
+         for pid in list(alive):
+            try:
+               done = os.waitpid(pid, os.WNOHANG)[0] == pid
+            except OSError as e:
+               if e.errno == errno.EINTR:
+                  continue
+               done = True   # ECHILD, nothing to wait for
+
+            if done:
+               alive.discard(pid)
+               if not terminated:
+                  syslog.syslog(syslog.LOG_ERR, "The worker %i of the notifier died unexpectedly; %i workers left." % esc(pid, len(alive)))
+
+         time.sleep(0.1)
+
+      syslog.syslog(syslog.LOG_NOTICE, "All the workers of the notifier finished.")
+
+   def _become_worker(self, worker_id, links):
+      self.worker_id = worker_id
+      if self.stats_file:
+         self.stats_file = "%s.%i" % (self.stats_file, worker_id)
+
+      signal.signal(signal.SIGTERM, self._stop_worker)
+
+      for (i, j), pair in links.items():
+         if worker_id not in (i, j):
+            pair[0].close()
+            pair[1].close()
+            continue
+
+         mine, other = (pair[0], pair[1]) if worker_id == i else (pair[1], pair[0])
+         other.close()
+         self._attach(mine, "Link to the worker #%i" % (j if worker_id == i else i), peer=True)
+
+   def _stop_worker(self, *args):
+      self._shutting_down_gracefully = True
+      if self.engine == "threads" and self.socket:
+         # unblock the accept(); the listening socket is shared by all
+         # the workers but all of them are stopping
+         try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+         except:
+            pass
+
    def wait_for_new_endpoints(self):
-      if self.show_stats:
-         self.show_endpoints_and_subscriptions()
+      # the accept() blocks, so the periodic reaping needs its own thread
+      self._sweeper = threading.Thread(target=self._sweep_periodically)
+      self._sweeper.daemon = True
+      self._sweeper.start()
 
       while True:
          try:
             syslog.syslog(syslog.LOG_DEBUG, "Waiting for a new endpoint to connect with self.")
             socket, address = self.socket.accept()
-            codename = "Endpoint to %s:%s" % (str(address[0]), str(address[1]))
-            syslog.syslog(syslog.LOG_NOTICE, "New endpoint connected: %s." % esc(str(address)))
+            codename = self._codename_of(socket, address)
+            syslog.syslog(syslog.LOG_NOTICE, "New endpoint connected: %s." % esc(codename))
          except:
+            # a worker that stops shuts down the listening socket of all
+            # of them (see _stop_worker)
+            if self.worker_id is not None and getattr(sys.exc_info()[1], "errno", None) == errno.EINVAL:
+               self._shutting_down_gracefully = True
+
             if self._shutting_down_gracefully:
                 syslog.syslog(syslog.LOG_NOTICE, "Shutting down 'publish_subscribe_notifier' daemon on %s." % esc(str(self.address)))
             else:
                 syslog.syslog(syslog.LOG_ERR, "Exception in the wait for new endpoints of the notifier: %s" % esc((traceback.format_exc())))
+            self._sweeper_stop.set()
             self.reap(log_error_if_alive=True)
             break
 
-         self.endpoints.append(_Endpoint(socket, self, codename))
+         self._enable_tcp_keepalive(socket)
+         with self.endpoints_lock:
+            self.endpoints.append(_Endpoint(socket, self, codename))
          self.reap(log_error_if_alive=False)
 
-         if self.show_stats:
-            self.show_endpoints_and_subscriptions()
+   def serve_in_event_loop(self):
+      ''' Serve all the endpoints from this single thread: the sockets are
+          non-blocking and they are multiplexed with epoll (or poll).
+          Each endpoint is a _LoopEndpoint that keeps its own read/write
+          buffers so no thread is created per endpoint. '''
+      self.poller = Poller()
+      self.socket.setblocking(False)
+      listener_fileno = self.socket.fileno()
+      self.poller.register(listener_fileno, READ)
+
+      wakeup_sockets = socket.socketpair()
+      wakeup_sockets[0].setblocking(False)
+      wakeup_fileno = wakeup_sockets[0].fileno()
+      self.poller.register(wakeup_fileno, READ)
+      with self._endpoints_to_attach_lock:
+         self._wakeup_sockets = wakeup_sockets
+      self._attach_loop_endpoints(wakeup_sockets[0])
+
+      next_sweep = time.time() + self.sweep_interval
+      try:
+         while not self._shutting_down_gracefully:
+            if time.time() >= next_sweep:
+               self.sweep()
+               next_sweep = time.time() + self.sweep_interval
 
-   def reap(self, log_error_if_alive):
-      to_close = filter(lambda endpoint: endpoint.is_finished, self.endpoints)
-      syslog.syslog(syslog.LOG_DEBUG, "Collecting dead endpoints: %i endpoints to be collected." % esc(len(to_close)))
-      for endpoint in to_close:
-         endpoint.close()
-         endpoint.join()
+            if time.time() >= self._next_metrics:
+               self.refresh_metrics()
 
-      self.endpoints = filter(lambda endpoint: not endpoint.is_finished, self.endpoints)
-      log_type = syslog.LOG_ERR if (log_error_if_alive and self.endpoints) else syslog.LOG_DEBUG
-      syslog.syslog(log_type, "Still alive %i endpoints." % esc(len(self.endpoints)))
+            some_endpoint_died = False
+            for fileno, event_mask in self.poller.poll(self.poll_timeout):
+               if fileno == listener_fileno:
+                  self._accept_loop_endpoints()
+                  continue
 
+               if fileno == wakeup_fileno:
+                  self._attach_loop_endpoints(wakeup_sockets[0])
+                  continue
 
-   def get_and_update_endpoints_by_topic(self, topic):
-      endpoints = filter(lambda endpoint: not endpoint.is_finished, self.endpoints_by_topic.get(topic, []))
-      if self.endpoints_by_topic.get(topic, []): # update the dictionary only if there is something
-         self.endpoints_by_topic[topic] = endpoints
+               endpoint = self.endpoints_by_fileno.get(fileno)
+               if endpoint is None:
+                  continue
 
-      return endpoints
+               try:
+                  if event_mask & (READ | ERROR) and not endpoint.is_finished:
+                     endpoint.on_readable()
+
+                  if event_mask & WRITE and not endpoint.is_finished:
+                     endpoint.on_writable()
+               except:
+                  endpoint._log(syslog.LOG_ERR, "An exception has occurred when receiving/processing the messages: %s." % esc(traceback.format_exc()))
+                  endpoint.is_finished = True
+
+               some_endpoint_died = some_endpoint_died or endpoint.is_finished
+
+            if some_endpoint_died:
+               self.reap(log_error_if_alive=False)
+
+         syslog.syslog(syslog.LOG_NOTICE, "Shutting down 'publish_subscribe_notifier' daemon on %s." % esc(str(self.address)))
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Exception in the event loop of the notifier: %s" % esc((traceback.format_exc())))
+
+      self.reap(log_error_if_alive=True)
+
+      with self._endpoints_to_attach_lock:
+         self._wakeup_sockets = None
+      for wakeup_socket in wakeup_sockets:
+         wakeup_socket.close()
+
+   def _attach_loop_endpoints(self, wakeup_socket):
+      try:
+         while wakeup_socket.recv(1024):
+            pass
+      except socket.error as e:
+         if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            raise
+
+      with self._endpoints_to_attach_lock:
+         to_attach, self._endpoints_to_attach = self._endpoints_to_attach, []
+
+      for endpoint in to_attach:
+         self._add_loop_endpoint(endpoint)
+
+   def _add_loop_endpoint(self, endpoint):
+      self.endpoints_by_fileno[endpoint.fileno] = endpoint
+      with self.endpoints_lock:
+         self.endpoints.append(endpoint)
+      self.poller.register(endpoint.fileno, READ)
+
+      if endpoint.is_peer:
+         self._add_peer(endpoint)
+
+   def _accept_loop_endpoints(self):
+      while True:
+         try:
+            sock, address = self.socket.accept()
+         except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+               break
+            raise
+
+         codename = self._codename_of(sock, address)
+         syslog.syslog(syslog.LOG_NOTICE, "New endpoint connected: %s." % esc(codename))
+
+         self._enable_tcp_keepalive(sock)
+         self._add_loop_endpoint(_LoopEndpoint(sock, self, codename))
+
+   def _enable_tcp_keepalive(self, sock):
+      ''' Let the kernel detect the half-open connections of the endpoints
+          that don't support the keepalive of the protocol. A connection
+          is dropped too if the data sent is not acknowledged in
+          'idle_timeout' seconds (where supported). '''
+      if not self.keepalive_interval or sock.family != socket.AF_INET:
+         return
+
+      try:
+         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+         for option, value in (('TCP_KEEPIDLE', self.keepalive_interval),
+                               ('TCP_KEEPINTVL', self.keepalive_interval / 3.0),
+                               ('TCP_KEEPCNT', 3),
+                               ('TCP_USER_TIMEOUT', self.idle_timeout * 1000)):
+            if hasattr(socket, option):
+               sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(1, int(value)))
+      except socket.error:
+         syslog.syslog(syslog.LOG_ERR, "The TCP keepalive couldn't be enabled: %s" % esc(traceback.format_exc()))
+
+   def reap(self, log_error_if_alive):
+      with self.endpoints_lock:
+         to_close = [endpoint for endpoint in self.endpoints if endpoint.is_finished]
+         syslog.syslog(syslog.LOG_DEBUG, "Collecting dead endpoints: %i endpoints to be collected." % esc(len(to_close)))
+         for endpoint in to_close:
+            endpoint.close()
+            endpoint.join()
+
+         for endpoint in to_close:
+            self.endpoints_by_fileno.pop(getattr(endpoint, 'fileno', None), None)
+            self.forget_subscriptions_of(endpoint)
+
+         dead = set(to_close)
+         self.endpoints = [endpoint for endpoint in self.endpoints if endpoint not in dead]
+         self.count('reaped', len(to_close))
+
+         log_type = syslog.LOG_ERR if (log_error_if_alive and self.endpoints) else syslog.LOG_DEBUG
+         syslog.syslog(log_type, "Still alive %i endpoints." % esc(len(self.endpoints)))
+
+   def sweep(self):
+      ''' Ping the idle endpoints, disconnect the ones that don't answer
+          and reap the dead endpoints that nobody reaped yet. '''
+      self.count('sweeps')
+      if self.keepalive_interval:
+         now = time.time()
+         for endpoint in list(self.endpoints):
+            if endpoint.is_finished:
+               continue
+
+            try:
+               if endpoint.ping_if_idle(now, self.keepalive_interval, self.idle_timeout):
+                  self.count('idle_evicted')
+                  self.forget_subscriptions_of(endpoint)   # don't distribute more events to it
+            except:
+               endpoint._log(syslog.LOG_ERR, "An exception has occurred when pinging it: %s." % esc(traceback.format_exc()))
+               endpoint.is_finished = True
+
+      self.reap(log_error_if_alive=False)
+
+   def count(self, counter, n=1):
+      with self.stats_lock:
+         self.reaping_counters[counter] += n
+
+   def _sweep_periodically(self):
+      next_sweep = time.time() + self.sweep_interval
+      while not self._sweeper_stop.wait(max(0, min(next_sweep, self._next_metrics) - time.time())):
+         if time.time() >= next_sweep:
+            try:
+               self.sweep()
+            except:
+               syslog.syslog(syslog.LOG_ERR, "Exception when reaping the dead endpoints: %s" % esc(traceback.format_exc()))
+            next_sweep = time.time() + self.sweep_interval
+
+         if time.time() >= self._next_metrics:
+            self.refresh_metrics()
 
 
-   def distribute_event(self, topic, obj_raw):
-      if topic not in self._safe_topics: 
-          fail_if_topic_isnt_valid(topic) # this shouldn't fail (it should be checked and filtered before)
-          self._safe_topics.add(topic)
+   def distribute_event(self, topic, obj_raw, from_peer=False):
+      self._safe_topics.validate(topic) # this shouldn't fail (it should be checked and filtered before)
 
-      topic_chain = build_topic_chain(topic)
-      
-      self.endpoint_subscription_lock.acquire() # with this we guarrante that all the events are delivered in the correct order
+      # No lock here: the subscriptions are read from an immutable snapshot.
+      # The events of a publisher are still delivered in order because
+      # they are distributed one at time by the same reader (its thread or
+      # the event loop) and each outbound queue keeps the order of arrival.
+      begin = time.time()
       try:
-         #syslog.syslog(syslog.LOG_NOTICE, "Distributing event over the topic chain '%s': %s." % esc(", ".join(topic_chain), obj_raw))
-         all_interested_endpoints = sum(map(self.get_and_update_endpoints_by_topic, topic_chain), [])
-         endpoints = set(all_interested_endpoints)
+         metrics = self._thread_metrics()
+         began = tracing.begin() if tracing.active else None
+         endpoints = self.subscriptions.subscribers_of(topic)
+         if self.filtered_subscriptions:
+            endpoints = self._apply_filters(endpoints, obj_raw, metrics)
          #syslog.syslog(syslog.LOG_NOTICE, "There are %i subscribed in total." % esc(len(endpoints)))
+         if began is not None:
+            tracing.end("notifier.distribute.lookup", began)
          
+         began = tracing.begin() if tracing.active else None
+         event = _EncodedEvent(topic, obj_raw)   # encoded once, shared by all
+         fanout = 0
          for endpoint in endpoints:
-            endpoint.send_event(topic, obj_raw)
+            if not endpoint.is_finished and not (from_peer and endpoint.is_peer):
+               endpoint.send_event(event)
+               fanout += 1
+
+         if began is not None:
+            tracing.end("notifier.distribute.enqueue", began)
+
+         metrics.count_event(topic, len(obj_raw), fanout)
+         metrics.count_distribution(time.time() - begin)
 
       except:
          syslog.syslog(syslog.LOG_ERR, "Exception in the distribution: %s" % esc(traceback.format_exc()))
 
-      finally:
-         self.endpoint_subscription_lock.release()
+   def distribute_events(self, events, from_peer=False):
+      ''' Distribute a batch of events: each subscriber receives the events
+          that it is interested in, in the same order, packed in batches too. '''
+      begin = time.time()
+      events_by_endpoint = {}
+      try:
+         metrics = self._thread_metrics()
+         began = tracing.begin() if tracing.active else None
+         for topic, obj_raw in events:
+            self._safe_topics.validate(topic)
 
-      if self.show_stats:
-         self.show_endpoints_and_subscriptions()
+            endpoints = self.subscriptions.subscribers_of(topic)
+            if self.filtered_subscriptions:
+               endpoints = self._apply_filters(endpoints, obj_raw, metrics)
 
-   def register_subscriber(self, topic, endpoint):
-      self.endpoint_subscription_lock.acquire()
-      try:
-         if topic in self.endpoints_by_topic:
-            self.endpoints_by_topic[topic].append(endpoint)
+            fanout = 0
+            for endpoint in endpoints:
+               if from_peer and endpoint.is_peer:
+                  continue
+
+               fanout += 1
+               if endpoint in events_by_endpoint:
+                  events_by_endpoint[endpoint].append((topic, obj_raw))
+               else:
+                  events_by_endpoint[endpoint] = [(topic, obj_raw)]
+
+            metrics.count_event(topic, len(obj_raw), fanout)
+
+         if began is not None:
+            tracing.end("notifier.distribute.lookup", began)
+
+         began = tracing.begin() if tracing.active else None
+         for endpoint, events_of_endpoint in events_by_endpoint.items():
+            if not endpoint.is_finished:
+               endpoint.send_events(events_of_endpoint)
+
+         if began is not None:
+            tracing.end("notifier.distribute.enqueue", began)
+
+         metrics.count_distribution(time.time() - begin)
+
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Exception in the distribution: %s" % esc(traceback.format_exc()))
+
+   def _apply_filters(self, subscribers, obj_raw, metrics):
+      ''' Return the endpoints that receive the event: the subscribers
+          without a filter and the endpoints of the filtered subscribers
+          whose filter matches the object of the event. The object is
+          unpacked only if a filter must be evaluated, and only once, and
+          each distinct filter is evaluated once. '''
+      endpoints = set()
+      filtered = []
+      for subscriber in subscribers:
+         if isinstance(subscriber, _FilteredSubscriber):
+            filtered.append(subscriber)
+         else:
+            endpoints.add(subscriber)
+
+      if not filtered:
+         return subscribers
+
+      obj = unpacked = None
+      matched_by_filter = {}
+      rejected = set()
+      for subscriber in filtered:
+         endpoint = subscriber.endpoint
+         if endpoint in endpoints:
+            continue
+
+         matched = matched_by_filter.get(subscriber.filter)
+         if matched is None:
+            if unpacked is None:
+               metrics.payloads_unpacked += 1
+               try:
+                  obj = unpack_object(obj_raw, content_typed=True)
+                  unpacked = True
+               except Exception:
+                  unpacked = False   # no filter matches an object that cannot be unpacked
+
+            matched = matched_by_filter[subscriber.filter] = unpacked and subscriber.filter.matches(obj)
+
+         if matched:
+            endpoints.add(endpoint)
+            rejected.discard(endpoint)
          else:
-            self.endpoints_by_topic[topic] = [endpoint]
+            rejected.add(endpoint)
 
-      finally:
-         self.endpoint_subscription_lock.release()
+      metrics.filtered_out += len(rejected)
+      return endpoints
 
-      if self.show_stats:
-         self.show_endpoints_and_subscriptions()
+   def retain_and_distribute_event(self, topic, obj_raw, from_peer=False):
+      ''' Retain the event as the last one of its topic and distribute it.
+          The peers retain it too so they receive it even if none of their
+          endpoints is subscribed to the topic.
+
+          The event is retained under the lock of the retained events but
+          it is distributed after releasing it because a full outbound
+          queue can block the distribution. An endpoint that is subscribing
+          meanwhile receives it from the store and then maybe once more
+          (see register_subscriber).
+          The retain and the distribution of the same topic are serialized
+          by the lock of its stripe so the last event distributed is always
+          the one left in the store. '''
+      self._safe_topics.validate(topic)
+      with self._retain_stripe(topic):
+         with self.retained.lock:
+            self.retained.retain(topic, obj_raw)
+
+         # from_peer=True so it is not sent to the peers as a regular event
+         self.distribute_event(topic, obj_raw, from_peer=True)
+         if not from_peer:
+            for peer in list(self.peers):
+               if not peer.is_finished:
+                  peer._queue_frame(self._retained_frame_for(peer, topic, obj_raw))
+
+   def _retain_stripe(self, topic):
+      # a lock per topic would have to be forgotten with its topic; the
+      # topics share a few locks instead and a blocked distribution delays
+      # only the retained events of the topics of its stripe
+      return self._retain_locks[(zlib.crc32(topic) & 0xffffffff) % len(self._retain_locks)]
+
+   def _send_retained_events(self, topic, endpoint, subscription_filter=None):
+      # the caller holds the lock of the retained events so they are
+      # queued as control frames: they never block, and they are bounded
+      # by the store anyway
+      events = self.retained.events_of(topic)
+      if subscription_filter is not None:
+         events = [(t, obj_raw) for t, obj_raw in events if self._retained_matches(subscription_filter, obj_raw)]
+
+      if events and not endpoint.is_finished:
+         endpoint.send_events(events, control=True)
+
+   def _retained_matches(self, subscription_filter, obj_raw):
+      try:
+         return subscription_filter.matches(unpack_object(obj_raw, content_typed=True))
+      except Exception:
+         return False
+
+   def register_subscriber(self, topic, endpoint):
+      ''' Subscribe the endpoint to the topic and send it the retained
+          events of the topic and of its subtopics. '''
+      with self.retained.lock:
+         with self.peers_lock:
+            self.subscriptions.subscribe(topic, endpoint)
+            if self.peers and not endpoint.is_peer:
+               self._propagate_subscriptions({topic: 1})
+
+         # the peers receive the retained events as they are published
+         if not endpoint.is_peer:
+            self._send_retained_events(topic, endpoint)
    
    def unsubscribe_me(self, topic, endpoint):
-      self.endpoint_subscription_lock.acquire()
       try:
-         if topic not in self.endpoints_by_topic:
-            syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' but no one is subscribed to that topic!" % esc(topic if topic else "(the empty topic)"))
-            
+         with self.peers_lock:
+            self.subscriptions.unsubscribe(topic, endpoint)
+            if self.peers and not endpoint.is_peer:
+               self._propagate_subscriptions({topic: -1})
+
+      except KeyError:
+         syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' but no one is subscribed to that topic!" % esc(topic if topic else "(the empty topic)"))
+
+      except ValueError:
+         syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' an endpoint that it is not subscribed to that topic!" % esc(topic if topic else "(the empty topic)"))
+
+   def register_filtered_subscriber(self, topic, filter_raw, endpoint):
+      ''' Subscribe the endpoint to the events of the topic whose object
+          matches the filter, its json (see filters). The peers are told
+          about the topic only: the events are filtered here. '''
+      with self.retained.lock:
+         with self.peers_lock:
+            try:
+               compiled = self._filters.compile(filter_raw)
+            except Exception as ex:
+               endpoint._log(syslog.LOG_ERR, "Subscription to the topic '%s' ignored: %s" % esc(topic if topic else "(the empty topic)", str(ex)))
+               return
+
+            subscribers = self._filtered_by_endpoint.setdefault(endpoint, {})
+            subscriber = subscribers.get(filter_raw)
+            if subscriber is None:
+               subscriber = subscribers[filter_raw] = _FilteredSubscriber(endpoint, compiled)
+
+            # counted before it is published so the distribution applies its filter
+            self.filtered_subscriptions += 1
+            self.subscriptions.subscribe(topic, subscriber)
+            if self.peers and not endpoint.is_peer:
+               self._propagate_subscriptions({topic: 1})
+
+         if not endpoint.is_peer:
+            self._send_retained_events(topic, endpoint, compiled)
+
+   def unsubscribe_filtered(self, topic, filter_raw, endpoint):
+      try:
+         with self.peers_lock:
+            subscribers = self._filtered_by_endpoint.get(endpoint, {})
+            subscriber = subscribers[filter_raw]
+            self.subscriptions.unsubscribe(topic, subscriber)
+            self.filtered_subscriptions -= 1
+
+            if subscriber not in self.subscriptions.topics_by_endpoint:
+               del subscribers[filter_raw]
+               if not subscribers:
+                  del self._filtered_by_endpoint[endpoint]
+
+            if self.peers and not endpoint.is_peer:
+               self._propagate_subscriptions({topic: -1})
+
+      except KeyError:
+         syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' with the filter '%s' but no one is subscribed to that topic with it!" % esc(topic if topic else "(the empty topic)", filter_raw))
+
+      except ValueError:
+         syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' with the filter '%s' an endpoint that it is not subscribed to that topic with it!" % esc(topic if topic else "(the empty topic)", filter_raw))
+
+   def forget_subscriptions_of(self, endpoint):
+      ''' Remove all the subscriptions of a dead endpoint, the filtered
+          ones included. '''
+      with self.peers_lock:
+         topics = {}
+         removed = 0
+         for subscriber in [endpoint] + list(self._filtered_by_endpoint.pop(endpoint, {}).values()):
+            for topic, n in self.subscriptions.topics_by_endpoint.get(subscriber, {}).items():
+               topics[topic] = topics.get(topic, 0) + n
+
+            n = self.subscriptions.remove_endpoint(subscriber)
+            if subscriber is not endpoint:
+               self.filtered_subscriptions -= n
+
+            removed += n
+
+         if removed and self.peers and not endpoint.is_peer:
+            self._propagate_subscriptions(dict((topic, -n) for topic, n in topics.items()))
+
+      if removed:
+         self.count('subscriptions_removed', removed)
+
+      if endpoint.is_peer:
+         self._forget_peer(endpoint)
+
+   def _propagate_subscriptions(self, deltas):
+      # tell the peers when the first local endpoint subscribes to a
+      # topic and when the last one unsubscribes from it
+      # (the caller holds the peers_lock)
+      changes = []
+      for topic, delta in deltas.items():
+         before = self.local_subscriptions.get(topic, 0)
+         after = before + delta
+         if after > 0:
+            self.local_subscriptions[topic] = after
          else:
-            endpoints_subscribed = self.endpoints_by_topic[topic]
+            self.local_subscriptions.pop(topic, None)
+
+         if before == 0 and after > 0:
+            changes.append(("subscribe", topic))
+         elif before > 0 and after <= 0:
+            changes.append(("unsubscribe", topic))
+
+      if changes:
+         for peer in self.peers:
+            peer._queue_frame((b"".join(pack_message(message_type=message_type, topic=topic, protocol_version=peer.protocol_version)
+                                    for message_type, topic in changes),), control=True)
+
+   def _add_peer(self, peer):
+      # a new peer learns all the topics of the local endpoints and the
+      # retained events
+      with self.retained.lock:
+         with self.peers_lock:
+            self.peers.append(peer)
+
+            topics = sorted(self.local_subscriptions)
+            for i in range(0, len(topics), 1024):
+               peer._queue_frame((pack_message(message_type="subscribe_many", topics=topics[i:i+1024], protocol_version=peer.protocol_version),), control=True)
+
+         if supports_retained(peer.protocol_version):
+            for topic, obj_raw in self.retained.events_of(b""):
+               peer._queue_frame(self._retained_frame_for(peer, topic, obj_raw), control=True)
+
+      if peer.peer_id is not None:
+         self._drop_duplicated_bridges(peer.peer_id)
+
+   def _retained_frame_for(self, peer, topic, obj_raw):
+      # the peers of the version 7 of the protocol or older (bridges with
+      # older notifiers) receive the event but they cannot retain it
+      message_type = "publish_retained" if supports_retained(peer.protocol_version) else "publish"
+      return (pack_message(message_type=message_type, topic=topic, obj=obj_raw, dont_pack_object=True, protocol_version=peer.protocol_version),)
+
+   def sync_with_peers(self, endpoint, cookie):
+      ''' Answer the sync of the endpoint once all the peers processed
+          the subscriptions propagated to them before. '''
+      with self.peers_lock:
+         sync_id = next(self._sync_ids) & 0xffffffff
+         self._pending_syncs[sync_id] = (endpoint, cookie, set(self.peers))
+
+         for peer in self.peers:
+            peer._queue_frame((pack_message(message_type="sync", cookie=sync_id, protocol_version=peer.protocol_version),), control=True)
+
+   def peer_synced(self, peer, sync_id):
+      with self.peers_lock:
+         pending = self._pending_syncs.get(sync_id)
+         if pending is None:
+            return
+
+         pending[2].discard(peer)
+         if pending[2]:
+            return
+
+         del self._pending_syncs[sync_id]
+
+      self._answer_sync(*pending[:2])
+
+   def _forget_peer(self, peer):
+      with self.peers_lock:
+         if peer not in self.peers:
+            return
+
+         log_type = syslog.LOG_NOTICE if self._shutting_down_gracefully else syslog.LOG_ERR
+         syslog.syslog(log_type, "Lost the link with a peer: %s." % esc(repr(peer)))
+         self.peers.remove(peer)
+
+         # don't wait for a dead peer
+         answered = []
+         for sync_id, (endpoint, cookie, waiting_for) in list(self._pending_syncs.items()):
+            waiting_for.discard(peer)
+            if not waiting_for:
+               del self._pending_syncs[sync_id]
+               answered.append((endpoint, cookie))
+
+      for endpoint, cookie in answered:
+         self._answer_sync(endpoint, cookie)
+
+   def _answer_sync(self, endpoint, cookie):
+      if not endpoint.is_finished:
+         endpoint._queue_frame((pack_message(message_type="synced", cookie=cookie, protocol_version=endpoint.protocol_version),), control=True)
+
+   def accept_bridge(self, endpoint, name):
+      ''' The endpoint is another notifier that keeps a bridge with this
+          one: from now on it is a peer. '''
+      if self.workers > 1:
+         endpoint._log(syslog.LOG_ERR, "A notifier with several workers cannot be bridged with other notifiers.")
+         raise Exception("Unexpected bridge.")
+
+      if not supports_bridges(endpoint.protocol_version) or endpoint.is_peer:
+         endpoint._log(syslog.LOG_ERR, "Unexpected bridge (protocol version %i)." % esc(endpoint.protocol_version))
+         raise Exception("Unexpected bridge.")
+
+      endpoint.name = name
+      endpoint.is_peer = True
+      endpoint.peer_id = endpoint.bridge_initiator = to_text(name)
+      self._bound_bridge_queue(endpoint)
+      endpoint._log(syslog.LOG_NOTICE, "Bridged with the notifier '%s'." % esc(name))
+
+      # tell the other notifier who we are
+      if supports_bridge_ids(endpoint.protocol_version):
+         endpoint._queue_frame((pack_message(message_type="bridge", name=to_bytes(self.bridge_id), protocol_version=endpoint.protocol_version),), control=True)
+
+      self._add_peer(endpoint)
+
+   def bridge_answered(self, endpoint, name):
+      ''' The notifier to which we bridged (see _connect_bridge) told us
+          its id. '''
+      if endpoint.peer_id is not None or self.workers > 1:
+         endpoint._log(syslog.LOG_ERR, "Unexpected bridge (it is already a peer).")
+         raise Exception("Unexpected bridge.")
+
+      endpoint.bridge_initiator = self.bridge_id
+      endpoint.peer_id = to_text(name)
+      endpoint._log(syslog.LOG_NOTICE, "Bridged with the notifier '%s'." % esc(name))
+
+      with self.peers_lock:
+         added = endpoint in self.peers
+
+      if added:
+         self._drop_duplicated_bridges(endpoint.peer_id)   # else _add_peer does it
+
+   def _drop_duplicated_bridges(self, peer_id):
+      # two bridges with the same notifier would deliver each event twice:
+      # both notifiers keep the one initiated by the notifier of the lowest
+      # id (the first one if both were initiated by the same notifier)
+      with self.peers_lock:
+         bridges = [peer for peer in self.peers if peer.peer_id == peer_id and not peer.is_finished]
+         if len(bridges) < 2:
+            return
+
+         kept = min(bridges, key=lambda peer: peer.bridge_initiator)
+
+      for peer in bridges:
+         if peer is not kept:
+            peer._log(syslog.LOG_WARNING, "Duplicated bridge with the notifier '%s', closing it." % esc(peer_id))
+            peer.is_finished = True
+            self.forget_subscriptions_of(peer)
+
+   def _is_bridged_with(self, peer_id):
+      with self.peers_lock:
+         return any(peer.peer_id == peer_id and not peer.is_finished for peer in self.peers)
+
+   def _keep_bridges(self):
+      bridged = {}   # address -> its endpoint
+      while True:
+         for address in self.bridges:
+            endpoint = bridged.get(address)
+            if endpoint is not None and (not endpoint.is_finished or (endpoint.peer_id is not None and self._is_bridged_with(endpoint.peer_id))):
+               continue   # alive or a duplicate of a bridge initiated by the other notifier
 
             try:
-               endpoints_subscribed.remove(endpoint)
-            except ValueError:
-               syslog.syslog(syslog.LOG_ERR, "Trying to unsubscribe from the topic '%s' an endpoint that it is not subscribed to that topic!" % esc(topic if topic else "(the empty topic)"))
+               bridged[address] = self._connect_bridge(address)
+            except:
+               syslog.syslog(syslog.LOG_WARNING, "Cannot bridge with the notifier at %s, retrying in %s secs: %s" % esc(str(address), self.bridge_retry_interval, traceback.format_exc()))
 
-            if not endpoints_subscribed:
-               del self.endpoints_by_topic[topic]  # if it is empty, remove it
+         if self._sweeper_stop.wait(self.bridge_retry_interval):
+            break
 
-      finally:
-         self.endpoint_subscription_lock.release()
+   def _connect_bridge(self, address):
+      ''' Connect to the notifier at the address and tell it that the
+          connection is a bridge between both (the 'bridge' message).
+          Return the endpoint of the new peer. '''
+      family, sockaddr = parse_address(address)
+      sock = socket.socket(family, socket.SOCK_STREAM)
+      try:
+         sock.settimeout(10)
+         sock.connect(sockaddr)
+
+         # the hello and the welcome are framed as in the version 1
+         sock.sendall(pack_message(message_type="hello", name=to_bytes(self.name), max_protocol_version=ProtocolVersion))
+         message_type, message_body_len = unpack_message_header(_recv_exactly(sock, HeaderLenByVersion[1]), 1)
+         message_body = _recv_exactly(sock, message_body_len)
+         if message_type != "welcome":
+            raise Exception("Unexpected message '%s' instead of the welcome." % message_type)
+
+         # the older notifiers are bridged with their version of the protocol
+         protocol_version = unpack_message_body(message_type, message_body)
+         if not supports_bridges(protocol_version):
+            raise Exception("The notifier uses the version %i of the protocol, the bridges require the version 6 or higher." % protocol_version)
+
+         sock.sendall(pack_message(message_type="bridge", name=to_bytes(self.bridge_id), protocol_version=protocol_version))
+         sock.settimeout(None)
+      except:
+         sock.close()
+         raise
 
-      if self.show_stats:
-         self.show_endpoints_and_subscriptions()
+      codename = "Bridge to %s" % (address if family != socket.AF_INET else "%s:%s" % sockaddr)
+      syslog.syslog(syslog.LOG_NOTICE, "New endpoint connected: %s." % esc(codename))
+
+      self._enable_tcp_keepalive(sock)
+      return self._attach(sock, codename, peer=True, protocol_version=protocol_version, bridge=True)
+
+   def reaping_stats(self):
+      ''' Return the counters of the reaping of the dead endpoints: how many
+          periodic sweeps were done, how many endpoints were reaped and how
+          many subscriptions were removed because of them; and of the
+          keepalive: how many pings were sent and how many idle endpoints
+          were disconnected. '''
+      with self.stats_lock:
+         return dict(self.reaping_counters)
 
    def close(self):
       if self.socket:
          syslog.syslog(syslog.LOG_NOTICE, "Shutting down 'publish/subscribe notifier' daemon.")
+         # the listening socket is shared by the workers: each one
+         # unblocks its own accept() (see _stop_worker)
          try:
-            self.socket.shutdown(socket.SHUT_RDWR)
+            if self.worker_id is None and not self.worker_pids:
+               self.socket.shutdown(socket.SHUT_RDWR)
          except:
             syslog.syslog(syslog.LOG_ERR, "Error in the shutdown: '%s'" % esc(traceback.format_exc()))
 
@@ -269,11 +1873,26 @@ class Notifier(Daemon):
             syslog.syslog(syslog.LOG_ERR, "Error in the close: '%s'" % esc(traceback.format_exc()))
 
          self.socket = None
+         self._sweeper_stop.set()
+         for thread in (self._sweeper, self._bridger):
+            if thread and thread is not threading.current_thread():
+               thread.join()
+
+         family, address = parse_address(self.address)
+         if family != socket.AF_INET and self.worker_id is None:
+            self._remove_stale_unix_socket(address)
 
-         for e in self.endpoints:
+         for e in list(self.endpoints):
             e.close()
             e.join()
 
+         if self.poller:
+            self.poller.close()
+            self.poller = None
+
+         if self.sampler:
+            tracing.stop_sampling(self.sampler)
+
          syslog.syslog(syslog.LOG_NOTICE, "Shutdown 'publish/subscribe notifier' daemon.")
 
    def signal_terminate_handler(self, sig_num, stack_frame):
@@ -282,28 +1901,108 @@ class Notifier(Daemon):
       except:
          pass
 
-   def show_endpoints_and_subscriptions(self):
-      import pprint
+   def outbound_queue_stats(self):
+      ''' Return the counters of the outbound queue of each endpoint
+          (see _OutboundQueue.stats) keyed by the endpoint's description. '''
+      return dict((repr(endpoint), endpoint.outbound.stats()) for endpoint in list(self.endpoints))
 
-      self.endpoint_subscription_lock.acquire()
+   def _thread_metrics(self):
+      ''' Return the _Metrics of the calling thread, only this thread updates them. '''
       try:
-         with open(self.stats_file, 'w') as out:
-            topics = sorted(self.endpoints_by_topic.keys())
-            endpoints = sorted(list(set(sum(self.endpoints_by_topic.values(), []))))
-            
-            out.write("Subcriptions:\n=============\n")
-            for endpoint in endpoints:
-               out.write(repr(endpoint))
-               out.write(": ")
-               out.write(", ".join(
-                  map(lambda topic: "<any>" if not topic else topic, 
-                     filter(lambda topic: endpoint in self.endpoints_by_topic[topic], topics))))
-               out.write("\n")
+         return self._metrics_local.metrics
+      except AttributeError:
+         metrics = self._metrics_local.metrics = _Metrics()
+         with self._metrics_lock:
+            self._metrics_of_threads.append((threading.current_thread(), metrics))
+         return metrics
+
+   def metrics(self):
+      ''' Return a snapshot of the metrics of the notifier, json-friendly:
+          the counters of the distribution (see _Metrics) of all the
+          threads, the outbound queue of each endpoint (see
+          outbound_queue_stats), the reaping counters (see reaping_stats)
+          and the histograms of the sampled stages (see tracing.Sampler). '''
+      with self._metrics_lock:
+         total = _Metrics()
+         alive = []
+         for thread, metrics in self._metrics_of_threads:
+            if thread.is_alive():
+               alive.append((thread, metrics))
+               total.merge(metrics)
+            else:
+               self._metrics_of_dead_threads.merge(metrics)
+
+         self._metrics_of_threads = alive
+         total.merge(self._metrics_of_dead_threads)
+
+      snapshot = total.as_dict()
+      snapshot.update({
+            'address': str(self.address),
+            'worker': self.worker_id,
+            'time': time.time(),
+            'uptime': time.time() - self.started_at,
+            'endpoints': len(self.endpoints),
+            'peers': len(self.peers),
+            'outbound_queues': self.outbound_queue_stats(),
+            'reaping': self.reaping_stats(),
+            'tracing': self.sampler.as_dict() if self.sampler else None,
+            'retained': self.retained.stats(),
+            })
+      return snapshot
+
+   def refresh_metrics(self):
+      ''' Publish the metrics on the MetricsTopic (if anybody is subscribed)
+          and write the stats file (if show_stats). It is called every
+          'metrics_interval' secs by the sweeper or the event loop. '''
+      self._next_metrics = time.time() + self.metrics_interval
+      try:
+         if self.subscriptions.subscribers_of(MetricsTopic):
+            self.distribute_event(MetricsTopic, pack_object(self.metrics(), "json"))
 
-      finally:
-         self.endpoint_subscription_lock.release()
+         if self.show_stats:
+            self.show_endpoints_and_subscriptions()
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Exception when refreshing the metrics: %s" % esc(traceback.format_exc()))
+
+   def show_endpoints_and_subscriptions(self):
+      ''' Write the subscriptions and the metrics in the stats file. The file
+          is replaced at once so it is never seen half written. '''
+      topics_by_endpoint = {}
+      for topic, endpoints in self.subscriptions.subscriptions():
+         for endpoint in set(endpoints):
+            topics_by_endpoint.setdefault(endpoint, []).append("<any>" if not topic else topic.decode("ascii"))
+
+      metrics = self.metrics()
+
+      tmp_file = "%s.tmp" % self.stats_file
+      with open(tmp_file, 'w') as out:
+         out.write("Subcriptions:\n=============\n")
+         for endpoint in sorted(topics_by_endpoint, key=repr):
+            out.write(repr(endpoint))
+            out.write(": ")
+            out.write(", ".join(sorted(topics_by_endpoint[endpoint])))
+            out.write("\n")
+
+         out.write("\nOutbound queues:\n================\n")
+         for endpoint, stats in sorted(metrics['outbound_queues'].items()):
+            out.write("%s: %s\n" % (endpoint, ", ".join("%s=%i" % item for item in sorted(stats.items()))))
+
+         out.write("\nReaping:\n========\n")
+         out.write("%s\n" % ", ".join("%s=%i" % item for item in sorted(metrics['reaping'].items())))
+
+         out.write("\nRetained:\n=========\n")
+         out.write("%s\n" % ", ".join("%s=%i" % item for item in sorted(metrics['retained'].items())))
+
+         out.write("\nEvents by prefix:\n=================\n")
+         for prefix in sorted(metrics['events_in']):
+            out.write("%s: %s\n" % (prefix, ", ".join("%s=%i" % (name, metrics[name][prefix]) for name in ("events_in", "bytes_in", "events_out", "bytes_out"))))
+
+         out.write("\nHistograms (upper bound: count):\n================================\n")
+         for name in ("fanout", "distribution_us"):
+            out.write("%s: %s\n" % (name, ", ".join("<%i: %i" % tuple(bucket) for bucket in metrics[name])))
+
+      os.rename(tmp_file, self.stats_file)
 
-      
 
 def main():
    import sys, os
@@ -331,14 +2030,43 @@ def main():
    else:
       stats_file = None
 
+   # an address like unix:/path is a Unix domain socket, the port is ignored
+   address = config.get("notifier", 'wait_on_address')
+   if not address.startswith(UnixAddressPrefix):
+      address = (address, config.getint("notifier", 'wait_on_port'))
+
+   # the addresses of the notifiers to bridge with: host:port or unix:/path
+   bridges = []
+   for bridge in config.get("notifier", 'bridges').split(","):
+      bridge = bridge.strip()
+      if bridge and not bridge.startswith(UnixAddressPrefix):
+         host, port = bridge.rsplit(":", 1)
+         bridge = (host, int(port))
+
+      if bridge:
+         bridges.append(bridge)
+
    notifier = Notifier(
-         address = (config.get("notifier", 'wait_on_address'), config.getint("notifier", 'wait_on_port')),
+         address = address,
          pidfile = pid_file,
          name = config.get("notifier", 'name'),
          foreground = config.getboolean("notifier", 'foreground'),
          listen_queue_len = config.getint("notifier", 'listen_queue_len'),
          show_stats = show_stats,
-         stats_file = stats_file
+         stats_file = stats_file,
+         engine = config.get("notifier", "engine"),
+         outbound_queue_len = config.getint("notifier", "outbound_queue_len"),
+         outbound_queue_overflow = config.get("notifier", "outbound_queue_overflow"),
+         reap_interval = config.getfloat("notifier", "reap_interval"),
+         keepalive_interval = config.getfloat("notifier", "keepalive_interval"),
+         idle_timeout = config.getfloat("notifier", "idle_timeout"),
+         workers = config.getint("notifier", "workers"),
+         bridges = bridges,
+         metrics_interval = config.getfloat("notifier", "metrics_interval"),
+         tracing_sample_every = config.getint("notifier", "tracing_sample_every"),
+         retained_max_bytes = config.getint("notifier", "retained_max_bytes"),
+         bridge_queue_len = config.getint("notifier", "bridge_queue_len"),
+         max_message_bytes = config.getint("notifier", "max_message_bytes")
          )
 
    notifier.do_from_arg(sys.argv[1] if len(sys.argv) == 2 else None)
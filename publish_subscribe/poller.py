@@ -0,0 +1,48 @@
+import select, errno
+
+READ  = select.POLLIN
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+class Poller(object):
+   ''' Thin wrapper around epoll (or poll if epoll is not available)
+       so the event loop of the notifier sees the same interface in
+       both cases.
+
+       The event masks READ, WRITE and ERROR have the same values for
+       poll and epoll so they can be used with any of them.
+       '''
+   def __init__(self):
+      if hasattr(select, "epoll"):
+         self._poller = select.epoll()
+         self._timeout_scale = 1      # epoll's timeout is in seconds
+      else:
+         self._poller = select.poll()
+         self._timeout_scale = 1000   # poll's timeout is in milliseconds
+
+      self.register = self._poller.register
+      self.modify = self._poller.modify
+      self.unregister = self._poller.unregister
+
+   def poll(self, timeout):
+      ''' Wait at most 'timeout' seconds and return a list of
+          (fileno, event mask) tuples. '''
+      try:
+         return self._poller.poll(timeout * self._timeout_scale)
+      except (select.error, IOError, OSError) as e:
+         # interrupted by a signal (python 2.x doesn't retry)
+         if e.args and e.args[0] == errno.EINTR:
+            return []
+         raise
+
+   def close(self):
+      if hasattr(self._poller, "close"):
+         self._poller.close()
+
+def ready_now(fileno, mask):
+   ''' Return which events of the mask are ready now in the file, without
+       waiting for them. '''
+   poller = select.poll()
+   poller.register(fileno, mask)
+   ready = poller.poll(0)
+   return (ready[0][1] & mask) if ready else 0
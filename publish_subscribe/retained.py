@@ -0,0 +1,109 @@
+import threading, collections, bisect
+from .topic import is_pattern, compile_pattern
+from .message import pack_object
+
+# a retained event with a null object clears the retained event of its topic
+_NullObjects = (pack_object(None, "json"), pack_object(None, "msgpack"))
+
+# what an event costs besides its topic and its object, roughly: its entries
+# in the dict and in the sorted list of topics
+_EntryOverhead = 64
+
+def _size_of(topic, obj_raw):
+   return len(topic) + len(obj_raw) + _EntryOverhead
+
+class RetainedStore(object):
+   ''' The last event published with the retain flag on each topic, kept
+       so the endpoints that subscribe later receive it immediately (the
+       current state of a gdb, for example).
+
+       The store is bounded by the bytes of the retained events, their
+       topics and objects plus a fixed overhead per event: when a new
+       event doesn't fit, the events retained the longest time ago
+       (updated the longest time ago) are evicted. An event larger than
+       'max_bytes' is never retained and a 'max_bytes' of 0 disables the
+       store.
+
+       The objects are kept as they were received, prefixed by their
+       content type, and never unpacked.
+
+       The topics are kept sorted too so the events of a topic and of its
+       subtopics (the subtree of the topic) are found with a binary search:
+       the subtopics of 'foo' are between 'foo.' and 'foo/', the character
+       after the dot.
+
+       The caller holds the 'lock' (see Notifier.register_subscriber).
+       '''
+   def __init__(self, max_bytes=16*1024*1024):
+      self.max_bytes = max_bytes
+      self.lock = threading.RLock()
+
+      self.objects_by_topic = collections.OrderedDict()    # the oldest first
+      self.topics = []  # sorted
+      self.bytes = 0
+      self.evicted = 0
+
+   def retain(self, topic, obj_raw):
+      ''' Retain the object as the last one of the topic. A null object
+          clears the topic instead. '''
+      self._forget(topic)
+      size = _size_of(topic, obj_raw)
+      if obj_raw in _NullObjects or size > self.max_bytes:
+         return
+
+      while self.bytes + size > self.max_bytes:
+         oldest = next(iter(self.objects_by_topic))
+         self._forget(oldest)
+         self.evicted += 1
+
+      self.objects_by_topic[topic] = obj_raw
+      self.bytes += size
+      bisect.insort(self.topics, topic)
+
+   def _forget(self, topic):
+      obj_raw = self.objects_by_topic.pop(topic, None)
+      if obj_raw is None:
+         return
+
+      self.bytes -= _size_of(topic, obj_raw)
+      del self.topics[bisect.bisect_left(self.topics, topic)]
+
+   def events_of(self, topic):
+      ''' Return the retained events, (topic, obj_raw) pairs sorted by
+          topic, that a subscription to the topic would receive: the ones
+          of the topic and of its subtopics. The topic can be a pattern
+          (see topic.compile_pattern). '''
+      if is_pattern(topic):
+         # only the subtree of the subtopics before the first wildcard can match
+         prefix = []
+         for subtopic in topic.split(b"."):
+            if is_pattern(subtopic):
+               break
+            prefix.append(subtopic)
+
+         matches = compile_pattern(topic)
+         return [(t, obj_raw) for t, obj_raw in self.events_of(b".".join(prefix)) if matches(t)]
+
+      if not topic:
+         return [(t, self.objects_by_topic[t]) for t in self.topics]
+
+      topics = []
+      if topic in self.objects_by_topic:
+         topics.append(topic)
+
+      begin = bisect.bisect_left(self.topics, topic + b".")
+      end = bisect.bisect_left(self.topics, topic + b"/")
+      topics.extend(self.topics[begin:end])
+
+      return [(t, self.objects_by_topic[t]) for t in topics]
+
+   def __len__(self):
+      return len(self.objects_by_topic)
+
+   def stats(self):
+      return {
+            'topics': len(self.objects_by_topic),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted,
+            }
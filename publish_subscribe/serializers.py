@@ -0,0 +1,266 @@
+import struct, sys, collections
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from .esc import to_bytes, to_text
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+if sys.version_info.major < 3:
+    # in python 2.x the msgpack package packs the str objects as binary
+    # data while we pack them as text (like json does)
+    _msgpack = None
+    text_t, binary_t, integer_t = unicode, (bytearray,), (int, long)
+else:
+    text_t, binary_t, integer_t = str, (bytes, bytearray), (int,)
+
+# The serializers are identified in the wire by their content type, a
+# single byte that prefixes each serialized object (see message.pack_object).
+Serializer = collections.namedtuple("Serializer", ["name", "content_type", "dumps", "loads"])
+
+_serializers_by_name = {}
+_serializers_by_content_type = {}
+
+def register_serializer(name, content_type, dumps, loads):
+    ''' Register a serializer: 'dumps' takes an object and returns bytes
+        and 'loads' does the opposite. The 'content_type' must be a byte
+        not used by any other serializer. '''
+    if not (0 <= content_type <= 0xff):
+        raise ValueError("The content type must be a byte (0-255), not %i." % content_type)
+
+    if name in _serializers_by_name or content_type in _serializers_by_content_type:
+        raise ValueError("The serializer '%s' or the content type %i is already registered." % (name, content_type))
+
+    serializer = Serializer(name, content_type, dumps, loads)
+    _serializers_by_name[name] = _serializers_by_content_type[content_type] = serializer
+
+def serializer_by_name(name):
+    try:
+        return _serializers_by_name[name]
+    except KeyError:
+        raise ValueError("Unknown serializer '%s'. Known serializers: %s." % (name, ", ".join(sorted(_serializers_by_name))))
+
+def serializer_by_content_type(content_type):
+    try:
+        return _serializers_by_content_type[content_type]
+    except KeyError:
+        raise ValueError("Unknown content type %i." % content_type)
+
+
+def _json_dumps(obj):
+    return to_bytes(json.dumps(obj))
+
+def _json_loads(raw):
+    return json.loads(to_text(raw))
+
+
+# Compact binary serializer: a subset of MessagePack (nil, booleans,
+# integers up to 64 bits, doubles, text, binary data, arrays and maps)
+# implemented in pure python. If the msgpack package is installed, it is
+# used instead; the wire format is the same.
+_uint8, _uint16, _uint32, _uint64 = struct.Struct(">B"), struct.Struct(">H"), struct.Struct(">I"), struct.Struct(">Q")
+_int8, _int16, _int32, _int64 = struct.Struct(">b"), struct.Struct(">h"), struct.Struct(">i"), struct.Struct(">q")
+_float32, _float64 = struct.Struct(">f"), struct.Struct(">d")
+
+def _pack_length(parts, length, fix_op, fix_max, op8, op16, op32):
+    if length <= fix_max:
+        parts.append(_uint8.pack(fix_op | length))
+    elif op8 is not None and length <= 0xff:
+        parts.append(_uint8.pack(op8) + _uint8.pack(length))
+    elif length <= 0xffff:
+        parts.append(_uint8.pack(op16) + _uint16.pack(length))
+    elif length <= 0xffffffff:
+        parts.append(_uint8.pack(op32) + _uint32.pack(length))
+    else:
+        raise ValueError("Object too large to be serialized (%i items or bytes)." % length)
+
+_positive_fixints = [_uint8.pack(i) for i in range(0x80)]
+
+def _pack_obj(parts, obj):
+    # fast path for the most common objects in the debugger data
+    obj_t = type(obj)
+    if obj_t is int and 0 <= obj <= 0x7f:
+        parts.append(_positive_fixints[obj])
+
+    elif obj_t is list:
+        _pack_length(parts, len(obj), 0x90, 15, None, 0xdc, 0xdd)
+        for item in obj:
+            _pack_obj(parts, item)
+
+    elif obj is None:
+        parts.append(b"\xc0")
+
+    elif obj is True:
+        parts.append(b"\xc3")
+
+    elif obj is False:
+        parts.append(b"\xc2")
+
+    elif isinstance(obj, integer_t):
+        if 0 <= obj <= 0x7f:
+            parts.append(_uint8.pack(obj))
+        elif -32 <= obj < 0:
+            parts.append(_int8.pack(obj))
+        elif 0 <= obj <= 0xff:
+            parts.append(b"\xcc" + _uint8.pack(obj))
+        elif 0 <= obj <= 0xffff:
+            parts.append(b"\xcd" + _uint16.pack(obj))
+        elif 0 <= obj <= 0xffffffff:
+            parts.append(b"\xce" + _uint32.pack(obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            parts.append(b"\xcf" + _uint64.pack(obj))
+        elif -0x80 <= obj < 0:
+            parts.append(b"\xd0" + _int8.pack(obj))
+        elif -0x8000 <= obj < 0:
+            parts.append(b"\xd1" + _int16.pack(obj))
+        elif -0x80000000 <= obj < 0:
+            parts.append(b"\xd2" + _int32.pack(obj))
+        elif -0x8000000000000000 <= obj < 0:
+            parts.append(b"\xd3" + _int64.pack(obj))
+        else:
+            raise ValueError("Integer out of range to be serialized: %i." % obj)
+
+    elif isinstance(obj, float):
+        parts.append(b"\xcb" + _float64.pack(obj))
+
+    elif isinstance(obj, text_t) or (isinstance(obj, str) and str is bytes):
+        # in python 2.x a str is text (if it is not valid utf-8 text,
+        # this fails as json.dumps would do)
+        raw = obj.encode("utf-8") if isinstance(obj, text_t) else obj.decode("utf-8").encode("utf-8")
+        _pack_length(parts, len(raw), 0xa0, 31, 0xd9, 0xda, 0xdb)
+        parts.append(raw)
+
+    elif isinstance(obj, binary_t):
+        _pack_length(parts, len(obj), 0xc4, -1, 0xc4, 0xc5, 0xc6)
+        parts.append(bytes(obj))
+
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(parts, len(obj), 0x90, 15, None, 0xdc, 0xdd)
+        for item in obj:
+            _pack_obj(parts, item)
+
+    elif isinstance(obj, dict):
+        _pack_length(parts, len(obj), 0x80, 15, None, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack_obj(parts, key)
+            _pack_obj(parts, value)
+
+    else:
+        raise TypeError("Object of type '%s' cannot be serialized." % type(obj).__name__)
+
+def _pure_msgpack_dumps(obj):
+    parts = []
+    _pack_obj(parts, obj)
+    return b"".join(parts)
+
+
+_fixed_len_by_op = {
+        0xc4: _uint8, 0xc5: _uint16, 0xc6: _uint32,
+        0xd9: _uint8, 0xda: _uint16, 0xdb: _uint32,
+        0xdc: _uint16, 0xdd: _uint32,
+        0xde: _uint16, 0xdf: _uint32,
+        }
+
+_number_by_op = {
+        0xca: _float32, 0xcb: _float64,
+        0xcc: _uint8, 0xcd: _uint16, 0xce: _uint32, 0xcf: _uint64,
+        0xd0: _int8, 0xd1: _int16, 0xd2: _int32, 0xd3: _int64,
+        }
+
+def _unpack_obj(raw, offset):
+    op = raw[offset]
+    offset += 1
+
+    if op <= 0x7f:
+        return op, offset
+
+    if 0x90 <= op <= 0x9f:
+        return _unpack_array(raw, offset, op & 0x0f)
+
+    if op >= 0xe0:
+        return op - 0x100, offset
+
+    if 0x80 <= op <= 0x8f:
+        return _unpack_map(raw, offset, op & 0x0f)
+
+    if 0xa0 <= op <= 0xbf:
+        length = op & 0x1f
+        return raw[offset:offset+length].decode("utf-8"), offset + length
+
+    if op == 0xc0:
+        return None, offset
+
+    if op == 0xc2:
+        return False, offset
+
+    if op == 0xc3:
+        return True, offset
+
+    number = _number_by_op.get(op)
+    if number is not None:
+        return number.unpack_from(raw, offset)[0], offset + number.size
+
+    length_t = _fixed_len_by_op.get(op)
+    if length_t is None:
+        raise ValueError("Unsupported type 0x%02x at %i." % (op, offset-1))
+
+    length = length_t.unpack_from(raw, offset)[0]
+    offset += length_t.size
+
+    if op <= 0xc6:
+        return bytes(raw[offset:offset+length]), offset + length
+    elif op <= 0xdb:
+        return raw[offset:offset+length].decode("utf-8"), offset + length
+    elif op <= 0xdd:
+        return _unpack_array(raw, offset, length)
+    else:
+        return _unpack_map(raw, offset, length)
+
+def _unpack_array(raw, offset, length):
+    array = []
+    append = array.append
+    for i in range(length):
+        op = raw[offset]
+        if op <= 0x7f:      # positive fixint, inlined: arrays of bytes are common
+            append(op)
+            offset += 1
+        else:
+            item, offset = _unpack_obj(raw, offset)
+            append(item)
+
+    return array, offset
+
+def _unpack_map(raw, offset, length):
+    mapping = {}
+    for i in range(length):
+        key, offset = _unpack_obj(raw, offset)
+        value, offset = _unpack_obj(raw, offset)
+        mapping[key] = value
+
+    return mapping, offset
+
+def _pure_msgpack_loads(raw):
+    raw = bytearray(raw)  # index it as integers in python 2.x and 3.x
+    obj, offset = _unpack_obj(raw, 0)
+    if offset != len(raw):
+        raise ValueError("Extra data after the serialized object (%i bytes)." % (len(raw) - offset))
+
+    return obj
+
+if _msgpack is not None:
+    def _msgpack_dumps(obj):
+        return _msgpack.packb(obj, use_bin_type=True)
+
+    def _msgpack_loads(raw):
+        return _msgpack.unpackb(bytes(raw), raw=False, strict_map_key=False)
+else:
+    _msgpack_dumps, _msgpack_loads = _pure_msgpack_dumps, _pure_msgpack_loads
+
+
+register_serializer("json", 0x1, _json_dumps, _json_loads)
+register_serializer("msgpack", 0x2, _msgpack_dumps, _msgpack_loads)
@@ -0,0 +1,234 @@
+import threading
+from .topic import is_pattern, SingleLevelWildcard, MultiLevelWildcard
+
+class _TopicNode(object):
+   ''' A node of the trie. Once a node is reachable from a snapshot
+       it is never modified: a change creates a new node instead. '''
+   __slots__ = ("endpoints", "children")
+
+   def __init__(self, endpoints=(), children=None):
+      self.endpoints = endpoints                 # an endpoint can be subscribed more than once
+      self.children = children if children is not None else {}   # subtopic -> _TopicNode
+
+   def is_empty(self):
+      return not self.endpoints and not self.children
+
+
+class _Snapshot(object):
+   ''' An immutable version of the trie with its own cache of resolved
+       sets. The cache is filled lazily by the readers. '''
+   __slots__ = ("root", "resolved_by_topic", "has_patterns")
+
+   def __init__(self, root, has_patterns=False):
+      self.root = root
+      self.resolved_by_topic = {}
+      self.has_patterns = has_patterns    # any subscription with wildcards?
+
+
+class TopicIndex(object):
+   ''' Index of the endpoints subscribed to each topic.
+
+       The topics are stored in a trie with one level per subtopic (the
+       root is the empty topic) so the endpoints interested in a topic,
+       the ones subscribed to the topic or to any of its prefixes (see
+       build_topic_chain), are collected in a single walk.
+
+       The trie is copy-on-write: a change of the subscriptions copies
+       the nodes from the root to the changed node and swaps the whole
+       snapshot at once. The readers (subscribers_of) take the current
+       snapshot and never lock; only the writers are serialized.
+
+       The resolved set of endpoints is cached per topic in the snapshot
+       so any subscription, unsubscription or removal of an endpoint
+       starts with an empty cache.
+
+       The topics of each endpoint are indexed too so all the
+       subscriptions of an endpoint are removed walking only its topics.
+
+       The wildcards of the patterns (see topic.compile_pattern) are
+       subtopics of the trie too: '*' and '#'. While there is any pattern
+       the walk follows every branch that matches, not only one.
+       '''
+   def __init__(self, cache_max_len=4096):
+      self.snapshot = _Snapshot(_TopicNode())
+      self.cache_max_len = cache_max_len
+      self._write_lock = threading.Lock()
+
+      # endpoint -> {topic: how many times it is subscribed to it}
+      self.topics_by_endpoint = {}
+
+      # how many of the subscriptions are to patterns
+      self.pattern_subscriptions = 0
+
+   @property
+   def root(self):
+      return self.snapshot.root
+
+   def subscribe(self, topic, endpoint):
+      with self._write_lock:
+         subtopics = topic.split(b".") if topic else []
+         path = self._path_to(subtopics, create=True)
+
+         leaf = path[-1]
+         new_leaf = _TopicNode(leaf.endpoints + (endpoint,), leaf.children)
+
+         if is_pattern(topic):
+            self.pattern_subscriptions += 1
+
+         self.snapshot = _Snapshot(self._swap(path, subtopics, new_leaf), self.pattern_subscriptions > 0)
+
+         topics = self.topics_by_endpoint.setdefault(endpoint, {})
+         topics[topic] = topics.get(topic, 0) + 1
+
+   def unsubscribe(self, topic, endpoint):
+      ''' Remove one subscription of the endpoint to the topic.
+          Raise KeyError if nobody is subscribed to the topic or
+          ValueError if the endpoint is not subscribed to it. '''
+      with self._write_lock:
+         subtopics = topic.split(b".") if topic else []
+         path = self._path_to(subtopics, create=False)
+
+         leaf = path[-1]
+         if not leaf.endpoints:
+            raise KeyError(topic)
+
+         endpoints = list(leaf.endpoints)
+         endpoints.remove(endpoint)
+         new_leaf = _TopicNode(tuple(endpoints), leaf.children)
+
+         if is_pattern(topic):
+            self.pattern_subscriptions -= 1
+
+         self.snapshot = _Snapshot(self._swap(path, subtopics, new_leaf), self.pattern_subscriptions > 0)
+
+         topics = self.topics_by_endpoint[endpoint]
+         topics[topic] -= 1
+         if not topics[topic]:
+            del topics[topic]
+            if not topics:
+               del self.topics_by_endpoint[endpoint]
+
+   def remove_endpoint(self, endpoint):
+      ''' Remove all the subscriptions of the endpoint, walking only the
+          topics to which it is subscribed. Return how many subscriptions
+          were removed. '''
+      with self._write_lock:
+         topics = self.topics_by_endpoint.pop(endpoint, None)
+         if not topics:
+            return 0
+
+         # the changes are applied to a private copy of the trie and the
+         # readers see all of them at once
+         root = self.snapshot.root
+         for topic in topics:
+            subtopics = topic.split(b".") if topic else []
+            path = self._path_to(subtopics, create=False, root=root)
+
+            leaf = path[-1]
+            new_leaf = _TopicNode(tuple(e for e in leaf.endpoints if e is not endpoint), leaf.children)
+            root = self._swap(path, subtopics, new_leaf)
+
+            if is_pattern(topic):
+               self.pattern_subscriptions -= topics[topic]
+
+         self.snapshot = _Snapshot(root, self.pattern_subscriptions > 0)
+         return sum(topics.values())
+
+   def _path_to(self, subtopics, create, root=None):
+      path = [root if root is not None else self.snapshot.root]
+      for subtopic in subtopics:
+         child = path[-1].children.get(subtopic)
+         if child is None:
+            if not create:
+               raise KeyError(subtopic)
+            child = _TopicNode()
+
+         path.append(child)
+
+      return path
+
+   def _swap(self, path, subtopics, new_leaf):
+      # copy the path from the leaf to the root, removing the empty nodes,
+      # and return the new root (to be published as a new snapshot)
+      new_node = new_leaf
+      for i in range(len(subtopics), 0, -1):
+         parent = path[i-1]
+         children = dict(parent.children)
+         if new_node.is_empty():
+            children.pop(subtopics[i-1], None)
+         else:
+            children[subtopics[i-1]] = new_node
+
+         new_node = _TopicNode(parent.endpoints, children)
+
+      return new_node
+
+   def subscribers_of(self, topic):
+      ''' Return the set of alive endpoints subscribed to the topic or
+          to any of its prefixes. '''
+      snapshot = self.snapshot
+      try:
+         return snapshot.resolved_by_topic[topic]
+      except KeyError:
+         pass
+
+      if snapshot.has_patterns:
+         endpoints = self._match(snapshot.root, topic.split(b"."))
+      else:
+         node = snapshot.root
+         endpoints = set(node.endpoints)
+         for subtopic in topic.split(b"."):
+            node = node.children.get(subtopic)
+            if node is None:
+               break
+
+            endpoints.update(node.endpoints)
+
+      resolved = frozenset(endpoint for endpoint in endpoints if not endpoint.is_finished)
+
+      if len(snapshot.resolved_by_topic) >= self.cache_max_len:
+         snapshot.resolved_by_topic.clear()
+
+      snapshot.resolved_by_topic[topic] = resolved
+      return resolved
+
+   def _match(self, root, subtopics):
+      ''' Collect the endpoints of the nodes that match the first subtopics
+          (any of them, like a prefix), following the literal subtopic and
+          the wildcards. A node is visited once per position in the topic. '''
+      endpoints = set()
+      visited = set()
+      pending = [(root, 0)]
+      last = len(subtopics)
+      while pending:
+         node, i = pending.pop()
+         if (node, i) in visited:
+            continue
+
+         visited.add((node, i))
+         endpoints.update(node.endpoints)
+
+         children = node.children
+         if i < last:
+            for child in (children.get(subtopics[i]), children.get(SingleLevelWildcard)):
+               if child is not None:
+                  pending.append((child, i + 1))
+
+         # '#' matches from none to all the remaining subtopics
+         child = children.get(MultiLevelWildcard)
+         if child is not None:
+            pending.extend((child, j) for j in range(i, last + 1))
+
+      return endpoints
+
+   def subscriptions(self):
+      ''' Iterate over the pairs (topic, endpoints) of all the
+          subscribed topics of the current snapshot. '''
+      pending = [(b"", self.snapshot.root)]
+      while pending:
+         topic, node = pending.pop()
+         if node.endpoints:
+            yield topic, list(node.endpoints)
+
+         for subtopic, child in node.children.items():
+            pending.append(((topic + b"." + subtopic) if topic else subtopic, child))
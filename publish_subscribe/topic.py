@@ -1,3 +1,4 @@
+import re
 from .esc import esc, to_bytes
 
 def build_topic_chain(topic):
@@ -22,12 +23,23 @@ def build_topic_chain(topic):
 
 
 
+# letters, digits, underscores and dashes separated by single dots
+_valid_topic_re = re.compile(br"\A(?:[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*)?\Z")
+
 def fail_if_topic_isnt_valid(topic, allow_empty=False):
    ''' Validate the topic and raise an exception if it fails.
        Only letters, digits, underscore, dashes and dots are allowed.
 
        If 'allow_empty' is true, the empty topic is allowed too.
        '''
+   if _valid_topic_re.match(topic) and (topic or allow_empty):
+      return
+
+   # the topic is invalid: check it character by character to tell why
+   _fail_with_the_reason(topic, allow_empty)
+   raise Exception("The topic '%s' is not valid." % esc(topic))
+
+def _fail_with_the_reason(topic, allow_empty=False):
    import string
    VALID = to_bytes(string.ascii_letters + string.digits + "_-.")
 
@@ -47,5 +59,99 @@ def fail_if_topic_isnt_valid(topic, allow_empty=False):
    subtopics = topic.split(b".")
    if len(subtopics) > 1:
       for subtopic in subtopics:
-         fail_if_topic_isnt_valid(subtopic, allow_empty=False)
+         _fail_with_the_reason(subtopic, allow_empty=False)
+
+
+# The subscriptions can have wildcards, each one a whole subtopic:
+#  - '*' matches exactly one subtopic: result-gdb.*.42
+#  - '#' matches any number of subtopics, none included: gdb.#.breakpoint
+# Like a subscription to a topic receives the events of its subtopics too,
+# a pattern matches the topics that begin with a match.
+SingleLevelWildcard = b"*"
+MultiLevelWildcard = b"#"
+
+_valid_pattern_re = re.compile(br"\A(?:(?:[A-Za-z0-9_-]+|\*|#)(?:\.(?:[A-Za-z0-9_-]+|\*|#))*)?\Z")
+
+def is_pattern(topic):
+   return SingleLevelWildcard in topic or MultiLevelWildcard in topic
+
+def fail_if_pattern_isnt_valid(pattern):
+   if _valid_pattern_re.match(pattern):
+      return
+
+   raise Exception("The topic '%s' is not valid: only letters, digits, underscores and dashes separated by single dots are allowed, the wildcards '*' and '#' being whole subtopics." % esc(pattern))
+
+def compile_pattern(pattern):
+   ''' Return a function that tells if the pattern matches the topic or
+       one of its prefixes (see build_topic_chain). '''
+   parts = []
+   for subtopic in pattern.split(b"."):
+      if subtopic == SingleLevelWildcard:
+         parts.append(br"\.[^.]+")
+      elif subtopic == MultiLevelWildcard:
+         parts.append(br"(?:\.[^.]+)*")
+      else:
+         parts.append(br"\." + re.escape(subtopic))
+
+   # each subtopic is matched with its leading dot, so is the topic
+   regex = re.compile(br"\A" + b"".join(parts) + br"(?:\.|\Z)")
+   def matches(topic):
+      return regex.match(b"." + topic) is not None
+
+   return matches
+
+
+class ValidTopicsCache(object):
+   ''' The topics already validated so the hot paths validate each topic
+       only once.
+
+       The cache holds at most 'max_len' topics: when it is full it is
+       emptied and it starts over (like the cache of TopicIndex). The
+       topics of the requests carry pids and cookies so an unbounded
+       cache would grow forever.
+
+       The empty topic is never cached: it is valid only for some uses.
+       '''
+   def __init__(self, max_len=4096):
+      self.max_len = max_len
+      self.topics = set()
+      self.hits = self.misses = self.resets = 0
+
+   def validate(self, topic, allow_empty=False, allow_patterns=False):
+      ''' Raise an exception if the topic is not valid (see
+          fail_if_topic_isnt_valid). If 'allow_patterns' is true, the topic
+          can have wildcards (see fail_if_pattern_isnt_valid); the patterns
+          are never cached, like the empty topic. '''
+      if topic in self.topics:
+         self.hits += 1
+         return
+
+      self.misses += 1
+      if allow_patterns and is_pattern(topic):
+         fail_if_pattern_isnt_valid(topic)
+         return
+
+      fail_if_topic_isnt_valid(topic, allow_empty=allow_empty)
+      if not topic:
+         return
+
+      if len(self.topics) >= self.max_len:
+         self.topics.clear()
+         self.resets += 1
+
+      self.topics.add(topic)
+
+   def __contains__(self, topic):
+      return topic in self.topics
+
+   def __len__(self):
+      return len(self.topics)
 
+   def stats(self):
+      return {
+            'len': len(self.topics),
+            'max_len': self.max_len,
+            'hits': self.hits,
+            'misses': self.misses,
+            'resets': self.resets,
+            }
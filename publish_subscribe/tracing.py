@@ -0,0 +1,238 @@
+''' Timing of the stages of the hot path of the notifier and of the clients.
+
+    The instrumented code times a stage only if the tracing is active (a
+    hook was added), otherwise it costs a single check:
+
+        began = tracing.begin() if tracing.active else None
+        ...the stage...
+        if began is not None:
+           tracing.end("notifier.unpack", began)
+
+    Each hook is called with the name of the stage and how long it took
+    (in seconds). The stages are:
+
+     - notifier.receive: read the next message (in the threads engine this
+       includes the wait for it)
+     - notifier.unpack: unpack a publish or a batch
+     - notifier.distribute.lookup: find the subscribers of an event
+     - notifier.distribute.enqueue: queue the event for each subscriber
+       (including the waits for the lock or for room in their queues)
+     - notifier.send: write the queued frames in the socket
+     - client.receive, client.unpack (json.loads and the like),
+       client.dispatch (the callbacks) and client.send: the same for an
+       EventHandler
+
+    The hooks are global to the process: a notifier run in-process and
+    its clients share them.
+
+    A Sampler (see start_sampling) is a hook that keeps a latency histogram
+    by stage, timing only one of every N stages (picked at random, so the
+    stages that run in a fixed cycle are sampled evenly) to keep its
+    overhead low.
+    The notifier runs one if 'tracing_sample_every' is set and it adds its
+    histograms to its metrics (see Notifier.metrics). Then this module,
+    run as a script, dumps them as percentiles or as folded stacks for
+    flamegraph.pl:
+
+        python -m publish_subscribe.tracing [--address host:port] [--folded] [metrics.json]
+    '''
+import sys, time, threading, json, random
+
+# checked by the instrumented code before timing anything
+active = False
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+_sample_every = 1
+_random = random.random
+
+clock = getattr(time, "perf_counter", time.time)
+
+def add_hook(hook):
+   global active
+   with _hooks_lock:
+      _hooks.append(hook)
+      active = True
+
+def remove_hook(hook):
+   global active
+   with _hooks_lock:
+      _hooks.remove(hook)
+      active = bool(_hooks)
+
+def set_sampling(every):
+   ''' Time only one of every 'every' stages, on average. '''
+   global _sample_every
+   if every < 1:
+      raise ValueError("The sampling must time one of every N stages with N >= 1, not %s." % every)
+
+   _sample_every = every
+
+def begin():
+   ''' Return when the stage began or None if it is not sampled. Each
+       stage is sampled with a probability of 1/N, independently of the
+       others: a shared countdown would sample the stages that run in a
+       cycle whose length shares a factor with N more than the rest. '''
+   if _sample_every > 1 and _random() * _sample_every >= 1:
+      return None
+
+   return clock()
+
+def end(stage, began):
+   elapsed = clock() - began
+   for hook in list(_hooks):
+      hook(stage, elapsed)
+
+
+# The histograms count the nanoseconds in log-linear buckets: 8 buckets per
+# power of 2, so a bucket is at most 12.5% wide.
+_SubBuckets = 8
+
+def _bucket_of(ns):
+   if ns < _SubBuckets:
+      return ns
+
+   shift = ns.bit_length() - 4
+   return (shift + 1) * _SubBuckets + ((ns >> shift) & (_SubBuckets - 1))
+
+def _lower_bound_of(bucket):
+   if bucket < _SubBuckets:
+      return bucket
+
+   shift = bucket // _SubBuckets - 1
+   return (_SubBuckets + bucket % _SubBuckets) << shift
+
+def _upper_bound_of(bucket):
+   return _lower_bound_of(bucket + 1) - 1
+
+
+class Sampler(object):
+   ''' A hook that counts the elapsed times of each stage in a histogram. '''
+   def __init__(self, sample_every=1):
+      self.sample_every = sample_every
+      self.histograms = {}    # stage -> {bucket: count}
+      self.totals = {}        # stage -> sum of the elapsed times (ns)
+      self.samples = {}       # stage -> how many times it was sampled
+      self.lock = threading.Lock()
+
+   def __call__(self, stage, elapsed):
+      ns = int(elapsed * 1000000000)
+      bucket = _bucket_of(ns)
+      with self.lock:
+         histogram = self.histograms.get(stage)
+         if histogram is None:
+            histogram = self.histograms[stage] = {}
+            self.totals[stage] = self.samples[stage] = 0
+
+         histogram[bucket] = histogram.get(bucket, 0) + 1
+         self.totals[stage] += ns
+         self.samples[stage] += 1
+
+   def as_dict(self):
+      ''' Return the histograms, json-friendly: the buckets as the pairs
+          [upper bound in ns, count], sorted. '''
+      with self.lock:
+         return {
+               'sample_every': self.sample_every,
+               'stages': dict((stage, {
+                        'samples': self.samples[stage],
+                        'total_ns': self.totals[stage],
+                        'buckets': [[_upper_bound_of(bucket), n] for bucket, n in sorted(histogram.items())],
+                        }) for stage, histogram in self.histograms.items()),
+               }
+
+def start_sampling(every=100):
+   ''' Time one of every 'every' stages and return the Sampler that keeps them. '''
+   sampler = Sampler(every)
+   set_sampling(every)
+   add_hook(sampler)
+   return sampler
+
+def stop_sampling(sampler):
+   remove_hook(sampler)
+
+
+def percentile_of(buckets, p):
+   ''' Return the p-th percentile (0 < p <= 1), in ns, of the buckets of a
+       stage (see Sampler.as_dict). It is the upper bound of its bucket. '''
+   count = sum(n for bound, n in buckets)
+   seen = 0
+   for bound, n in buckets:
+      seen += n
+      if seen >= p * count:
+         return bound
+
+   return buckets[-1][0] if buckets else 0
+
+def percentile_report(histograms, out):
+   ''' Write a table with the percentiles of each stage in microseconds. '''
+   out.write("%-28s %9s %9s %9s %9s %9s %9s\n" % ("stage (us)", "samples", "p50", "p90", "p99", "p999", "max"))
+   for stage, histogram in sorted(histograms['stages'].items()):
+      buckets = histogram['buckets']
+      out.write("%-28s %9i %s\n" % (stage, histogram['samples'],
+            " ".join("%9.1f" % (percentile_of(buckets, p) / 1000.0) for p in (0.5, 0.9, 0.99, 0.999, 1))))
+
+def folded_report(histograms, out):
+   ''' Write the estimated time of each stage, in microseconds, as folded
+       stacks (notifier;distribute;lookup 1234), the input of flamegraph.pl.
+       Each stage was sampled with a probability of 1/N so its sampled time
+       times N estimates its whole time. '''
+   for stage, histogram in sorted(histograms['stages'].items()):
+      out.write("%s %i\n" % (stage.replace(".", ";"), histogram['total_ns'] * histograms['sample_every'] // 1000))
+
+
+def _next_published_metrics(address):
+   from .eventHandler import EventHandler
+
+   received = []
+   arrived = threading.Event()
+   def on_metrics(metrics):
+      received.append(metrics)
+      arrived.set()
+
+   handler = EventHandler(name="tracing-dump", address=address)
+   try:
+      handler.subscribe('notifier.metrics', on_metrics)
+      if not arrived.wait(120):
+         raise Exception("The notifier didn't publish its metrics (is its 'metrics_interval' 0?).")
+   finally:
+      handler.close()
+
+   return received[0]
+
+def main(argv):
+   import argparse
+   from .connection import UnixAddressPrefix
+
+   parser = argparse.ArgumentParser(description="Dump the latencies of the stages sampled by a notifier.")
+   parser.add_argument("metrics", nargs="?", help="a json file with the metrics of the notifier (by default they are received from it)")
+   parser.add_argument("--address", default="localhost:5555", help="the address of the notifier: host:port or unix:/path")
+   parser.add_argument("--folded", action="store_true", help="write folded stacks for flamegraph.pl instead of percentiles")
+   args = parser.parse_args(argv)
+
+   if args.metrics:
+      with open(args.metrics) as f:
+         metrics = json.load(f)
+   else:
+      address = args.address
+      if not address.startswith(UnixAddressPrefix):
+         host, port = address.rsplit(":", 1)
+         address = (host, int(port))
+
+      metrics = _next_published_metrics(address)
+
+   histograms = metrics.get('tracing')
+   if not histograms:
+      sys.stderr.write("The notifier doesn't sample its stages, see its 'tracing_sample_every'.\n")
+      return 1
+
+   if args.folded:
+      folded_report(histograms, sys.stdout)
+   else:
+      percentile_report(histograms, sys.stdout)
+
+   return 0
+
+if __name__ == '__main__':
+   sys.exit(main(sys.argv[1:]))
@@ -1,39 +1,574 @@
-import os, time
-from subprocess import check_output
-from threading import Lock
+''' Benchmark suite of the notifier and its clients.
 
-import publish_subscribe.eventHandler 
+    It starts a notifier in-process on a private port and runs the
+    scenarios below against it, printing a table and, optionally, writing
+    the results as json to track the regressions between versions:
 
-def is_running():
-    time.sleep(0.01)
-    out = check_output(["python", "publish_subscribe/notifier.py", "status"])
-    return "running" in out
+        python regress/publish_subscribe/perf.py --json results.json
+        python regress/publish_subscribe/perf.py --compare results.json
 
+    Scenarios:
+     - publish: throughput of a publisher, alone and with a subscriber
+     - latency: percentiles of the time from a publish to its delivery
+     - fanout: delivery to 1, 10, 100 and 1000 subscribers
+     - filters: delivery to 100 subscribers with content filters, 10
+       distinct ones, so each event matches a tenth of them
+     - hierarchy: publications on deep topics (subscribed at the top and
+       at the bottom of the hierarchy)
+     - payload: objects from 16 bytes to 16 MiB (the frame limit of the
+       version 1 of the protocol is 64 KiB, of the others 4 GiB)
+     - churn: subscriptions and unsubscriptions per second
+     - request: round trips of shortcuts.Requester (what shortcuts.request
+       uses) against a fake gdb, one by one and pipelined
+     - transports: latency and throughput over TCP, Unix sockets and an
+       in-process socketpair
 
-if __name__ == '__main__':
-    os.system("python publish_subscribe/notifier.py start")
-    assert is_running()
-    
+    Each result is a metric of a scenario with its parameters, like the
+    'throughput' of 'fanout' with {'subscribers': 100}. See workers_perf.py
+    for the scaling with the workers of the notifier.
+    '''
+from __future__ import print_function, division
+
+import sys, os, time, threading, socket, json, argparse, platform, tempfile, shutil, subprocess, collections
+sys.path.append(os.getcwd())
+
+from publish_subscribe.notifier import Notifier
+from publish_subscribe.eventHandler import EventHandler
+from publish_subscribe.connection import MessageReader
+from publish_subscribe.message import pack_message, unpack_message_body, ProtocolVersion
+from publish_subscribe.poller import Poller, READ
+from publish_subscribe.filters import canonical_filter
+from shortcuts import Requester
+
+Scenarios = collections.OrderedDict()
+
+def scenario(func):
+    Scenarios[func.__name__] = func
+    return func
+
+# the units in which less is better, for the comparisons
+LowerIsBetter = ("us", "ms", "s")
+
+
+def start_notifier(address, engine):
+    # no keepalive: the raw subscribers don't answer the pings
+    notifier = Notifier(address=address, pidfile=None, name="perf-notifier",
+                        foreground=True, listen_queue_len=1024, show_stats=False,
+                        stats_file=None, engine=engine, keepalive_interval=0)
+    notifier.init()
+    notifier.serving_thread = threading.Thread(target=notifier.serve)
+    notifier.serving_thread.daemon = True
+    notifier.serving_thread.start()
+    return notifier
+
+def stop_notifier(notifier):
+    notifier.mark_shutdown_gracefully()
+    if notifier.engine == "threads":
+        notifier.close()          # unblock the accept()
+    notifier.serving_thread.join()
+    notifier.close()
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def at(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return collections.OrderedDict([("p50", at(0.50)), ("p90", at(0.90)), ("p99", at(0.99)), ("p999", at(0.999)), ("max", samples[-1])])
+
+def sync(handler, _ids=[0]):
+    ''' Return once the notifier processed everything sent by the handler
+        (the subscribe waits for it). '''
+    _ids[0] += 1
+    handler.subscribe('perf.sync.%i' % _ids[0], lambda data: None)
+
+
+class RawSubscribers(object):
+    ''' Many subscribers that only count the events received, served by
+        a single thread with raw sockets so a thousand of them are cheap. '''
+    def __init__(self, address, count, topics, filters=None):
+        ''' Subscribe each one to the topics. If 'filters' is given (their
+            json, see filters), the subscriber i subscribes with the filter
+            i modulo their count. '''
+        self.received = 0
+        self.expected = None
+        self.done = threading.Event()
+        self.connections = []
+        self.version = ProtocolVersion
+
+        for i in range(count):
+            sock = socket.create_connection(address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = MessageReader()
+
+            sock.sendall(pack_message('hello', name=b"perf-raw", max_protocol_version=ProtocolVersion))
+            self._receive(sock, reader, 'welcome', 1)
+
+            if filters:
+                subscriptions = [pack_message('subscribe_filtered', topic=topic, filter_raw=filters[i % len(filters)], protocol_version=self.version) for topic in topics]
+            else:
+                subscriptions = [pack_message('subscribe', topic=topic, protocol_version=self.version) for topic in topics]
+            sock.sendall(b"".join(subscriptions) + pack_message('sync', cookie=i, protocol_version=self.version))
+            self.connections.append((sock, reader))
+
+        # the subscriptions are in place once they are synced
+        for sock, reader in self.connections:
+            self._receive(sock, reader, 'synced', self.version)
+
+        self.poller = Poller()
+        self.connections_by_fileno = {}
+        for sock, reader in self.connections:
+            sock.setblocking(False)
+            self.poller.register(sock.fileno(), READ)
+            self.connections_by_fileno[sock.fileno()] = (sock, reader)
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._count)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _receive(self, sock, reader, expected_type, protocol_version):
+        while True:
+            message = reader.next_message(protocol_version)
+            if message is not None:
+                assert message[0] == expected_type, message[0]
+                return unpack_message_body(*message)
+
+            if not reader.recv_from(sock):
+                raise Exception("The notifier closed the connection.")
+
+    def expect(self, events):
+        ''' Wait for the given count of events (in total, for all the
+            subscribers) since the last call. '''
+        self.done.clear()
+        self.expected = self.received + events
+        if self.received >= self.expected:
+            self.done.set()
+
+    def wait(self, timeout=300):
+        if not self.done.wait(timeout):
+            raise Exception("Only %i events of %i received." % (self.received, self.expected))
+
+    def _count(self):
+        while not self.closed:
+            for fileno, mask in self.poller.poll(0.2):
+                sock, reader = self.connections_by_fileno[fileno]
+                try:
+                    if not reader.recv_from(sock):
+                        self.poller.unregister(fileno)
+                        continue
+                except socket.error:
+                    continue
+
+                while True:
+                    message = reader.next_message(self.version)
+                    if message is None:
+                        break
+
+                    message_type, message_body = message
+                    if message_type == 'publish':
+                        self.received += 1
+                    elif message_type == 'publish_batch':
+                        self.received += len(unpack_message_body(message_type, message_body, dont_unpack_object=True))
+
+            if self.expected is not None and self.received >= self.expected:
+                self.done.set()
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.poller.close()
+        for sock, reader in self.connections:
+            sock.close()
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.address = ('localhost', args.port)
+        self.engine = args.engine
+        self.results = []
+        self.notifier = None
+
+    def scale(self, n):
+        return max(1, n // 10) if self.args.quick else n
+
+    def record(self, scenario, metric, value, unit, **params):
+        self.results.append(collections.OrderedDict([
+            ("scenario", scenario), ("metric", metric), ("params", params),
+            ("value", value), ("unit", unit)]))
+
+        print("%-11s %-18s %-32s %14.1f %s" % (scenario, metric,
+                ", ".join("%s=%s" % item for item in sorted(params.items())), value, unit), file=self.args.table)
+        self.args.table.flush()
+
+    def handler(self, name, **kargs):
+        return EventHandler(name=name, address=kargs.pop('address', self.address), **kargs)
+
+
+@scenario
+def publish(bench):
+    events = bench.scale(20000)
+
+    publisher = bench.handler("perf-publisher")
+    try:
+        begin = time.time()
+        for i in range(events):
+            publisher.publish('perf.nobody', i)
+        sync(publisher)
+        bench.record("publish", "throughput", events / (time.time() - begin), "events/s", subscribers=0)
+
+        subscribers = RawSubscribers(bench.address, 1, [b'perf.data'])
+        try:
+            subscribers.expect(events)
+            begin = time.time()
+            for i in range(events):
+                publisher.publish('perf.data', i)
+            subscribers.wait()
+            bench.record("publish", "throughput", events / (time.time() - begin), "events/s", subscribers=1)
+
+            # the same events coalesced in batches by the publisher
+            batch = 64
+            subscribers.expect(events)
+            begin = time.time()
+            for i in range(0, events, batch):
+                publisher.publish_many([('perf.data', j) for j in range(i, min(events, i + batch))])
+            subscribers.wait()
+            bench.record("publish", "throughput", events / (time.time() - begin), "events/s", subscribers=1, batch=batch)
+        finally:
+            subscribers.close()
+    finally:
+        publisher.close()
+
+@scenario
+def latency(bench):
+    samples = bench.scale(5000)
+
+    publisher = bench.handler("perf-publisher")
+    subscriber = bench.handler("perf-subscriber")
+    arrived = threading.Event()
+    subscriber.subscribe('perf.latency', lambda data: arrived.set())
+    try:
+        elapsed = []
+        for i in range(samples):
+            arrived.clear()
+            begin = time.time()
+            publisher.publish('perf.latency', i)
+            arrived.wait()
+            elapsed.append((time.time() - begin) * 1e6)
+
+        for name, value in percentiles(elapsed).items():
+            bench.record("latency", name, value, "us")
+    finally:
+        publisher.close()
+        subscriber.close()
+
+@scenario
+def fanout(bench):
+    deliveries = bench.scale(200000)
+
+    publisher = bench.handler("perf-publisher")
     try:
-        agent1 = publish_subscribe.eventHandler.EventHandler()
+        for count in (1, 10, 100, 1000):
+            subscribers = RawSubscribers(bench.address, count, [b'perf.fanout'])
+            try:
+                events = max(10, deliveries // count)
+                subscribers.expect(events * count)
+                begin = time.time()
+                for i in range(events):
+                    publisher.publish('perf.fanout', i)
+                subscribers.wait()
+                elapsed = time.time() - begin
+
+                bench.record("fanout", "throughput", events / elapsed, "events/s", subscribers=count)
+                bench.record("fanout", "deliveries", events * count / elapsed, "events/s", subscribers=count)
+            finally:
+                subscribers.close()
+    finally:
+        publisher.close()
 
-        is_done = Lock()
-        is_done.acquire()
-        def done(e):
-            global is_done
-            is_done.release()
-        agent1.subscribe('bar', done)
+@scenario
+def filters(bench):
+    count, distinct = 100, 10
+    events = bench.scale(20000)
 
+    publisher = bench.handler("perf-publisher")
+    try:
+        filters = [canonical_filter({'thread-id': i}) for i in range(distinct)]
+        subscribers = RawSubscribers(bench.address, count, [b'perf.filters'], filters)
         try:
-            payload = {chr(k) * 1: {chr(q)*2: range(4) for q in range(ord('A'), ord('z'))}
-                            for k in range(ord('A'), ord('z'))}
-            for i in range(10000, -1, -1):
-                agent1.publish('foo', {'n': i, 'd': payload})
-            agent1.publish('bar', {})
-            is_done.acquire()
+            subscribers.expect(events * count // distinct)
+            begin = time.time()
+            for i in range(events):
+                publisher.publish('perf.filters', {'thread-id': i % distinct, 'n': i})
+            subscribers.wait()
+            elapsed = time.time() - begin
 
+            bench.record("filters", "throughput", events / elapsed, "events/s", subscribers=count, filters=distinct)
+            bench.record("filters", "deliveries", events * count // distinct / elapsed, "events/s", subscribers=count, filters=distinct)
         finally:
-            agent1.close()
+            subscribers.close()
     finally:
-        os.system("python publish_subscribe/notifier.py stop")
+        publisher.close()
+
+@scenario
+def hierarchy(bench):
+    events = bench.scale(20000)
+
+    publisher = bench.handler("perf-publisher")
+    try:
+        for depth in (1, 4, 16, 64):
+            parents = ".".join("l%i" % level for level in range(depth))
 
+            # more distinct topics than the cache of the resolved subscriptions
+            topics = ["%s.e%i" % (parents, i) for i in range(8192)]
+            subscribed = [b"l0", parents.encode("ascii")]
+
+            subscribers = RawSubscribers(bench.address, 1, subscribed)
+            try:
+                subscribers.expect(events)
+                begin = time.time()
+                for i in range(events):
+                    publisher.publish(topics[i % len(topics)], i)
+                subscribers.wait()
+                bench.record("hierarchy", "throughput", events / (time.time() - begin), "events/s", depth=depth + 1)
+            finally:
+                subscribers.close()
+    finally:
+        publisher.close()
+
+@scenario
+def payload(bench):
+    budget = bench.scale(256 * 1024 * 1024)   # bytes published by size
+
+    publisher = bench.handler("perf-publisher")
+    subscribers = RawSubscribers(bench.address, 1, [b'perf.payload'])
+    try:
+        for size in (16, 1024, 16 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024):
+            data = "x" * size
+            events = max(5, min(bench.scale(20000), budget // size))
+
+            subscribers.expect(events)
+            begin = time.time()
+            for i in range(events):
+                publisher.publish('perf.payload', data)
+            subscribers.wait()
+            elapsed = time.time() - begin
+
+            bench.record("payload", "throughput", events / elapsed, "events/s", size=size)
+            bench.record("payload", "bandwidth", events * size / elapsed / (1024 * 1024), "MiB/s", size=size)
+    finally:
+        subscribers.close()
+        publisher.close()
+
+@scenario
+def churn(bench):
+    operations = bench.scale(20000)
+
+    handler = bench.handler("perf-churner")
+    try:
+        # some subscriptions that stay, the trie is not empty
+        for i in range(100):
+            handler.subscribe('perf.stay.%i' % i, lambda data: None, send_and_wait_echo=False)
+        sync(handler)
+
+        begin = time.time()
+        for i in range(operations // 2):
+            subscription_id = handler.subscribe('perf.churn.%i' % (i % 100), lambda data: None, return_subscription_id=True, send_and_wait_echo=False)
+            handler.unsubscribe(subscription_id)
+        sync(handler)
+        bench.record("churn", "throughput", operations / (time.time() - begin), "ops/s")
+
+        # waiting for each subscription to be in place
+        count = bench.scale(2000)
+        begin = time.time()
+        for i in range(count):
+            handler.subscribe('perf.synced.%i' % i, lambda data: None)
+        bench.record("churn", "synced", count / (time.time() - begin), "ops/s")
+    finally:
+        handler.close()
+
+@scenario
+def request(bench):
+    class FakeGdb(object):
+        def get_gdb_pid(self):
+            return 42
+
+    gdb_side = bench.handler("perf-fake-gdb")
+    gdb_side.subscribe("request-gdb.42", lambda request: gdb_side.publish("result-gdb.42.%i" % request['token'], {'echo': request['command']}))
+
+    requester = Requester(name="perf-requester", address=bench.address)
+    gdb = FakeGdb()
+    try:
+        requester.request(gdb, "-warm-up", timeout=10)
+
+        samples = bench.scale(2000)
+        elapsed = []
+        for i in range(samples):
+            begin = time.time()
+            requester.request(gdb, "-cmd", timeout=10)
+            elapsed.append((time.time() - begin) * 1e6)
+
+        for name, value in percentiles(elapsed).items():
+            bench.record("request", name, value, "us")
+
+        count = bench.scale(10000)
+        begin = time.time()
+        pending = [requester.request_async(gdb, "-cmd-%i" % i) for i in range(count)]
+        for response in pending:
+            response.result(timeout=60)
+        bench.record("request", "pipelined", count / (time.time() - begin), "requests/s")
+    finally:
+        requester.close()
+        gdb_side.close()
+
+@scenario
+def transports(bench):
+    events = bench.scale(10000)
+    round_trips = bench.scale(2000)
+
+    def measure(transport, connect):
+        publisher = EventHandler(name="perf-publisher", address=connect())
+        subscriber = EventHandler(name="perf-subscriber", address=connect())
+        arrived = threading.Event()
+        received = [0]
+        def on_data(data):
+            received[0] += 1
+            if received[0] == events:
+                arrived.set()
+        subscriber.subscribe('perf.data', on_data)
+        publisher.subscribe('perf.latency', lambda data: arrived.set())
+        try:
+            begin = time.time()
+            for i in range(round_trips):
+                arrived.clear()
+                publisher.publish('perf.latency', i)
+                arrived.wait()
+            bench.record("transports", "round_trip", (time.time() - begin) / round_trips * 1e6, "us", transport=transport)
+
+            arrived.clear()
+            begin = time.time()
+            for i in range(events):
+                publisher.publish('perf.data', i)
+            arrived.wait()
+            bench.record("transports", "throughput", events / (time.time() - begin), "events/s", transport=transport)
+        finally:
+            publisher.close()
+            subscriber.close()
+
+    measure("tcp", lambda: bench.address)
+    measure("socketpair", bench.notifier.socketpair)
+
+    tmpdir = tempfile.mkdtemp()
+    address = "unix:" + os.path.join(tmpdir, "notifier.sock")
+    notifier = start_notifier(address, bench.engine)
+    try:
+        measure("unix", lambda: address)
+    finally:
+        stop_notifier(notifier)
+        shutil.rmtree(tmpdir)
+
+
+def metadata(args):
+    try:
+        revision = subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.STDOUT).decode("ascii").strip()
+    except Exception:
+        revision = None
+
+    return collections.OrderedDict([
+        ("revision", revision),
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("cpus", _cpu_count()),
+        ("engine", args.engine),
+        ("protocol_version", ProtocolVersion),
+        ("quick", args.quick),
+        ])
+
+def _cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def key_of(result):
+    return (result["scenario"], result["metric"], tuple(sorted(result["params"].items())))
+
+def compare(results, baseline, tolerance, out):
+    ''' Print the results that are worse than the baseline by more than the
+        tolerance (a fraction). Return how many there are. '''
+    baseline_by_key = dict((key_of(result), result) for result in baseline["results"])
+
+    regressions = 0
+    for result in results:
+        old = baseline_by_key.get(key_of(result))
+        if old is None or not old["value"]:
+            continue
+
+        change = (result["value"] - old["value"]) / old["value"]
+        worse = change > tolerance if result["unit"] in LowerIsBetter else change < -tolerance
+        if worse:
+            regressions += 1
+            print("REGRESSION %-11s %-18s %-32s %14.1f -> %.1f %s (%+.0f%%)" % (result["scenario"], result["metric"],
+                    ", ".join("%s=%s" % (k, v) for k, v in sorted(result["params"].items())),
+                    old["value"], result["value"], result["unit"], change * 100), file=out)
+
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark suite of the notifier.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help="the scenarios to run: %s (all by default)" % ", ".join(Scenarios))
+    parser.add_argument("--engine", default="eventloop", choices=("eventloop", "threads"), help="the engine of the notifier")
+    parser.add_argument("--port", type=int, default=5590, help="the private port of the notifier")
+    parser.add_argument("--quick", action="store_true", help="a tenth of the events, for a smoke test")
+    parser.add_argument("--json", metavar="FILE", help="write the results as json in the file ('-' for the stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a previous json file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="the worsening (a fraction) tolerated by --compare")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.scenarios if name not in Scenarios]
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(unknown))
+
+    # the table goes to the stderr if the json goes to the stdout
+    args.table = sys.stderr if args.json == "-" else sys.stdout
+
+    # a thousand subscribers need two thousand file descriptors
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, 8192) if hard != resource.RLIM_INFINITY else 8192, hard))
+    except (ImportError, ValueError):
+        pass
+
+    bench = Bench(args)
+    bench.notifier = start_notifier(bench.address, args.engine)
+    try:
+        for name in (args.scenarios or Scenarios):
+            Scenarios[name](bench)
+    finally:
+        stop_notifier(bench.notifier)
+
+    report = collections.OrderedDict([("meta", metadata(args)), ("results", bench.results)])
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    elif args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        differences = [key for key in ("python", "engine", "cpus", "quick") if baseline["meta"].get(key) != report["meta"][key]]
+        if differences:
+            print("Warning: the baseline was taken with another %s." % ", ".join(differences), file=args.table)
+
+        regressions = compare(bench.results, baseline, args.tolerance, args.table)
+        print("%i regressions (tolerance %.0f%%) against %s." % (regressions, args.tolerance * 100, args.compare), file=args.table)
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
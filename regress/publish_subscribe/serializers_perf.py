@@ -0,0 +1,36 @@
+import sys, os, timeit
+sys.path.append(os.getcwd())
+
+from publish_subscribe.serializers import serializer_by_name
+from publish_subscribe.message import pack_message, unpack_message_body
+
+# Typical debugger data: the registers of the cpu and a dump of the memory
+registers = dict(("r%i" % i, 0xbfff0000 + i * 4096) for i in range(32))
+registers.update({'eflags': 0x246, 'st0': 1.5, 'running': False})
+
+memory = [{'address': 0x8048000 + i * 16, 'bytes': [(i * 7 + j) % 256 for j in range(16)]} for i in range(256)]
+
+payloads = [('registers', registers), ('memory', memory)]
+
+
+def bench(label, func, number):
+    elapsed = min(timeit.repeat(func, number=number, repeat=3))
+    print("  %-28s %8.2f us" % (label, elapsed / number * 1e6))
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for payload_name, obj in payloads:
+        print("%s:" % payload_name)
+        for name in ("json", "msgpack"):
+            s = serializer_by_name(name)
+            raw = s.dumps(obj)
+            print("  %-28s %8i bytes" % ("%s size" % name, len(raw)))
+
+            bench("%s dumps" % name, lambda: s.dumps(obj), number)
+            bench("%s loads" % name, lambda: s.loads(raw), number)
+
+            # the whole path of a publication: pack and unpack the message
+            bench("%s pack+unpack message" % name,
+                    lambda: unpack_message_body('publish', pack_message('publish', topic=b"foo", obj=obj, dont_pack_object=False, protocol_version=3, serializer=name)[5:], dont_unpack_object=False, content_typed=True),
+                    number)
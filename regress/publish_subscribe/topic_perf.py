@@ -0,0 +1,32 @@
+import sys, os, timeit
+sys.path.append(os.getcwd())
+
+from publish_subscribe.topic import fail_if_topic_isnt_valid, _fail_with_the_reason, ValidTopicsCache
+
+# Typical topics: the requests to gdb carry its pid and a cookie
+topics = [b"request-gdb.%i.%i" % (4242, cookie) for cookie in range(1000)]
+topics += [b"gdb.4242.type.Stopped", b"spawner.add-debugger", b"foo"]
+
+
+def bench(label, func, number):
+    elapsed = min(timeit.repeat(func, number=number, repeat=3))
+    print("  %-36s %8.3f us/topic" % (label, elapsed / number / len(topics) * 1e6))
+
+def validate_all(validate):
+    for topic in topics:
+        validate(topic)
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    cache = ValidTopicsCache()
+    small_cache = ValidTopicsCache(max_len=100)
+
+    print("validation of %i topics:" % len(topics))
+    bench("per character (the old validator)", lambda: validate_all(_fail_with_the_reason), number)
+    bench("regex", lambda: validate_all(fail_if_topic_isnt_valid), number)
+    bench("cache (all hits)", lambda: validate_all(cache.validate), number)
+    bench("cache (smaller than the topics)", lambda: validate_all(small_cache.validate), number)
+
+    print("cache stats: %s" % cache.stats())
+    print("small cache stats: %s" % small_cache.stats())
@@ -0,0 +1,109 @@
+import sys, os, time, threading, multiprocessing
+sys.path.append(os.getcwd())
+
+from publish_subscribe.notifier import Notifier
+from publish_subscribe.eventHandler import EventHandler
+
+# Throughput of the notifier by the number of its workers: several
+# publishers and subscribers, each one in its own process, exchange events
+# through a notifier of 1, 2, 4... workers. Each subscriber checks that the
+# events of each publisher arrive in order.
+#
+#   python regress/publish_subscribe/workers_perf.py [events per publisher] [publishers] [subscribers] [max workers] [engine]
+
+Port = 5571
+
+def start_notifier(workers, engine):
+    notifier = Notifier(address=('localhost', Port), pidfile=None, name="perf-notifier",
+                        foreground=True, listen_queue_len=64, show_stats=False,
+                        stats_file=None, engine=engine, workers=workers)
+    notifier.init()
+    notifier.serving_thread = threading.Thread(target=notifier.serve)
+    notifier.serving_thread.daemon = True
+    notifier.serving_thread.start()
+    return notifier
+
+def stop_notifier(notifier):
+    notifier.mark_shutdown_gracefully()
+    if notifier.engine == "threads":
+        notifier.close()          # unblock the accept()
+    notifier.serving_thread.join()
+    notifier.close()
+
+def subscriber(events, publishers, ready, start, results):
+    handler = EventHandler(name="perf-subscriber", address=('localhost', Port))
+    last_by_publisher = [-1] * publishers
+    state = {'received': 0, 'in_order': True}
+    done = threading.Event()
+
+    def on_event(data):
+        publisher, n = data
+        if n != last_by_publisher[publisher] + 1:
+            state['in_order'] = False
+        last_by_publisher[publisher] = n
+
+        state['received'] += 1
+        if state['received'] == events * publishers:
+            done.set()
+
+    handler.subscribe('perf', on_event)   # it waits until every worker knows it
+    ready.put(True)
+
+    start.wait()
+    done.wait()
+    results.put((time.time(), state['in_order']))
+    handler.close()
+
+def publisher(publisher_id, events, ready, start):
+    handler = EventHandler(name="perf-publisher", address=('localhost', Port))
+    ready.put(True)
+
+    start.wait()
+    for n in range(events):
+        handler.publish('perf.data', [publisher_id, n])
+    handler.close()
+
+def bench(workers, engine, events, publishers, subscribers):
+    notifier = start_notifier(workers, engine)
+    try:
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        start = multiprocessing.Event()
+
+        processes = [multiprocessing.Process(target=subscriber, args=(events, publishers, ready, start, results)) for i in range(subscribers)]
+        processes += [multiprocessing.Process(target=publisher, args=(i, events, ready, start)) for i in range(publishers)]
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            ready.get()
+
+        begin = time.time()
+        start.set()
+
+        finished = [results.get() for i in range(subscribers)]
+        for process in processes:
+            process.join()
+    finally:
+        stop_notifier(notifier)
+
+    elapsed = max(end for end, in_order in finished) - begin
+    delivered = events * publishers * subscribers
+    in_order = all(in_order for end, in_order in finished)
+
+    print("%7i %10.2f s %12.0f events/s %9s" % (workers, elapsed, delivered / elapsed, "yes" if in_order else "NO"))
+
+if __name__ == '__main__':
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    publishers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    subscribers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    max_workers = int(sys.argv[4]) if len(sys.argv) > 4 else multiprocessing.cpu_count()
+    engine = sys.argv[5] if len(sys.argv) > 5 else "eventloop"
+
+    print("%i events x %i publishers -> %i subscribers, %s engine, %i cores" % (
+                events, publishers, subscribers, engine, multiprocessing.cpu_count()))
+    print("%7s %12s %19s %9s" % ("workers", "elapsed", "throughput", "in order"))
+
+    workers = 1
+    while workers <= max_workers:
+        bench(workers, engine, events, publishers, subscribers)
+        workers *= 2
@@ -4,6 +4,7 @@ import time
 import sys
 from subprocess import check_output, check_call
 import random
+import threading
 from threading import Lock
 
 if __package__:
@@ -32,45 +33,226 @@ def stop_notifier(path):
    notifier_path = os.path.join(path, "notifier").replace(os.sep, '.')
    check_call(["python", "-m", notifier_path, "stop"]) 
 
-def request(gdb, command, arguments=tuple(), return_none=False):
-   cookie = int(random.getrandbits(30))
-   request_topic = "request-gdb.%i.%i" % (gdb.get_gdb_pid(), cookie)
-   response_topic = "result-gdb.%i.%i" % (gdb.get_gdb_pid(), cookie)
-
-   # Build the command correctly: use always the MI interface and a cookie
-   if not command.startswith("-"):
-      interpreter = 'console'
-   else:
-      interpreter = 'mi'
-
-   request_for_command = {
-         'command': command,
-         'token': cookie,
-         'arguments': arguments,
-         'interpreter': interpreter,
-   }
-
-   # Create a flag acquired by default
-   response_received_flag = Lock()
-   response_received_flag.acquire() 
-
-   ctx = {}
-   def _wait_and_get_response_from_gdb(event):
-      ctx['response'] = event
-      response_received_flag.release() # release the flag, response received!
-      
-   pubsub = EventHandler(name="requester")
-   subscription_id = pubsub.subscribe(
-                                 response_topic, 
-                                 _wait_and_get_response_from_gdb, 
-                                 return_subscription_id = True
-                        )
-
-   pubsub.publish(request_topic, request_for_command)
-   response_received_flag.acquire() # block until the flag is release by the callback (and the respose was received)
-   pubsub.unsubscribe(subscription_id)
-
-   return None if return_none else ctx['response']
+class PendingResponse(object):
+   ''' The response of a request sent by a Requester, not received yet
+       perhaps. Call 'result' to wait for it. '''
+   def __init__(self, requester, response_topic):
+      self.requester = requester
+      self.response_topic = response_topic
+      self.received_flag = threading.Event()
+      self.response = self.error = None
+
+   def _set(self, response=None, error=None):
+      self.response, self.error = response, error
+      self.received_flag.set()
+
+   def done(self):
+      return self.received_flag.is_set()
+
+   def result(self, timeout=None):
+      ''' Wait at most 'timeout' seconds (forever if None) for the
+          response and return it. If it timed out, the response is
+          discarded and an exception is raised. '''
+      if not self.received_flag.wait(timeout):
+         self.requester._forget(self)
+         raise Exception("The response in the topic '%s' timed out after %s seconds." % (to_text(self.response_topic), timeout))
+
+      if self.error is not None:
+         raise self.error
+
+      return self.response
+
+
+class _RequesterEventHandler(EventHandler):
+   def __init__(self, requester, **kargs):
+      self.requester = requester
+      EventHandler.__init__(self, as_daemon=True, **kargs)
+
+   def dispatch(self, topic, obj):
+      self.requester._route(topic, obj)
+      EventHandler.dispatch(self, topic, obj)
+
+   def run(self):
+      try:
+         EventHandler.run(self)
+      finally:
+         # no response can arrive anymore
+         self.requester._connection_lost(self)
+
+
+class Requester(object):
+   ''' Send requests to gdb and receive their responses over a single,
+       long-lived connection.
+
+       The requester subscribes once to the 'result-gdb.<pid>' topic of
+       each gdb; the responses are routed to their requests by the cookie
+       in their topic so any number of requests can be pending at the
+       same time (see request_async).
+       '''
+   def __init__(self, name="requester", address=("localhost", 5555)):
+      self.name = name
+      self.address = address
+
+      self.lock = Lock()
+      self.pubsub = None
+      self.subscribed_pids = {}   # the subscription to the results of each gdb, set once it is in place
+      self.pending_by_topic = {}
+
+   def request(self, gdb, command, arguments=tuple(), return_none=False, timeout=None):
+      ''' Send the command to gdb and wait for its response at most
+          'timeout' seconds (forever if None). '''
+      response = self.request_async(gdb, command, arguments).result(timeout)
+      return None if return_none else response
+
+   def request_async(self, gdb, command, arguments=tuple()):
+      ''' Send the command to gdb and return a PendingResponse without
+          waiting for the response. This allows to pipeline many commands. '''
+      gdb_pid = gdb.get_gdb_pid()
+      pubsub = self._connected_to(gdb_pid)
+
+      cookie = int(random.getrandbits(30))
+      request_topic = "request-gdb.%i.%i" % (gdb_pid, cookie)
+      response_topic = to_bytes("result-gdb.%i.%i" % (gdb_pid, cookie))
+
+      # Build the command correctly: use always the MI interface and a cookie
+      if not command.startswith("-"):
+         interpreter = 'console'
+      else:
+         interpreter = 'mi'
+
+      request_for_command = {
+            'command': command,
+            'token': cookie,
+            'arguments': arguments,
+            'interpreter': interpreter,
+      }
+
+      response = PendingResponse(self, response_topic)
+      with self.lock:
+         if self.pubsub is not pubsub:
+            raise Exception("The connection was lost before sending the request.")
+
+         if response_topic in self.pending_by_topic:
+            raise Exception("There is already a request pending with the cookie %i." % cookie)
+         self.pending_by_topic[response_topic] = response
+
+      try:
+         pubsub.publish(request_topic, request_for_command)
+      except:
+         self._forget(response)
+         raise
+
+      return response
+
+   def _connected_to(self, gdb_pid):
+      # the first caller for a gdb subscribes to its results; the others
+      # wait for it so their requests cannot be sent before the
+      # subscription is in place (their responses would be lost)
+      while True:
+         with self.lock:
+            pubsub = self.pubsub
+            connected = pubsub is not None and not pubsub.connection.closed
+            if connected:
+               subscribed = self.subscribed_pids.get(gdb_pid)
+               must_subscribe = subscribed is None
+               if must_subscribe:
+                  subscribed = self.subscribed_pids[gdb_pid] = threading.Event()
+
+         if not connected:
+            self._reconnect(pubsub)
+            continue
+
+         if must_subscribe:
+            try:
+               # the callback does nothing: the responses are routed by _route
+               pubsub.subscribe("result-gdb.%i" % gdb_pid, lambda data: None)
+            except:
+               with self.lock:
+                  if self.subscribed_pids.get(gdb_pid) is subscribed:
+                     del self.subscribed_pids[gdb_pid]
+               raise
+            finally:
+               subscribed.set()
+
+            return pubsub
+
+         subscribed.wait()
+         with self.lock:
+            if self.subscribed_pids.get(gdb_pid) is subscribed and self.pubsub is pubsub:
+               return pubsub
+
+         # the subscription failed or the connection was replaced: try again
+
+   def _reconnect(self, old_pubsub):
+      # connecting can take a while (it retries) so it is done without
+      # the lock, which _route, _forget and close need meanwhile
+      pubsub = _RequesterEventHandler(self, name=self.name, address=self.address)
+      with self.lock:
+         replaced = self.pubsub is old_pubsub
+         if replaced:
+            # the subscriptions were lost with the old connection and so
+            # the responses pending on it
+            self.pubsub = pubsub
+            self.subscribed_pids.clear()
+            stale, self.pending_by_topic = self.pending_by_topic, {}
+
+      if replaced:
+         self._fail_lost(stale)
+      else:
+         pubsub.close()   # another caller reconnected first
+
+   def _connection_lost(self, pubsub):
+      # called by the reader of the connection when it ends
+      with self.lock:
+         if self.pubsub is not pubsub:
+            return   # closed or replaced already
+
+         self.pubsub = None
+         self.subscribed_pids.clear()
+         stale, self.pending_by_topic = self.pending_by_topic, {}
+
+      self._fail_lost(stale)
+
+   def _fail_lost(self, pending_by_topic):
+      for response in pending_by_topic.values():
+         response._set(error=Exception("The connection was lost before receiving the response in the topic '%s'." % to_text(response.response_topic)))
+
+   def _route(self, topic, obj):
+      with self.lock:
+         response = self.pending_by_topic.pop(topic, None)
+
+      if response is not None:
+         response._set(response=obj)
+
+   def _forget(self, response):
+      with self.lock:
+         if self.pending_by_topic.get(response.response_topic) is response:
+            del self.pending_by_topic[response.response_topic]
+
+   def close(self):
+      ''' Close the connection; the pending requests fail. '''
+      with self.lock:
+         pubsub, self.pubsub = self.pubsub, None
+         pending, self.pending_by_topic = self.pending_by_topic, {}
+
+      for response in pending.values():
+         response._set(error=Exception("The requester was closed before receiving the response in the topic '%s'." % to_text(response.response_topic)))
+
+      if pubsub is not None:
+         pubsub.close()
+
+
+_default_requester = Requester()
+
+def request(gdb, command, arguments=tuple(), return_none=False, timeout=None):
+   ''' Send the command to gdb and return its response using a shared
+       Requester. See Requester.request. '''
+   return _default_requester.request(gdb, command, arguments, return_none=return_none, timeout=timeout)
+
+def request_async(gdb, command, arguments=tuple()):
+   ''' Send the command to gdb and return a PendingResponse using a shared
+       Requester. See Requester.request_async. '''
+   return _default_requester.request_async(gdb, command, arguments)
 
 
 def collect(func_collector):